@@ -1,16 +1,25 @@
 import numpy as np
 import jax
-from copy import deepcopy
+import hashlib
+import uuid
+from concurrent.futures import ProcessPoolExecutor
 
 from classes.action_states.as_helpers import Pseudo_AS
+from classes.batch_ou_network import Batch_OU_Network
+from methods.executor_methods import make_executor, rollout_payload, pack_payload, tree_search_task
+from methods.retention_methods import build_retention_mask
 
 
 class Action_state():
+    # True if fitting or sampling rolls back the internal state, which then needs its full history
+    rolls_back_internal_state = False
+
     def __init__(self, N, K, 
                           behaviour,
                           epsilon, 
                           sample_action_func,
-                          fit_action_func):
+                          fit_action_func,
+                          retention='full'):
 
         self._N = N
         self._n = 0
@@ -45,6 +54,9 @@ class Action_state():
         ## Variables intervened on for future fitting
         self._variable_history = np.zeros(self._N+1)
         self._variable_history[:] = np.nan
+        ## Frames at which action values are kept, see methods.retention_methods
+        ## Actions themselves are always kept as they are read back when fitting
+        self._retention_mask = build_retention_mask(self._N, retention)
  
         # Set realised to False by default
         self._realised = False
@@ -224,6 +236,12 @@ class Action_state():
                 self._actions_history[n] = None
 
 
+    # Record a value in a per frame history if the current frame is retained
+    def _record(self, history, value):
+        if self._retention_mask[self._n]:
+            history[self._n] = value
+
+
     @property
     def a(self):
         return self._current_action
@@ -309,8 +327,8 @@ class Action_state():
 
 # Tree search action selection
 class Treesearch_AS(Action_state):
-    def __init__(self, N, K, behaviour, epsilon, possible_actions, action_len, policy_funcs, C, knowledge, gain_type, tree_search_func, tree_search_func_args=[], resource_rational_parameter=0):
-        super().__init__(N, K, behaviour, epsilon, self._tree_search_action_sample, self._tree_search_action_fit)
+    def __init__(self, N, K, behaviour, epsilon, possible_actions, action_len, policy_funcs, C, knowledge, gain_type, tree_search_func, tree_search_func_args=[], resource_rational_parameter=0, rollouts='sequential', executor='serial', workers=None, transpositions=False, tolerance=None, common_random_numbers=False, estimator='simulation', fit_schedule='every_frame', retention='full'):
+        super().__init__(N, K, behaviour, epsilon, self._tree_search_action_sample, self._tree_search_action_fit, retention=retention)
 
         # Num of possible action is all possible values for all variable plus 1 for staying idle
         self._num_actions = self._K * len(possible_actions) + 1
@@ -340,6 +358,7 @@ class Treesearch_AS(Action_state):
         self._action_values = [None for i in range(self._N+1)]
         self._action_seqs_values = [None for i in range(self._N+1)]
         self._action_seqs = [None for i in range(self._N+1)]
+        self._action_len_history = np.zeros(self._N+1)
         
         self._knowledge = knowledge
         self._C = C  
@@ -352,6 +371,76 @@ class Treesearch_AS(Action_state):
             self._resource_rational_parameter = resource_rational_parameter
             self._gain_function = self._resource_rational
 
+        # Rollouts
+        ## 'sequential': every branch is simulated on its own by the tree search function
+        ## 'batched': all branches of a tree level, for all sampled graphs, are simulated in lockstep, see _batched_seqs_values
+        ### Requires a fixed depth tree (set by subclasses in _batched_depth), information gain and states supporting batched rollouts, falls back to sequential otherwise
+        self._rollouts = rollouts
+        self._batched_depth = None
+
+        # Executor of sequential rollouts, see methods.executor_methods
+        ## 'serial': branches are explored in place one after the other
+        ## 'process': the subtrees of each root action, for each sampled graph, are explored concurrently by a pool of worker processes
+        ##            Each task seeds its own process, seeded runs are reproducible
+        ### The pool is created at the first action selection and kept until close_executor is called, at the end of Experiment.fit and run
+        ### A pool can be given instead of 'process', e.g. by methods.executor_methods.shared_executors, it is then owned by the caller
+        ### and kept open across trials
+        ### Threads are not supported: rollouts draw from the global numpy generator, concurrent draws are not reproducible
+        if isinstance(executor, ProcessPoolExecutor):
+            self._executor = 'process'
+            self._executor_pool = executor
+            self._owns_executor = False
+        elif executor not in ['serial', 'process']:
+            raise ValueError(f"Unknown executor {executor}, can be 'serial' or 'process'")
+        else:
+            self._executor = executor
+            self._executor_pool = None
+            self._owns_executor = True
+        self._workers = workers
+
+        # Transposition table of serial sequential rollouts, see _transposed_local_experiment
+        ## Branches starting from the same node, i.e. same frame, graph and state fingerprint, are simulated once:
+        ## identical graph samples, graph independent data when fitting and nodes reached again at later decisions share their gains and resulting states
+        ## Identical graph samples only share their nodes with common random numbers, otherwise each sample is an independent rollout, see _graph_id
+        ## tolerance: at a new decision, if the observed data are within tolerance of the node reached by the chosen action in the previous tree,
+        ##            that node is promoted as the root and its explored subtree is reused, None to only reuse identical nodes
+        ### The table is only used at decisions where nodes can be shared, see _shared_nodes, other decisions do not hash their nodes
+        self._transpositions = {} if transpositions else None
+        self._tolerance = tolerance
+        self._promoted = {}
+        self._decision_roots = []
+        self._last_decision = None
+        self._graph_draw = 0
+
+        # Common random numbers
+        ## If True, the noise of the external and sensory states is drawn once per decision and shared by all branches and sampled graphs:
+        ## a frame is simulated with the same noise whatever the actions and graph, comparisons between actions are paired
+        self._common_random_numbers = common_random_numbers
+
+        # Estimator of the gain of each branch
+        ## 'simulation': branches are simulated with the noise of the external and sensory states, see _run_local_experiment, reference estimator
+        ## 'noise_free': each branch is simulated once along its noise free trajectory given the sampled graph, no noise is drawn
+        ##               The gain is the information gained from the mean observations, not the expected information gain over the predicted observations
+        ##               All branches are evaluated at once by the batch_rollout methods of the internal states, as batched rollouts,
+        ##               requires the same conditions and raises a ValueError otherwise
+        ### When the external state is realised the observations are the data whatever the estimator, both give the same values
+        self._estimator = estimator
+
+        # Frames at which action values are computed when fitting
+        ## 'every_frame': a tree search at every fitted frame
+        ## 'decision_points': a tree search only at decision points, i.e. onsets and changes of variable or value of the actions,
+        ##                    and every action_len + 1 frames within a segment, as action sampling replans every action_len frames
+        ##                    The log probability of the action at a decision point is that of the whole segment it starts,
+        ##                    the other frames of the segment have probability 1 and reuse the action values of the decision point
+        self._fit_schedule = fit_schedule
+        self._fit_segment = None # (flat action, first frame, last fitted frame) of the current segment
+        self._fit_action_values = None
+
+        # Intervention of each action as a (variable, value) row, nan for idleness
+        self._action_table = np.full((self._num_actions, 2), np.nan)
+        for i in range(self._num_actions - 1):
+            self._action_table[i, :] = self._remap_action(i)
+
 
     def _tree_search_action_sample(self, external_state, sensory_state, internal_state):  
         # If time to act, sample new action
@@ -364,22 +453,21 @@ class Treesearch_AS(Action_state):
                 return self._remap_action(np.random.choice(self._num_actions))
 
             # Compute action values
-            ## /!\ Deepcopies are important to not break the main state objects /!\
-            es_copy = deepcopy(external_state)
-            ss_copy = deepcopy(sensory_state)
-            is_copy = deepcopy(internal_state)
-            action_values = self._tree_search_action_values(es_copy, 
-                                                            ss_copy, 
-                                                            is_copy)
-
-            del es_copy
-            del ss_copy
-            del is_copy
+            ## /!\ States are explored in place, restoring the snapshots is important to not break the main state objects /!\
+            snapshots = self._snapshot_states(external_state, sensory_state, internal_state)
+            try:
+                action_values = self._tree_search_action_values(external_state, 
+                                                                sensory_state, 
+                                                                internal_state)
+            finally:
+                self._restore_states(snapshots, external_state, sensory_state, internal_state)
+
             # Sample a sequence of actions
             sampled_action = self._policy(action_values)
+            self._record_decision(sampled_action)
 
             # Update history
-            self._action_values[self._n] = action_values  
+            self._record(self._action_values, action_values)
 
             # Reset action_idx
             self._action_idx = 0
@@ -397,11 +485,26 @@ class Treesearch_AS(Action_state):
         # Flatten action
         flat_action = self._flatten_action(action)
 
+        # Within a segment, the action was chosen at its decision point
+        if self._fit_schedule == 'decision_points' and not self._decision_point(flat_action):
+            self._fit_segment = self._fit_segment[0:2] + (self._n,)
+
+            self._record(self._action_values, self._fit_action_values)
+            self._record(self._action_len_history, self._action_len)
+
+            return 0
+
         # Compute action values
-        ## /!\ Deepcopies are important to not break the main state objects /!\
-        action_values = self._tree_search_action_values(deepcopy(external_state), 
-                                                        deepcopy(sensory_state), 
-                                                        deepcopy(internal_state))
+        ## /!\ States are explored in place, restoring the snapshots is important to not break the main state objects /!\
+        snapshots = self._snapshot_states(external_state, sensory_state, internal_state)
+        try:
+            action_values = self._tree_search_action_values(external_state, 
+                                                            sensory_state, 
+                                                            internal_state)
+        finally:
+            self._restore_states(snapshots, external_state, sensory_state, internal_state)
+
+        self._record_decision(flat_action)
 
         # Compute policy params
         action_prob = self._pmf_policy(flat_action, action_values)
@@ -409,14 +512,29 @@ class Treesearch_AS(Action_state):
         # Log of probability of action
         action_log_prob = np.log(action_prob)
 
+        self._fit_segment = (flat_action, self._n, self._n)
+        self._fit_action_values = action_values
+
         # Update history
-        self._action_values[self._n] = action_values 
-        self._action_len_history[self._n] = self._action_len  
+        self._record(self._action_values, action_values)
+        self._record(self._action_len_history, self._action_len)
 
         # Return action remapped to the action (idx) to tuple (variable, value)
         return action_log_prob
         
 
+    # Segments are runs of the same action over consecutive fitted frames, a new trial or rolled back state starts a new segment
+    def _decision_point(self, flat_action):
+        if self._fit_segment is None:
+            return True
+
+        segment_action, first_frame, last_frame = self._fit_segment
+
+        return flat_action != segment_action \
+               or self._n != last_frame + 1 \
+               or self._n - first_frame >= self._action_len + 1
+
+
     def _tree_search_action_values(self, external_state, sensory_state, internal_state):
 
         # Logic for tree search based action values
@@ -445,45 +563,81 @@ class Treesearch_AS(Action_state):
             graphs_pseudoposterior = probs / probs.sum()
             iterations_C = self._C
 
-        for c in range(iterations_C):
-
-            external_state.causal_matrix = graphs[c]
-
-            # Variable for printing, sample has 
-            sample_print = external_state.causal_vector
-
-            #print('Compute action values, C=', c, 'Model n:', internal_state._n, 'Sampled graph:', sample_print)
-
-            # Build outcome tree
-            seqs_values_astree = self._tree_search_func(0, 
-                                                        external_state, 
-                                                        sensory_state,
-                                                        internal_state,
-                                                        self._run_local_experiment,
-                                                        *self._tree_search_func_args)
-
-            # Extract action values
-            leaves = jax.tree_leaves(seqs_values_astree)
-            leaves_table = np.array(leaves).reshape((int(len(leaves)/2), 2))
-            seqs_values_c, seqs = leaves_table[:, 0].astype(float), leaves_table[:, 1]
-
-            # Update action_value for time n
-            if c == 0:
-                if self._knowledge == 'posterior_weighted':
-                    seqs_values = graphs_pseudoposterior[c] * seqs_values_c
+        if self._common_random_numbers:
+            noise = np.random.standard_normal((external_state._N+1, self._K+1))
+            external_state.set_common_noise(noise[:, 0:self._K])
+            sensory_state.set_common_noise(noise[:, self._K])
+
+        # Common noise is reset whatever happens in the rollouts
+        try:
+            # Reuse of the nodes explored at previous decisions
+            tabled = False
+            if self._transpositions is not None:
+                self._promote_root(external_state, sensory_state, internal_state)
+                self._decision_roots = []
+                tabled = self._shared_nodes(graphs[0:iterations_C], external_state, sensory_state, internal_state)
+                graph_draws = self._graph_draws(graphs[0:iterations_C])
+            gain_update_rule = self._transposed_local_experiment if tabled else self._run_local_experiment
+
+            # All sampled graphs are explored at once by batched rollouts
+            if self._batched_rollouts(sensory_state, internal_state):
+                batched_seqs_values, batched_seqs = self._batched_seqs_values(graphs[0:iterations_C], external_state, sensory_state, internal_state)
+
+            for c in range(iterations_C):
+
+                if self._batched_rollouts(sensory_state, internal_state):
+                    seqs_values_c, seqs = batched_seqs_values[c], batched_seqs
                 else:
-                    seqs_values = seqs_values_c
+                    if self._executor == 'process':
+                        if c == 0:
+                            trees = self._concurrent_trees(graphs[0:iterations_C], external_state, sensory_state, internal_state)
+                        seqs_values_astree = trees[c]
+                    else:
+                        external_state.causal_matrix = graphs[c]
+
+                        # Variable for printing, sample has 
+                        sample_print = external_state.causal_vector
+
+                        #print('Compute action values, C=', c, 'Model n:', internal_state._n, 'Sampled graph:', sample_print)
+
+                        if tabled:
+                            self._graph_draw = graph_draws[c]
+                            self._decision_roots.append(self._node_key(external_state, sensory_state, internal_state))
+
+                        # Build outcome tree
+                        seqs_values_astree = self._tree_search_func(0, 
+                                                                    external_state, 
+                                                                    sensory_state,
+                                                                    internal_state,
+                                                                    gain_update_rule,
+                                                                    *self._tree_search_func_args)
+
+                    # Extract action values
+                    leaves = jax.tree_leaves(seqs_values_astree)
+                    leaves_table = np.array(leaves).reshape((int(len(leaves)/2), 2))
+                    seqs_values_c, seqs = leaves_table[:, 0].astype(float), leaves_table[:, 1]
+
+                # Update action_value for time n
+                if c == 0:
+                    if self._knowledge == 'posterior_weighted':
+                        seqs_values = graphs_pseudoposterior[c] * seqs_values_c
+                    else:
+                        seqs_values = seqs_values_c
                     
-                action_seqs = seqs
-            else:
-                if self._knowledge == 'posterior_weighted':
-                    seqs_values += graphs_pseudoposterior[c] * seqs_values_c
+                    action_seqs = seqs
                 else:
-                    seqs_values += 1/(c+1) * (seqs_values_c - seqs_values)
+                    if self._knowledge == 'posterior_weighted':
+                        seqs_values += graphs_pseudoposterior[c] * seqs_values_c
+                    else:
+                        seqs_values += 1/(c+1) * (seqs_values_c - seqs_values)
 
+        finally:
+            if self._common_random_numbers:
+                external_state.set_common_noise(None)
+                sensory_state.set_common_noise(None)
 
-        self._action_seqs_values[self._n] = seqs_values
-        self._action_seqs[self._n] = action_seqs  
+        self._record(self._action_seqs_values, seqs_values)
+        self._record(self._action_seqs, action_seqs)
 
         # Average over values
         action_values = self._average_over_sequences(seqs_values, seqs)
@@ -491,7 +645,241 @@ class Treesearch_AS(Action_state):
         return action_values
 
 
+    # Concurrent exploration of the trees of all graphs, see methods.executor_methods
+    ## One task per graph and root action, the root branches of each graph are put back together as a single tree
+    ## Worker processes receive the states serialised once for the whole decision
+    def _concurrent_trees(self, graphs, external_state, sensory_state, internal_state):
+        if self._executor_pool is None:
+            sample_space = (internal_state._sample_space, internal_state._indexed_space, internal_state._sample_space_as_mat)
+            self._executor_pool = make_executor(self._executor, self._workers, sample_space=sample_space)
+
+        payload = pack_payload(rollout_payload(self, external_state, sensory_state, internal_state, strip_sample_space=True))
+        decision = uuid.uuid4().hex
+
+        tasks = [(graph, i) for graph in graphs for i in range(self._num_actions)]
+        seeds = np.random.randint(2**32, size=len(tasks))
+        futures = [self._executor_pool.submit(tree_search_task, payload, graph, i, seed=seed, decision=decision) for (graph, i), seed in zip(tasks, seeds)]
+        root_branches = [future.result()[0] for future in futures]
+
+        return [root_branches[c*self._num_actions:(c+1)*self._num_actions] for c in range(len(graphs))]
+
+    # Shut down the pool made by the action state, pools given by the caller are left open
+    def close_executor(self):
+        if self._executor_pool is not None and self._owns_executor:
+            self._executor_pool.shutdown()
+            self._executor_pool = None
+
+
+    # Transpositions
+    # Update rule for the leaves values with a transposition table, same as _run_local_experiment
+    ## The table holds, for each node and action, the gain, the snapshots of the resulting states, the resulting node and its observations
+    def _transposed_local_experiment(self, action_idx, external_state, sensory_state, internal_state):
+        key = self._node_key(external_state, sensory_state, internal_state) + (action_idx,)
+
+        if key in self._transpositions:
+            gain, snapshots, _, _ = self._transpositions[key]
+            self._restore_states(snapshots, external_state, sensory_state, internal_state)
+        else:
+            gain = self._run_local_experiment(action_idx, external_state, sensory_state, internal_state)[0]
+            self._transpositions[key] = (gain, 
+                                         self._snapshot_states(external_state, sensory_state, internal_state), 
+                                         self._node_key(external_state, sensory_state, internal_state), 
+                                         sensory_state.s.copy())
+
+        return (gain, external_state, sensory_state, internal_state)
+
+    # True if the trees of this decision can share nodes, between themselves or with the nodes kept from previous decisions
+    ## Trees share nodes when the data is realised (graph independent) or when graphs are sampled more than once with common random numbers,
+    ## kept nodes are only reachable if one of the roots is among them, the table is cleared otherwise
+    def _shared_nodes(self, graphs, external_state, sensory_state, internal_state):
+        if len(graphs) > 1 and external_state._realised:
+            return True
+        if self._common_random_numbers and np.unique(np.array(graphs).reshape((len(graphs), -1)), axis=0).shape[0] < len(graphs):
+            return True
+
+        if self._transpositions:
+            fingerprint = self._states_fingerprint(external_state, sensory_state, internal_state)
+            nodes = {key[0:3] for key in self._transpositions}
+            for graph, draw in zip(graphs, self._graph_draws(graphs)):
+                node = (internal_state._n, self._graph_id(external_state, graph, draw))
+                if node + (self._promoted.get(node + (fingerprint,), fingerprint),) in nodes:
+                    return True
+
+        self._transpositions.clear()
+        self._promoted.clear()
+        return False
+
+    # Node of the tree: (frame, graph, fingerprint of the states)
+    ## The graph does not matter when the external state is realised, all graphs then share their nodes
+    ## The fingerprint identifies the path to the node, nodes reached by different action sequences with the same states are merged
+    def _node_key(self, external_state, sensory_state, internal_state):
+        graph_id = self._graph_id(external_state, external_state.causal_matrix, self._graph_draw)
+        fingerprint = self._states_fingerprint(external_state, sensory_state, internal_state)
+
+        node = (internal_state._n, graph_id)
+        return node + (self._promoted.get(node + (fingerprint,), fingerprint),)
+
+    # Graph part of the node keys
+    ## Without common random numbers, the draw (i-th sample of the graph at this decision) separates repeated samples,
+    ## averaging over samples then combines independent rollouts
+    def _graph_id(self, external_state, graph, draw=0):
+        if external_state._realised:
+            return None
+        elif self._common_random_numbers:
+            return graph.tobytes()
+        else:
+            return (graph.tobytes(), draw)
+
+    # Number of earlier samples of the same graph, for each sampled graph
+    def _graph_draws(self, graphs):
+        counts = {}
+        draws = []
+        for graph in graphs:
+            graph_bytes = np.asarray(graph).tobytes()
+            draws.append(counts.get(graph_bytes, 0))
+            counts[graph_bytes] = draws[-1] + 1
+        return draws
+
+    def _states_fingerprint(self, external_state, sensory_state, internal_state):
+        digest = hashlib.blake2b(internal_state.fingerprint(), digest_size=16)
+        digest.update(sensory_state.s.tobytes())
+        if sensory_state.s_alt is not None:
+            digest.update(sensory_state.s_alt.tobytes())
+        if not external_state._realised:
+            digest.update(external_state.x.tobytes())
+
+        return digest.digest()
+
+    def _record_decision(self, action_idx):
+        if self._transpositions is not None:
+            self._last_decision = (self._decision_roots, action_idx)
+
+    # Promote the nodes reached by the last chosen action if the observed data are within tolerance, and drop unreachable nodes
+    def _promote_root(self, external_state, sensory_state, internal_state):
+        n = internal_state._n
+
+        # New trial or rolled back states, nodes of the table are not valid anymore
+        if self._last_decision and self._last_decision[0] and self._last_decision[0][0][0] > n:
+            self._transpositions.clear()
+            self._promoted.clear()
+            self._last_decision = None
+
+        if self._tolerance is not None and self._last_decision:
+            fingerprint = self._states_fingerprint(external_state, sensory_state, internal_state)
+            roots, action_idx = self._last_decision
+            for root in roots:
+                if root + (action_idx,) not in self._transpositions:
+                    continue
+                _, _, child, child_obs = self._transpositions[root + (action_idx,)]
+                if child[0] == n and child[2] != fingerprint and np.max(np.abs(child_obs - sensory_state.s)) <= self._tolerance:
+                    # Keyed by the fingerprint of the observed states, looked up in _node_key
+                    self._promoted[child[0:2] + (fingerprint,)] = child[2]
+
+        for key in [key for key in self._transpositions if key[0] < n]:
+            del self._transpositions[key]
+        for key in [key for key in self._promoted if key[0] < n]:
+            del self._promoted[key]
+
+
+    # Batched rollouts
+    def _batched_rollouts(self, sensory_state, internal_state):
+        batchable = self._batched_depth is not None \
+                    and self._gain_type == 'expected_information_gained' \
+                    and sensory_state.supports_batched_rollouts \
+                    and internal_state.supports_batched_rollouts
+        if self._estimator == 'noise_free' and not batchable:
+            raise ValueError('The noise free estimator requires batched rollouts: fixed depth trees, expected information gained and batch capable states')
+        return (self._rollouts == 'batched' or self._estimator == 'noise_free') and batchable
+
+    # Values of all action sequences of a fixed depth tree, for all graphs at once
+    ## The tree is expanded breadth wise: at each level every branch is split into one branch per action,
+    ## the external, sensory and internal states of all branches are then simulated in lockstep along a leading branch axis
+    ## Branches are ordered graph first then depth first, i.e. as the leaves of the trees built by the sequential tree search functions
+    ## States are not modified: external trajectories are simulated by a batch network (or read from the data when realised),
+    ## internal states update copies of their posterior, see the batch_rollout methods of the internal states
+    ## With the noise free estimator, branches follow their noise free trajectories and observations
+    ## Returns the (C, num_actions**depth) values of the sequences for each graph and the sequences
+    def _batched_seqs_values(self, graphs, external_state, sensory_state, internal_state):
+        noise_free = self._estimator == 'noise_free'
+        graphs = np.array(graphs)
+        C = graphs.shape[0]
+        graph_idx = np.arange(C)
+        x = np.tile(external_state.x, (C, 1))
+        rollout_state = internal_state.rollout_state()
+        entropy = np.repeat(internal_state.batch_entropy(rollout_state), C)
+        rollout_state = {name: np.repeat(value, C, axis=0) for name, value in rollout_state.items()}
+        seqs_values = np.zeros(C)
+        seqs = [''] * C
+
+        n = internal_state._n
+        for depth in range(self._batched_depth):
+            # Split every branch into one branch per action
+            graph_idx = np.repeat(graph_idx, self._num_actions)
+            x = np.repeat(x, self._num_actions, axis=0)
+            rollout_state = {name: np.repeat(value, self._num_actions, axis=0) for name, value in rollout_state.items()}
+            entropy = np.repeat(entropy, self._num_actions)
+            seqs_values = np.repeat(seqs_values, self._num_actions)
+            actions = np.tile(np.arange(self._num_actions), len(seqs))
+            seqs = [seq + ',' + str(i) if seq else str(i) for seq in seqs for i in range(self._num_actions)]
+
+            # Same number of frames as _run_local_experiment
+            if n + self._action_len + 1 >= internal_state._N:
+                T = int(internal_state._N - n)
+            else:
+                T = int(self._action_len + 1)
+
+            if T > 0:
+                interventions = self._action_table[actions]
+                X = self._batch_trajectories(external_state, graphs, graph_idx, x, interventions, n, T, noise_free=noise_free)
+                x = X[:, -1, :]
+
+                observations = sensory_state.batch_observations(X, frames=np.arange(n+1, n+T+1), noise_free=noise_free)
+                rollout_state = internal_state.batch_rollout(rollout_state, observations, interventions[:, 0])
+
+                posterior_entropy = internal_state.batch_entropy(rollout_state)
+                seqs_values += entropy - posterior_entropy
+                entropy = posterior_entropy
+
+            n += T
+
+        return seqs_values.reshape((C, -1)), np.array(seqs[0:len(seqs) // C])
+
+    # External trajectories of a batch of branches over T frames from frame n, (B, T, K)
+    ## noise_free: noise free trajectories, the mean of each frame given the previous one
+    def _batch_trajectories(self, external_state, graphs, graph_idx, x, interventions, n, T, noise_free=False):
+        B = graph_idx.size
+        if external_state._realised:
+            # The data already exists, all branches observe it whatever the interventions
+            return np.tile(external_state._X[n+1:n+T+1, :], (B, 1, 1))
+
+        batch_network = Batch_OU_Network(T, self._K, B, external_state._dt, 
+                                         theta=external_state.theta, 
+                                         sigma=external_state.sigma, 
+                                         ground_truth=graphs[graph_idx], 
+                                         init_state=x, 
+                                         range_values=external_state._range)
+        if noise_free:
+            noise = np.zeros((T, self._K))
+        elif external_state._common_noise is not None:
+            noise = external_state._common_noise[n+1:n+T+1]
+        else:
+            noise = None
+        batch_network.run(iter=T, interventions=interventions, noise=noise)
+
+        return batch_network.data[:, 1:, :]
+
+
     # Background methods
+    # Snapshots of the external, sensory and internal states to come back to after exploring a branch, see the snapshot methods of the states
+    ## Cost scales with the length of the explored branches, not with the length of the trial
+    def _snapshot_states(self, external_state, sensory_state, internal_state):
+        return external_state.snapshot(), sensory_state.snapshot(), internal_state.snapshot()
+
+    def _restore_states(self, snapshots, external_state, sensory_state, internal_state):
+        external_state.restore(snapshots[0])
+        sensory_state.restore(snapshots[1])
+        internal_state.restore(snapshots[2])
+
     # Return None, for idleness or a tuple (variable index, variable value) otherwise
     def _remap_action(self, action):
         if action // self._poss_actions.size > self._K - 1:
@@ -569,8 +957,11 @@ class Treesearch_AS(Action_state):
 
 
 class Experience_AS(Action_state):
-    def __init__(self, N, K, behaviour, epsilon, possible_actions, policy_funcs, experience_gained_func):
-        super().__init__(N, K, behaviour, epsilon, self._experience_action_sample, self._experience_action_fit)
+    # Information gained is measured by rolling back the internal state to the start of the action
+    rolls_back_internal_state = True
+
+    def __init__(self, N, K, behaviour, epsilon, possible_actions, policy_funcs, experience_gained_func, retention='full'):
+        super().__init__(N, K, behaviour, epsilon, self._experience_action_sample, self._experience_action_fit, retention=retention)
 
         # Possible values for actions
         self._poss_actions = possible_actions
@@ -690,7 +1081,7 @@ class Experience_AS(Action_state):
                 sampled_action = (variable, sign*self._poss_actions[sampled_action_idx])
 
                 # Update action value history and local params
-                self._action_values[self._n] = action_values  
+                self._record(self._action_values, action_values)
 
 
             # Convert length and obs to datapoint
@@ -758,7 +1149,7 @@ class Experience_AS(Action_state):
                 effective_previous_action = self._constrain_action((self._previous_action[0], self._mean_value_taken))
                 # Changing action, compute action values for previous action
                 action_values = self._experience_gained_func(effective_previous_action, self._action_len, self._obs_len, sensory_state, internal_state)
-                self._action_values[self._n] = action_values 
+                self._record(self._action_values, action_values)
 
                 # Fit previous action 
                 action_idx = self._flatten_action(effective_previous_action)
@@ -767,7 +1158,7 @@ class Experience_AS(Action_state):
 
                 # Get action probability from policy
                 action_taken = (action_idx, action_len_sec, obs_len_sec)
-                action_prob = self._pmf_policy(action_taken, self._action_values[self._n])
+                action_prob = self._pmf_policy(action_taken, action_values)
 
                 # Previous action becomes current action, reset counters of length
                 # We start new action here
@@ -0,0 +1,98 @@
+from classes.action_states.action_state import Treesearch_AS
+import numpy as np
+import time
+
+# Anytime Monte Carlo tree search
+## UCT over the same actions and gains as the other tree searches, the tree is grown until a per decision budget runs out
+## budget_type: 'nodes', budget is the number of simulated branches (calls to the gain update rule) per decision
+##              'time', budget is the wall clock time in seconds per decision
+## The budget is shared equally between the sampled graphs, action values are the mean return of each root action when it runs out
+class Anytime_MCTS_TSAS(Treesearch_AS):
+    def __init__(self, N, K, behaviour, epsilon, possible_actions, action_len, policy_funcs, C, knowledge, gain_type, depth, budget, budget_type='nodes', exploration=np.sqrt(2), resource_rational_parameter=0, common_random_numbers=False, estimator='simulation', fit_schedule='every_frame', retention='full'):
+        self._depth = depth
+        self._budget = budget
+        self._budget_type = budget_type
+        self._exploration = exploration
+        super().__init__(N, K, behaviour, epsilon, possible_actions, action_len, policy_funcs, C, knowledge, gain_type, self._build_tree_mcts, tree_search_func_args=[depth, budget, budget_type, exploration], resource_rational_parameter=resource_rational_parameter, common_random_numbers=common_random_numbers, estimator=estimator, fit_schedule=fit_schedule, retention=retention)
+
+        # Number of graphs explored per decision, see Treesearch_AS._tree_search_action_values
+        self._num_graphs = 1 if type(knowledge) == np.ndarray or knowledge == 'perfect' else C
+
+        self._decision_start = None
+        self._searched_graphs = 0
+
+
+    def _tree_search_action_values(self, external_state, sensory_state, internal_state):
+        self._decision_start = time.perf_counter()
+        self._searched_graphs = 0
+
+        return super()._tree_search_action_values(external_state, sensory_state, internal_state)
+
+
+    # Each iteration selects actions with UCB1 down the tree from the root, simulating each of them,
+    # until an action not taken yet at a node is reached (expansion) or the depth is reached, the path gains are then backed up
+    ## Transitions are stochastic, paths are simulated again at each iteration from the root (open loop)
+    def _build_tree_mcts(self, gain, external_state, sensory_state, internal_state, gain_update_rule, depth, budget, budget_type, exploration):
+        # Share of the budget of this graph
+        self._searched_graphs += 1
+        if budget_type == 'time':
+            deadline = self._decision_start + budget * self._searched_graphs / self._num_graphs
+        else:
+            node_budget = int(np.ceil(budget / self._num_graphs))
+
+        root = self._new_node()
+        snapshots = self._snapshot_states(external_state, sensory_state, internal_state)
+        num_simulated = 0
+        while True:
+            if budget_type == 'time' and time.perf_counter() >= deadline:
+                break
+            elif budget_type != 'time' and num_simulated >= node_budget:
+                break
+
+            # Selection and expansion
+            node = root
+            path = []
+            for level in range(depth):
+                action = self._uct_action(node, exploration)
+                new_gain, external_state, sensory_state, internal_state = gain_update_rule(action,
+                                                                                           external_state,
+                                                                                           sensory_state,
+                                                                                           internal_state)
+                num_simulated += 1
+                path.append((node, action, new_gain))
+
+                if action not in node['children']:
+                    node['children'][action] = self._new_node()
+                    break
+                node = node['children'][action]
+
+            # Backup, the return of an action is the sum of the gains from there on
+            path_return = 0
+            for node, action, new_gain in reversed(path):
+                path_return += new_gain
+                node['visits'][action] += 1
+                node['returns'][action] += path_return
+
+            ## Roll back for next iteration
+            self._restore_states(snapshots, external_state, sensory_state, internal_state)
+
+        # Best estimates, actions not visited before the budget ran out have no expected gain
+        visits = root['visits']
+        values = np.zeros(self._num_actions)
+        values[visits > 0] = root['returns'][visits > 0] / visits[visits > 0]
+
+        return [(gain + values[i], str(i)) for i in range(self._num_actions)]
+
+
+    def _new_node(self):
+        return {'visits': np.zeros(self._num_actions), 'returns': np.zeros(self._num_actions), 'children': {}}
+
+    # UCB1, actions not taken yet at the node are tried first in random order
+    def _uct_action(self, node, exploration):
+        visits = node['visits']
+        untried = np.where(visits == 0)[0]
+        if untried.size > 0:
+            return np.random.choice(untried)
+
+        ucb = node['returns'] / visits + exploration * np.sqrt(np.log(visits.sum()) / visits)
+        return np.argmax(ucb)
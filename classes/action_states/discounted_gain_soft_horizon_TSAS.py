@@ -1,28 +1,33 @@
 from classes.action_states.action_state import Treesearch_AS
-from copy import deepcopy
 
 # Discounted gain soft horizon
 class Discounted_gain_soft_horizon_TSAS(Treesearch_AS):
-    def __init__(self, N, K, behaviour, epsilon, possible_actions, action_len, policy_funcs, C, knowledge, gain_type, discount, horizon, resource_rational_parameter=0):
+    def __init__(self, N, K, behaviour, epsilon, possible_actions, action_len, policy_funcs, C, knowledge, gain_type, discount, horizon, resource_rational_parameter=0, executor='serial', workers=None, transpositions=False, tolerance=None, common_random_numbers=False, estimator='simulation', fit_schedule='every_frame', retention='full'):
 
         self._discount = discount 
         self._horizon = horizon
 
-        super().__init__(N, K, behaviour, epsilon, possible_actions, action_len, policy_funcs, C, knowledge, gain_type, self._build_tree_dgsh, tree_search_func_args=[discount, horizon], resource_rational_parameter=resource_rational_parameter)
+        super().__init__(N, K, behaviour, epsilon, possible_actions, action_len, policy_funcs, C, knowledge, gain_type, self._build_tree_dgsh, tree_search_func_args=[discount, horizon], resource_rational_parameter=resource_rational_parameter, executor=executor, workers=workers, transpositions=transpositions, tolerance=tolerance, common_random_numbers=common_random_numbers, estimator=estimator, fit_schedule=fit_schedule, retention=retention)
 
 
-    def _build_tree_dgsh(self, gain, external_state, sensory_state, internal_state, gain_update_rule, discount, horizon, depth=0, seq=''):
+    def _build_tree_dgsh(self, gain, external_state, sensory_state, internal_state, gain_update_rule, discount, horizon, depth=0, seq='', root_actions=None):
         if depth > 0 and gain * discount**depth < horizon:
             return gain, seq
         else:
             new_tree = []
-            for i in range(self._num_actions):
+            snapshots = self._snapshot_states(external_state, sensory_state, internal_state)
+            # Root actions can be restricted, e.g. to explore the subtree of each root action in a different task
+            actions = range(self._num_actions) if root_actions is None else root_actions
+            for i in actions:
                 new_gain, external_state_out, sensory_state_out, internal_state_out = gain_update_rule(i, 
-                                                                                                       deepcopy(external_state),  
-                                                                                                       deepcopy(sensory_state), 
-                                                                                                       deepcopy(internal_state))
+                                                                                                       external_state,  
+                                                                                                       sensory_state, 
+                                                                                                       internal_state)
                 acc_gain = gain + new_gain
 
+                # Deeper levels are explored from the states of this level
+                self._restore_states(snapshots, external_state, sensory_state, internal_state)
+
                 # Compile sequence
                 if not seq:
                     new_seq = str(i)
@@ -33,8 +38,6 @@ class Discounted_gain_soft_horizon_TSAS(Treesearch_AS):
                 new_tree.append(new_leaf)
 
                 # Roll back for next branch exploration
-                #internal_state.rollback(self._action_len)
-                #sensory_state.rollback(self._action_len)
-                #external_state.reset(self._action_len)
+                self._restore_states(snapshots, external_state, sensory_state, internal_state)
 
             return new_tree
\ No newline at end of file
@@ -2,8 +2,8 @@ import numpy as np
 from classes.action_states.action_state import Experience_AS
 
 class Experience_discrete_3D_AS(Experience_AS):
-    def __init__(self, N, K, behaviour, epsilon, possible_actions, policy_funcs, time_unit, max_acting_time, max_obs_time, experience_measure, prior_action_values, discount=0.9):        
-        super().__init__(N, K, behaviour, epsilon, possible_actions, policy_funcs, self._action_values_update)
+    def __init__(self, N, K, behaviour, epsilon, possible_actions, policy_funcs, time_unit, max_acting_time, max_obs_time, experience_measure, prior_action_values, discount=0.9, retention='full'):        
+        super().__init__(N, K, behaviour, epsilon, possible_actions, policy_funcs, self._action_values_update, retention=retention)
 
         # Pick experience gained function
         if experience_measure == 'information':
@@ -1,24 +1,26 @@
 from classes.action_states.action_state import Treesearch_AS
 from classes.action_states.action_state import Pseudo_AS
-from copy import deepcopy
 
 # Undiscounted gain hard horizon
 class Variational_Actor_TSAS(Treesearch_AS):
-    def __init__(self, N, K, behaviour, epsilon, possible_actions, action_len, policy_funcs, C, knowledge, gain_type, depth, resource_rational_parameter=0):
+    def __init__(self, N, K, behaviour, epsilon, possible_actions, action_len, policy_funcs, C, knowledge, gain_type, depth, resource_rational_parameter=0, executor='serial', workers=None, transpositions=False, tolerance=None, common_random_numbers=False, estimator='simulation', fit_schedule='every_frame', retention='full'):
         self._depth = depth
-        super().__init__(N, K, behaviour, epsilon, possible_actions, action_len, policy_funcs, C, knowledge, gain_type, self._build_tree_ughh, tree_search_func_args=[self._depth],  resource_rational_parameter=resource_rational_parameter)
+        super().__init__(N, K, behaviour, epsilon, possible_actions, action_len, policy_funcs, C, knowledge, gain_type, self._build_tree_ughh, tree_search_func_args=[self._depth],  resource_rational_parameter=resource_rational_parameter, executor=executor, workers=workers, transpositions=transpositions, tolerance=tolerance, common_random_numbers=common_random_numbers, estimator=estimator, fit_schedule=fit_schedule, retention=retention)
 
     
-    def _build_tree_ughh(self, gain, external_state, sensory_state, internal_state, gain_update_rule, depth, seq=''):
+    def _build_tree_ughh(self, gain, external_state, sensory_state, internal_state, gain_update_rule, depth, seq='', root_actions=None):
         if depth == 0:
             return gain, seq
         else:
             new_tree = []
-            for i in range(self._num_actions):
+            snapshots = self._snapshot_states(external_state, sensory_state, internal_state)
+            # Root actions can be restricted, e.g. to explore the subtree of each root action in a different task
+            actions = range(self._num_actions) if root_actions is None else root_actions
+            for i in actions:
                 new_gain, external_state_out, sensory_state_out, internal_state_out = gain_update_rule(i, 
-                                                                                                       deepcopy(external_state),  
-                                                                                                       deepcopy(sensory_state), 
-                                                                                                       deepcopy(internal_state))
+                                                                                                       external_state,  
+                                                                                                       sensory_state, 
+                                                                                                       internal_state)
                 acc_gain = gain + new_gain
 
                 a = self._remap_action(i)
@@ -32,9 +34,7 @@ class Variational_Actor_TSAS(Treesearch_AS):
                 new_tree.append(new_leaf)
 
                 ## Roll back for next branch exploration
-                #internal_state.rollback(self._action_len + 1)
-                #sensory_state.rollback(self._action_len + 1)
-                #external_state.reset(self._action_len + 1)
+                self._restore_states(snapshots, external_state, sensory_state, internal_state)
 
             return new_tree
 
@@ -96,6 +96,32 @@ class Agent():
 
         self._n += 1
 
+    ## Observe only, the internal state then learns from the whole trial with replay_learn
+    def observe(self, external_state):
+        self._sensory_state.observe(external_state, self._internal_state)
+
+    ## Learn fit from a whole realised trial at once, see Internal_state.replays_trials
+    ### interventions: (T,) variable intervened upon at each update, nan when idle
+    ### action_log_probs: (T,) log probability of the action fitted after each update, already added to the log likelihood
+    ### Same log likelihood and history as T calls to fit_learn, each followed by fit_action
+    def replay_learn(self, interventions, action_log_probs):
+        T = interventions.size
+        n = self._internal_state._n
+        observations = self._sensory_state._observations[n:n+T+1, :]
+        observations_alt = self._sensory_state._observations_alt[n:n+T+1, :]
+
+        judgement_log_probs = self._internal_state.replay_trial(observations, observations_alt, interventions, self._action_state._A)
+        if judgement_log_probs is None:
+            judgement_log_probs = np.zeros(T)
+
+        # History entry after each update holds the judgements up to it and the actions fitted before it
+        log_likelihood_start = self._log_likelihood - np.sum(action_log_probs)
+        actions_before = np.concatenate(([0], np.cumsum(action_log_probs)[:-1]))
+        self._log_likelihood_history[self._n:self._n+T] = log_likelihood_start + np.cumsum(judgement_log_probs) + actions_before
+
+        self._log_likelihood += np.sum(judgement_log_probs)
+        self._n += T
+
     ## Act by sampling an action
     def act(self, external_state):
         # Sample new action
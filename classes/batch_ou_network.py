@@ -0,0 +1,204 @@
+import numpy as np
+
+
+# Batch of independent OU networks advanced in lockstep
+## Holds B realisations in a single (B, N+1, K) tensor, each with its own ground truth, theta, sigma and bounds
+## One update is a single batched matrix multiply and a single noise draw for all networks
+class Batch_OU_Network():
+    def __init__(self, N, K, B, dt, theta=0.5,
+                                    sigma=3,
+                                    ground_truth=None,
+                                    init_state=None,
+                                    range_values=(-100, 100)):
+        # Parameters
+        self._N = N         # End of trial, maximum datapoints
+        self._n = 0         # Current index in trial, shared by all networks
+        self._K = K
+        self._B = B         # Number of networks in the batch
+        self._dt = dt
+
+        # Per network parameters, scalars are broadcast to the whole batch
+        self._theta = self._per_batch(theta)
+        self._sig = self._per_batch(sigma)
+        self._range = np.tile(np.array(range_values, dtype=float), (self._B, 1)) if np.ndim(range_values) == 1 else np.array(range_values, dtype=float)
+
+        if type(ground_truth) == np.ndarray:
+            self.set_ground_truth(ground_truth)
+        else:
+            self._G = None
+
+        # State initialisation
+        self._mus = np.zeros((self._B, self._N+1, self._K))
+
+        self._X = np.zeros((self._B, self._N+1, self._K))
+        # If state is non initial, set the first row of each network to be the initial state
+        if type(init_state) == np.ndarray:
+            self._X[:, 0, :] = init_state
+        # Initialise array of empty interventions
+        self._I = np.empty((self._B, self._N+1))
+        self._I[:] = np.nan
+
+
+    ## noise: optional (iter, K) standard normal draws shared by all networks, row i is used at the i-th iteration (common random numbers)
+    def run(self, iter=1, interventions=None, reset=False, noise=None):
+        if reset:
+            self.reset()
+
+        if self._n > self._N:
+            print('Iterations maxed out')
+            return
+        elif iter > self._N - self._n:
+            r_iter = self._N - self._n
+        else:
+            r_iter = iter
+
+        # Interventions can be None, a tuple shared by all networks,
+        # a (B, 2) array of (variable, value) rows with nan for idle networks, or a (iter, B, 2) array
+        inter_array = self._interventions_as_array(interventions, r_iter)
+
+        # Run iterations
+        for i in range(r_iter):
+            self.update(inter_array[i], noise=None if noise is None else noise[i])
+
+        # Return the generated values
+        return self._X[:, self._n-r_iter+1:self._n+1, :]
+
+
+    def update(self, intervention=None, noise=None):
+        X = self._X[:, self._n, :]
+
+        # Compute attractor for all networks at once
+        self_attractor = -1 * X * (np.abs(X) / self._range.max(axis=1, keepdims=True))
+        causal_attractor = np.matmul(X[:, np.newaxis, :], self._G)[:, 0, :]
+        att = self_attractor + causal_attractor
+
+        # Store mus
+        mus = X + self._theta * self._dt * (att - X)
+        self._mus[:, self._n, :] = mus
+
+        # Update using a single draw from a standard normal for the whole batch
+        if noise is None:
+            noise = np.random.normal(size=(self._B, self._K))
+        X_new = mus + self._sig * np.sqrt(self._dt) * noise
+
+        # If intervention, set value irrespective of causal matrix
+        if type(intervention) == np.ndarray:
+            acting = ~np.isnan(intervention[:, 0])
+            if acting.sum() > 0:
+                inter_var = intervention[acting, 0].astype(int)
+                X_new[acting, inter_var] = intervention[acting, 1]
+                self._I[acting, self._n+1] = inter_var
+
+        # Bound values
+        self._X[:, self._n+1, :] = np.clip(X_new, self._range[:, 0:1], self._range[:, 1:2])
+
+        # Increment index
+        self._n += 1
+
+
+    # Load data
+    ## ground_truth: a (K, K) causal matrix or a (K*(K-1),) link vector shared by all networks,
+    ## or one per network as (B, K, K) matrices or (B, K*(K-1)) link vectors
+    ## A (K, K) array is always a shared matrix: with K=2 and B=2, per network link vectors must be given as matrices
+    def set_ground_truth(self, ground_truth):
+        if ground_truth.ndim == 3 or ground_truth.shape == (self._K, self._K):
+            G = ground_truth
+        else:
+            G = self._causality_matrix(ground_truth, fill_diag=1)
+
+        if G.ndim == 2:
+            G = np.tile(G, (self._B, 1, 1))
+        elif G.shape[0] != self._B:
+            raise ValueError(f'Ground truth given for {G.shape[0]} networks, the batch has {self._B}')
+
+        self._G = G
+
+
+    def reset(self, init_state=None):
+        self._n = 0
+
+        self._X[:, 1:, :] = 0 # Reset data except for the initial state
+        self._mus[:] = 0
+        self._I[:] = np.nan
+
+        if type(init_state) == np.ndarray:
+            self._X[:, 0, :] = init_state
+
+
+    # Extract a single network realisation
+    def network_data(self, b):
+        return self._X[b, 0:self._n+1, :]
+
+
+    # Properties
+    @property
+    def N(self):
+        return self._N
+
+    @property
+    def K(self):
+        return self._K
+
+    @property
+    def B(self):
+        return self._B
+
+    @property
+    def causal_vector(self):
+        return self._G[:, ~np.eye(self._K, dtype=bool)]
+
+    @property
+    def causal_matrix(self):
+        return self._G
+
+    @causal_matrix.setter
+    def causal_matrix(self, model):
+        self.set_ground_truth(model)
+
+    @property
+    def sigma(self):
+        return self._sig[:, 0]
+
+    @property
+    def theta(self):
+        return self._theta[:, 0]
+
+    @property
+    def data(self):
+        return self._X[:, 0:self._n+1, :]
+
+    @property
+    def interventions(self):
+        return self._I[:, 0:self._n+1]
+
+    @property
+    def x(self):
+        return self._X[:, self._n, :]
+
+    @property
+    def x_prev(self):
+        return self._X[:, self._n-1, :]
+
+
+    # Internal methods
+    def _per_batch(self, param):
+        return (np.ones(self._B) * param).reshape((self._B, 1))
+
+    def _interventions_as_array(self, interventions, r_iter):
+        inter_array = np.empty((r_iter, self._B, 2))
+        inter_array[:] = np.nan
+
+        if isinstance(interventions, tuple):
+            inter_array[:, :, 0] = interventions[0]
+            inter_array[:, :, 1] = interventions[1]
+        elif type(interventions) == np.ndarray and len(interventions.shape) == 2:
+            inter_array[:] = interventions
+        elif type(interventions) == np.ndarray:
+            inter_array[:] = interventions[0:r_iter]
+
+        return inter_array
+
+    def _causality_matrix(self, link_vec, fill_diag=1):
+        causal_mat = fill_diag * np.ones(link_vec.shape[:-1] + (self._K, self._K))
+        causal_mat[..., ~np.eye(self._K, dtype=bool)] = link_vec
+        return causal_mat
@@ -22,7 +22,10 @@ class Experiment():
             self._entropy_history = np.zeros((self._iter, agent._multi_is, self.agent._N))
 
 
-    def fit(self, verbose=False, reset=False):
+    # Fit a realised trial
+    ## replay: if True, the internal state learns from the whole trial at once when it can (see _can_replay), stepping otherwise
+    ##         Same posteriors and log likelihood as stepping
+    def fit(self, verbose=False, reset=False, replay=False):
         if not self.external_state._realised and self.agent.realised:
             print('Cannot fit, no loaded data, use Experiment.run instead. Exiting...')
             return
@@ -34,7 +37,11 @@ class Experiment():
             self.external_state.reset()
         self._n = 0
 
-        for n in range(self._N):
+        if replay and self._can_replay():
+            self._fit_replay()
+            n = self._N - 1
+
+        for n in range(self._n, self._N):
             # Collect action and action to fit
             a = self.agent.a
 
@@ -53,6 +60,8 @@ class Experiment():
 
             self._n += 1
 
+        self._close_executor()
+
         if verbose:
             print('Iter:', n, 'Current MAP:', self.agent.MAP, 'Current LL:', self.agent.log_likelihood, 'Entropy:', self.agent.posterior_entropy)
             if self.agent.fitting_judgement:
@@ -66,7 +75,10 @@ class Experiment():
                 final_distance = self.agent.MAP
                 print('Final distance:', np.sum((self.agent.final_judgement - final_distance)**2)**(-1/2))
 
-    def run(self, verbose=False, reset=False):     
+    # Simulate trials
+    ## open_loop: if True, observers following an action plan get the trajectory generated at once, see _generate_open_loop
+    ##            Noise is then drawn from a generator seeded by the global one, seeded runs differ from stepping
+    def run(self, verbose=False, reset=False, open_loop=False):     
         self._i = 0
 
         for i in range(self._iter):
@@ -80,23 +92,32 @@ class Experiment():
 
             self._n = 0
 
-            for n in range(self._N):
-                a = self.agent.a
-                x = self.external_state.run(interventions=a)
-                self.agent.learn(self.external_state)
-            
-                _ = self.agent.act(self.external_state)
-
-                self._n += 1
+            # Observers following an action plan do not change the environment: the trajectory can be generated at once
+            generated = open_loop and self._can_run_open_loop()
+            if generated:
+                self._generate_open_loop()
 
+            try:
+                for n in range(self._N):
+                    a = self.agent.a
+                    x = self.external_state.run(interventions=a)
+                    self.agent.learn(self.external_state)
                 
+                    _ = self.agent.act(self.external_state)
+
+                    self._n += 1
 
-                if n % 10 == 0 and verbose:
-                    print('Iter:', n)
-                    print('Current MAP:', self.agent.MAP, 'Entropy:', self.agent.posterior_entropy_unsmoothed)
-                    #print('Current posterior:')
-                    #print(np.around(agent.model.posterior_links, 2))
+                    
 
+                    if n % 10 == 0 and verbose:
+                        print('Iter:', n)
+                        print('Current MAP:', self.agent.MAP, 'Entropy:', self.agent.posterior_entropy_unsmoothed)
+                        #print('Current posterior:')
+                        #print(np.around(agent.model.posterior_links, 2))
+            finally:
+                # The network generates data again for the next realisation
+                if generated:
+                    self.external_state._realised = False
 
             if verbose:
                 print('Iter:', n)
@@ -105,6 +126,68 @@ class Experiment():
 
             self._i += 1
 
+        self._close_executor()
+
+    # Trajectories can be generated open loop when the actions are known in advance, i.e. an observer following an action plan
+    def _can_run_open_loop(self):
+        return hasattr(self.external_state, 'run_open_loop') \
+               and not self.external_state._realised \
+               and self.external_state._common_noise is None \
+               and self.agent.action_state._realised \
+               and self.agent.action_state._behaviour == 'obs'
+
+    # Generate the rest of the trial from the action plan, see OU_Network.run_open_loop
+    ## The action applied to frame n+1 is the one sampled at frame n, the first frame uses the current action
+    ## The network is then stepped through as realised data: run only records the interventions
+    ## The noise seed is drawn from the global generator so that seeded simulations stay reproducible
+    def _generate_open_loop(self):
+        a_s = self.agent.action_state
+        start = self.external_state._n
+
+        actions = np.full(self._N - start, np.nan)
+        values = np.zeros((self._N - start, self.external_state.K))
+        a = self.agent.a
+        if isinstance(a, tuple):
+            actions[0] = a[0]
+            values[0, a[0]] = a[1]
+        actions[1:] = a_s._A[start:self._N-1]
+        values[1:] = a_s._X[start:self._N-1]
+
+        self.external_state.run_open_loop(actions, values, rng=np.random.randint(np.iinfo(np.int32).max))
+
+        self.external_state._n = start
+        self.external_state._realised = True
+
+    # The internal state can be replayed if it supports it and action fitting does not read it at every frame
+    ## Replays read the realised actions, which must then be the fitted actions
+    def _can_replay(self):
+        return not self.agent._multi_is \
+               and self.agent.internal_state.replays_trials \
+               and self.agent.action_state._behaviour in ['obs', 'random'] \
+               and np.array_equal(self.agent.action_state._A, self.agent.action_state._A_fit, equal_nan=True)
+
+    # Actions are fitted and observations made frame by frame, the internal state then learns from the whole trial
+    def _fit_replay(self):
+        interventions = np.full(self._N, np.nan)
+        action_log_probs = np.zeros(self._N)
+        for n in range(self._N):
+            a = self.agent.a
+            if isinstance(a, tuple):
+                interventions[n] = a[0]
+
+            self.external_state.run(interventions=a)
+            self.agent.observe(self.external_state)
+            action_log_probs[n] = self.agent.fit_action(self.external_state)
+
+            self._n += 1
+
+        self.agent.replay_learn(interventions, action_log_probs)
+
+    # Release the worker pool of the action state once the experiment is over, see Treesearch_AS.close_executor
+    def _close_executor(self):
+        if hasattr(self.agent._action_state, 'close_executor'):
+            self.agent._action_state.close_executor()
+
             
     def entropy_report(self):
         if not self._i <= self._iter:
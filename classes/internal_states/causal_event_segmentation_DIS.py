@@ -1,4 +1,4 @@
-from classes.internal_states.internal_state import Discrete_IS
+from classes.internal_states.internal_state import Discrete_IS, memoised_property
 from scipy import stats
 import numpy as np
 
@@ -6,8 +6,13 @@ import numpy as np
 # Causal event segmentation model
 
 class causal_event_segmentation_DIS(Discrete_IS):
-    def __init__(self, N, K, links, dt, abs_bounds, ces_type, ce_threshold=0.5, time_threshold = 15, guess=0.1, generate_sample_space=True, sample_params=False, prior_param=None, smoothing=False):
-        super().__init__(N, K, links, dt, self._update_rule, generate_sample_space=generate_sample_space, sample_params=sample_params, prior_param=prior_param, smoothing=smoothing)
+    # Running evidence sums are updated in place and the evidence buffer is read back by updates, see Internal_state.snapshot
+    _snapshot_copies = Discrete_IS._snapshot_copies + ('_evidence_sum',)
+    _snapshot_rows = ('_evidence_collected',)
+    _fingerprint_attributes = ('_last_obs', '_last_action', '_last_action_len', '_last_instant_action', '_last_action_idx', '_last_action_end', '_evidence_sum', '_evidence_count')
+
+    def __init__(self, N, K, links, dt, abs_bounds, ces_type, ce_threshold=0.5, time_threshold = 15, guess=0.1, generate_sample_space=True, sample_params=False, prior_param=None, smoothing=False, history_dtype=np.float64, retention='full'):
+        super().__init__(N, K, links, dt, self._update_rule, generate_sample_space=generate_sample_space, sample_params=sample_params, prior_param=prior_param, smoothing=smoothing, history_dtype=history_dtype, retention=retention)
 
         self._bounds = abs_bounds
 
@@ -31,6 +36,9 @@ class causal_event_segmentation_DIS(Discrete_IS):
         self._last_obs = np.zeros(self._K)
         self._last_action_idx = 0
 
+        # Cause and effect variable of each link, links are ordered row wise off the diagonal
+        self._link_causes, self._link_effects = np.where(~np.eye(self._K, dtype=bool))
+
 
 
 
@@ -112,55 +120,13 @@ class causal_event_segmentation_DIS(Discrete_IS):
 
         ## Get change
         ## Update evidence or values (posterior value)
-        one_step_evidence = np.zeros(self._posterior_params.shape)
-        idx = 0
-        for i in range(self._K):
-            for j in range(self._K):
-                if i != j:
-                    if j == self._last_action[0] or i != self._last_action[0]:
-                        # If looking a link going into cause i or if looking at link that are not acted upon
-                        idx += 1
-                        continue
-
-                    
-                    if np.abs(obs[j]) > self._causal_event_threshold:
-                        if self._type_model == 'strength_sensitive':
-                            if self._last_action_idx < self._time_threshold:
-                                # Accumulate strong link evidence 
-                                if obs[j] * obs[i] > 1:
-                                    # Positive link
-                                    link_value = 1
-                                    one_step_evidence[idx, :] = (self._L == link_value).astype(int)
-                                else:
-                                    # Negative link
-                                    link_value = -1
-                                    one_step_evidence[idx, :] = (self._L == link_value).astype(int)
-                            else:
-                                # Accumulate weak link evidence
-                                if obs[j] * obs[i] > 1:
-                                    # Positive link
-                                    link_value = 1/2
-                                    one_step_evidence[idx, :] = (self._L == link_value).astype(int)
-                                else:
-                                    # Negative link
-                                    link_value = -1/2
-                                    one_step_evidence[idx, :] = (self._L == link_value).astype(int)
-
-                        elif self._type_model == 'strength_insensitive':
-                            if obs[j] * obs[i] > 1:
-                                one_step_evidence[idx, :] = (self._L == 1/2).astype(int)
-                                one_step_evidence[idx, :] = (self._L == 1).astype(int)
-                            else: 
-                                one_step_evidence[idx, :] = (self._L == -1).astype(int)
-                                one_step_evidence[idx, :] = (self._L == -1/2).astype(int)
-                    
-                    idx += 1
-                    
+        one_step_evidence = self._one_step_evidence(obs, self._last_action[0])
         
         # Update evidence collected
+        self._evidence_sum += one_step_evidence - self._evidence_collected[self._n, :, :]
         self._evidence_collected[self._n, :, :] = one_step_evidence
-        # posterior_params: sum over evidence collected
-        posterior_params = np.nanmean(self._evidence_collected, axis=0)
+        # posterior_params: mean over evidence collected, running equivalent of a nanmean over the evidence buffer
+        posterior_params = self._evidence_sum / self._evidence_count
         posterior_params = posterior_params / posterior_params.sum(axis=1, keepdims=1)
 
         # update mus
@@ -176,6 +142,30 @@ class causal_event_segmentation_DIS(Discrete_IS):
         
 
     
+    # One hot evidence of the current frame
+    ## Only links going out of the acted upon variable whose effect crosses the causal event threshold collect evidence
+    ## The sign of the link is given by the sign of the product of cause and effect values
+    def _one_step_evidence(self, obs, focus):
+        one_step_evidence = np.zeros(self._posterior_params.shape)
+
+        links = np.where((self._link_causes == focus) & (np.abs(obs[self._link_effects]) > self._causal_event_threshold))[0]
+        positive = obs[self._link_effects[links]] * obs[self._link_causes[links]] > 1
+
+        if self._type_model == 'strength_sensitive':
+            # Strong link evidence early in the action, weak link evidence after the time threshold
+            strength = 1 if self._last_action_idx < self._time_threshold else 1/2
+            link_values = np.where(positive, strength, -strength)
+        elif self._type_model == 'strength_insensitive':
+            # Positive events are evidence for 1, negative events for -1/2
+            link_values = np.where(positive, 1, -1/2)
+        else:
+            return one_step_evidence
+
+        one_step_evidence[links, :] = self._L == link_values.reshape((-1, 1))
+
+        return one_step_evidence
+
+
     # Background methods
     ## Prior initialisation specific to model:
     def _local_prior_init(self):  
@@ -183,7 +173,17 @@ class causal_event_segmentation_DIS(Discrete_IS):
 
         self._evidence_collected[0, :, : ] = self._prior_params
 
-    @property
+        # Running sum and count of the evidence collected, nan priors are left out as in a nanmean over the buffer
+        self._evidence_sum = np.nan_to_num(self._prior_params, nan=0)
+        self._evidence_count = self._N - np.isnan(self._prior_params)
+
+    ## Evidence collected in the rolled back frames is removed from the running sum
+    def _local_rollback(self, back):
+        rolled_back = self._evidence_collected[self._n:self._n+back, :, :]
+        self._evidence_sum -= rolled_back.sum(axis=0)
+        rolled_back[:] = 0
+
+    @memoised_property
     def posterior(self):
         if self._smoothing_temp:
             smoothed_posterior = self._smooth_softmax(self._posterior_params)
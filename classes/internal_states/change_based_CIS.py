@@ -18,8 +18,12 @@ import numpy as np
 ## Sigmoid
 
 class LC_linear_change_CIS(Continuous_IS):
-    def __init__(self, N, K, links, dt, prop_const, variance, hypothesis, decay_type, decay_rate, generate_sample_space=True, sample_params=False, prior_param=None, smoothing=False):
-        super().__init__(N, K, links, dt, self._update_rule, generate_sample_space=generate_sample_space, sample_params=sample_params, prior_param=prior_param, smoothing=smoothing)
+    replays_trials = True
+    # Attention and schedule state read back by the next update, see Internal_state.fingerprint
+    _fingerprint_attributes = ('_last_obs', '_last_action', '_last_action_len', '_last_instant_action', '_last_action_idx', '_last_action_end')
+
+    def __init__(self, N, K, links, dt, prop_const, variance, hypothesis, decay_type, decay_rate, generate_sample_space=True, sample_params=False, prior_param=None, smoothing=False, history_dtype=np.float64, retention='full'):
+        super().__init__(N, K, links, dt, self._update_rule, generate_sample_space=generate_sample_space, sample_params=sample_params, prior_param=prior_param, smoothing=smoothing, history_dtype=history_dtype, retention=retention)
 
         self._c = 1 / prop_const
         self._sigma = variance**(1/2)
@@ -31,6 +35,7 @@ class LC_linear_change_CIS(Continuous_IS):
         elif hypothesis == 'full_knowledge':
             self._calc_obs_stat = self._full_knowledge
 
+        self._decay_type = decay_type
         if decay_type == 'exponential':
             self._power_update_coef = self._exponential_decay
         elif decay_type == 'sigmoid':
@@ -38,6 +43,9 @@ class LC_linear_change_CIS(Continuous_IS):
 
         self._decay_rate = decay_rate
 
+        # Cause and effect variable of each link, links are ordered row wise off the diagonal
+        self._link_causes, self._link_effects = np.where(~np.eye(self._K, dtype=bool))
+
         self._last_action = None
         self._last_action_len = None
         self._last_instant_action = None
@@ -87,8 +95,6 @@ class LC_linear_change_CIS(Continuous_IS):
                 self._last_action_idx = 0
 
 
-        new_params = np.zeros(self._posterior_params.shape)
-
         # Logic for updating
         # Compute power update coefficient
         delay = self._last_action_len
@@ -96,52 +102,117 @@ class LC_linear_change_CIS(Continuous_IS):
         self._power_update_coef_history[self._n] = power_coef
 
         ## Get change
-        ## Update evidence or values (posterior value)
-        idx = 0
-        for i in range(self._K):
-            for j in range(self._K):
-                if i != j:
-                    mean_prev = self._posterior_params[idx, 0]
-                    sd_prev = self._posterior_params[idx, 1]
-
-                    if j == self._last_action[0] or i != self._last_action[0]:
-                        sd = sd_prev
-                        mean = mean_prev
-                        new_params[idx, :] = [mean, sd]
-                        idx += 1
-                        continue
-                    
-                    # Compute summary stat
-                    summary_stat = self._calc_obs_stat(obs_alt[j], self._last_obs[i], self._last_obs[j])
-
-                    #if np.abs(summary_stat) > 8:
-                    #    print('Divergence!')
-                    #    pass
-
-                    # Control divergence
-                    if np.abs(summary_stat) == np.inf:
-                        sd = sd_prev
-                        mean = mean_prev
-                        new_params[idx, :] = [mean, sd]
-                        idx += 1
-                        continue
-                    
-                
-                    # Compute posterior parameters
-                    sd = (power_coef / self._sigma**2 + 1 / sd_prev**2)**(-1/2)
-                    mean = sd**2 * (summary_stat * power_coef / self._sigma**2 + mean_prev / sd_prev**2)
-
-                    new_params[idx, :] = [mean, sd]
-
-                    self._summary_stats_history[idx, self._n] = summary_stat
-                    idx += 1  
-    
+        ## Update evidence or values (posterior value), only links going out of the acted upon variable are updated
+        summary_stats = self._link_summary_stats(obs_alt.reshape((1, self._K)), 
+                                                 self._last_obs.reshape((1, self._K)), 
+                                                 np.array([self._last_action[0]]))[0]
+        evidence = ~np.isnan(summary_stats)
+        self._summary_stats_history[evidence, self._n] = summary_stats[evidence]
+
+        mean_prev = self._posterior_params[:, 0]
+        sd_prev = self._posterior_params[:, 1]
+
+        # Compute posterior parameters
+        sd = (power_coef / self._sigma**2 + 1 / sd_prev**2)**(-1/2)
+        mean = sd**2 * (summary_stats * power_coef / self._sigma**2 + mean_prev / sd_prev**2)
+
+        new_params = np.where(evidence.reshape((-1, 1)), np.array([mean, sd]).T, self._posterior_params)
+
         self._last_action_idx += 1
         self._last_obs = obs
         self._last_instant_action = intervention
 
         return new_params
-        
+
+
+    # Whole trial replay from the sensory and action histories, see Local_computations_omniscient_DIS.replay_trial
+    def replay_trial(self, observations, observations_alt, interventions, actions):
+        return self.replay(observations, observations_alt, interventions, actions)
+
+    # Event driven replay of a whole realised trial, step wise update is kept for closed loop runs
+    ## observations, observations_alt: (T+1, K) arrays as recorded by the sensory state, first row is the observation preceding the first update
+    ## interventions: (T,) array of the variable intervened upon at each update, nan when idle
+    ## actions: realised actions as loaded in the action state, the real action at update t is actions[t], fitted and real actions are assumed to be the same
+    ## Intervention segments, their lengths and decay coefficients are derived once from the action arrays, continuing from the current attention state
+    ## The update is conjugate: precisions and precision weighted means are summed over the frames that can change the posterior, the other frames repeat the previous posterior
+    ## Equivalent to T calls to update, returns the log probability of the judgements at each update
+    def replay(self, observations, observations_alt, interventions, actions):
+        T = observations.shape[0] - 1
+        start = self._n
+        frames = np.arange(start, start + T)
+
+        # Length of the run of consecutive frames acting on the same variable, as Action_state._get_action_len
+        run_idx = np.cumsum(np.concatenate(([True], actions[1:] != actions[:-1]))) - 1
+        run_len = np.bincount(run_idx)[run_idx].astype(float)
+        run_len[np.isnan(actions)] = np.nan
+
+        intervening = ~np.isnan(interventions)
+        acting = ~np.isnan(actions[frames])
+        intervening_prev = np.concatenate(([bool(self._last_instant_action)], intervening[:-1]))
+        engaged = np.concatenate(([False], np.maximum.accumulate(intervening & (frames > 0))[:-1])) | bool(self._last_action)
+
+        # Frames that can change the posterior and starts of the intervention segments
+        updated = (frames > 0) & (intervening | (engaged & ~acting))
+        starts = intervening & (frames > 0) & (~engaged | ~intervening_prev)
+
+        # Updates made before each frame, the first segment continues the current attention state
+        updates_before = np.cumsum(updated) - updated
+        seg = np.cumsum(starts)
+        seg_start = np.concatenate(([0], np.where(starts)[0]))[seg]
+        focus = np.where(seg > 0, interventions[seg_start], self._last_action[0] if self._last_action else np.nan)
+        action_len = np.where(seg > 0, run_len[frames[seg_start]], self._last_action_len if self._last_action_len is not None else np.nan)
+        action_idx = np.where(seg > 0, updates_before - updates_before[seg_start], self._last_action_idx + updates_before)
+
+        active = np.where(updated)[0]
+        if self._decay_type == 'exponential':
+            power_coefs = self._decay_rate_powers(action_idx[active])
+        elif self._decay_type == 'sigmoid':
+            power_coefs = 1 / (1 + self._decay_rate_powers(- action_idx[active] + action_len[active]))
+        self._power_update_coef_history[frames[active]] = power_coefs
+
+        summary_stats = self._link_summary_stats(observations_alt[active+1, :], observations[active, :], focus[active])
+        evidence = ~np.isnan(summary_stats)
+        steps, links = np.where(evidence)
+        self._summary_stats_history[links, frames[active[steps]]] = summary_stats[steps, links]
+
+        # Posterior after each active update
+        precision_steps = evidence * power_coefs.reshape((-1, 1)) / self._sigma**2
+        weighted_mean_steps = np.where(evidence, summary_stats, 0) * precision_steps
+
+        precision_prev = 1 / self._posterior_params[:, 1]**2
+        precision = precision_prev + np.cumsum(precision_steps, axis=0)
+        mean = (self._posterior_params[:, 0] * precision_prev + np.cumsum(weighted_mean_steps, axis=0)) / precision
+
+        posterior_params = np.concatenate((self._posterior_params.reshape((1,) + self._posterior_params.shape), np.stack((mean, precision**(-1/2)), axis=2)))
+        # Idle frames refer to the posterior of the last active update
+        posterior_params = posterior_params[np.cumsum(updated)]
+
+        # Attention state after the last update
+        if seg[-1] > 0:
+            self._last_action = (int(focus[-1]), observations[seg_start[-1], int(focus[-1])])
+            self._last_action_len = int(action_len[-1]) if not np.isnan(action_len[-1]) else None
+        if updated.any():
+            self._last_action_idx = int(action_idx[-1] + updated[-1])
+        self._last_instant_action = (int(interventions[-1]), observations[T-1, int(interventions[-1])]) if intervening[-1] else None
+        self._last_obs = observations[-1, :]
+
+        return self._replay_updates(posterior_params)
+
+
+    ## Summary statistic of the links going out of the variable in focus, nan for the other links and when it diverges
+    ## obs_alt: (T, K) change observations, last_obs: (T, K) previous observations, focus: (T,) acted upon variable
+    def _link_summary_stats(self, obs_alt, last_obs, focus):
+        summary_stats = np.full((focus.size, self._link_causes.size), np.nan)
+        steps, links = np.where(self._link_causes == focus.reshape((-1, 1)))
+        causes = self._link_causes[links]
+        effects = self._link_effects[links]
+
+        summary_stat = self._calc_obs_stat(obs_alt[steps, effects], last_obs[steps, causes], last_obs[steps, effects])
+        # Control divergence
+        summary_stat[np.abs(summary_stat) == np.inf] = np.nan
+        summary_stats[steps, links] = summary_stat
+
+        return summary_stats
 
     
     # Background methods
@@ -149,28 +220,28 @@ class LC_linear_change_CIS(Continuous_IS):
     def _local_prior_init(self):
         self._summary_stats_history = np.zeros((self._prior_params.shape[0], self._N))
 
-    # Summary statistics               
+    # Summary statistics, element wise over arrays of observations
     ## Proportional to cause value
     def _prop_cause_value(self, change_effect, cause, effect):
-        if np.abs(cause) == 0:
-            return np.inf
-        else:
-            return self._c * change_effect / cause
+        with np.errstate(divide='ignore', invalid='ignore'):
+            summary_stat = self._c * change_effect / cause
+
+        return np.where(np.abs(cause) == 0, np.inf, summary_stat)
 
     ## Full knowledge
     def _full_knowledge(self, change_effect, cause, effect):
-        if np.abs(cause) == 0:
-            return np.inf
-        else:
-            return self._c * change_effect / cause + effect / cause
+        with np.errstate(divide='ignore', invalid='ignore'):
+            summary_stat = self._c * change_effect / cause + effect / cause
+
+        return np.where(np.abs(cause) == 0, np.inf, summary_stat)
     
     ## Proportional to distance
     ### NOT FUNCTIONAL: Requires additional logic as it fails for negative links
     def _prop_distance(self, change_effect, cause, effect):
-        if np.abs(cause - effect) == 0:
-            return np.inf
-        else:
-            return self._c * (change_effect / (cause - effect))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            summary_stat = self._c * (change_effect / (cause - effect))
+
+        return np.where(np.abs(cause - effect) == 0, np.inf, summary_stat)
         
 
     # Power update coefficients
@@ -182,6 +253,11 @@ class LC_linear_change_CIS(Continuous_IS):
     def _sigmoid_decay(self, delay):
         return 1 / (1 + self._decay_rate**(- self._last_action_idx + delay))
 
+    ## Powers of the decay rate, computed once per distinct exponent with the same scalar power as the step wise update
+    def _decay_rate_powers(self, exponents):
+        values, inverse = np.unique(exponents, return_inverse=True)
+        return np.array([self._decay_rate**float(e) for e in values], dtype=float)[inverse]
+
     
     # Generic Continuous functions
     def _argmax(self):
@@ -205,12 +281,13 @@ class LC_linear_change_CIS(Continuous_IS):
         return stats.norm.entropy(scale=parameters[:, 1])
 
 
+    ## params: (num_link_vars, 2) or (T, num_link_vars, 2) for a whole history
     def _posterior_pmf(self, params):
-        means = params[:, 0].reshape((params.shape[0], 1))
-        sds = params[:, 1].reshape((params.shape[0], 1))
+        means = params[..., 0, np.newaxis]
+        sds = params[..., 1, np.newaxis]
 
         discrete_pmf = stats.norm.cdf(self._L + self._interval, loc=means, scale=sds) - stats.norm.cdf(self._L - self._interval, loc=means, scale=sds)
-        discrete_pmf_norm = discrete_pmf / discrete_pmf.sum(axis=1).reshape(means.shape)
+        discrete_pmf_norm = discrete_pmf / discrete_pmf.sum(axis=-1, keepdims=True)
 
         return discrete_pmf_norm
 
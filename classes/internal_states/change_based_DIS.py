@@ -18,8 +18,12 @@ import numpy as np
 ## Sigmoid
 
 class LC_linear_change_DIS(Discrete_IS):
-    def __init__(self, N, K, links, dt, prop_const, hypothesis, decay_type, lh_var=1/10, decay_rate=0.65, generate_sample_space=True, sample_params=False, prior_param=None,  smoothing=False):
-        super().__init__(N, K, links, dt, self._update_rule, generate_sample_space=generate_sample_space, sample_params=sample_params, prior_param=prior_param, smoothing=smoothing)
+    replays_trials = True
+    # Attention and schedule state read back by the next update, see Internal_state.fingerprint
+    _fingerprint_attributes = ('_last_obs', '_last_action', '_last_action_len', '_last_instant_action', '_last_action_idx', '_last_action_end')
+
+    def __init__(self, N, K, links, dt, prop_const, hypothesis, decay_type, lh_var=1/10, decay_rate=0.65, generate_sample_space=True, sample_params=False, prior_param=None,  smoothing=False, history_dtype=np.float64, retention='full'):
+        super().__init__(N, K, links, dt, self._update_rule, generate_sample_space=generate_sample_space, sample_params=sample_params, prior_param=prior_param, smoothing=smoothing, history_dtype=history_dtype, retention=retention)
 
         self._c = 1 / prop_const
         self._sigma = lh_var**(1/2)
@@ -34,6 +38,7 @@ class LC_linear_change_DIS(Discrete_IS):
         elif hypothesis == 'full_knowledge':
             self._calc_obs_stat = self._full_knowledge
 
+        self._decay_type = decay_type
         if decay_type == 'exponential':
             self._power_update_coef = self._exponential_decay
         elif decay_type == 'sigmoid':
@@ -41,6 +46,9 @@ class LC_linear_change_DIS(Discrete_IS):
 
         self._decay_rate = decay_rate if decay_rate > 1e-1 else 1e-1
 
+        # Cause and effect variable of each link, links are ordered row wise off the diagonal
+        self._link_causes, self._link_effects = np.where(~np.eye(self._K, dtype=bool))
+
         self._last_action = None
         self._last_action_len = None
         self._last_instant_action = None
@@ -132,38 +140,16 @@ class LC_linear_change_DIS(Discrete_IS):
         self._power_update_coef_history[self._n] = power_coef
 
         ## Get change
-        ## Update evidence or values (posterior value)
-        log_likelihood_per_link = np.zeros(self._posterior_params.shape)
-        idx = 0
-        for i in range(self._K):
-            for j in range(self._K):
-                if i != j:
-                    if j == self._last_action[0] or i != self._last_action[0]:
-                        log_likelihood_per_link[idx, :] = np.zeros(self._L.size)
-                        idx += 1
-                        continue
-
-                    # Compute summary stat
-                    summary_stat = self._calc_obs_stat(obs_alt[j], self._last_obs[i], self._last_obs[j])
-                        
-                    # Control divergence and weird interventions
-                    if np.abs(summary_stat) == np.inf:
-                        log_likelihood_per_link[idx, :] = np.zeros(self._L.size)
-                        idx += 1
-                        continue
-
-                    # Likelihood of observed the new values given the previous values for each model
-                    log_likelihood = power_coef * stats.norm.logpdf(summary_stat, loc=self._L, scale=self._sigma)
-                    # Normalisation step
-                    likelihood_log = log_likelihood - np.amax(log_likelihood)
-                    likelihood_norm = np.exp(likelihood_log) / np.exp(likelihood_log).sum()
-                    log_likelihood_per_link[idx, :] = np.log(likelihood_norm)
-                    self._summary_stats_history[idx, self._n] = summary_stat
-                    idx += 1
-                    
+        ## Update evidence or values (posterior value), only links going out of the acted upon variable are updated
+        log_likelihood_per_link, summary_stats = self._link_log_likelihoods(obs_alt.reshape((1, self._K)), 
+                                                                            self._last_obs.reshape((1, self._K)), 
+                                                                            np.array([power_coef]), 
+                                                                            np.array([self._last_action[0]]))
+        evidence = ~np.isnan(summary_stats[0])
+        self._summary_stats_history[evidence, self._n] = summary_stats[0, evidence]
         
-        # Posterior params is the log likelihood of each model given the data
-        log_posterior = self._posterior_params + log_likelihood_per_link
+                # Posterior params is the log likelihood of each model given the data
+        log_posterior = self._posterior_params + log_likelihood_per_link[0]
 
         # update mus
         self._last_action_idx += 1
@@ -182,7 +168,113 @@ class LC_linear_change_DIS(Discrete_IS):
          
 
         return log_posterior
-        
+
+
+    # Whole trial replay from the sensory and action histories, see Local_computations_omniscient_DIS.replay_trial
+    ## Evidence comes from the change summaries and the realised actions, interventions are read from the actions
+    def replay_trial(self, observations, observations_alt, interventions, actions):
+        return self.replay(observations, observations_alt, actions)
+
+    # Event driven replay of a whole realised trial, step wise update is kept for closed loop runs
+    ## observations, observations_alt: (T+1, K) arrays as recorded by the sensory state, first row is the observation preceding the first update
+    ## actions: realised actions as loaded in the action state, the real action at update t is actions[t]
+    ## Attention only depends on the realised actions: intervention segments, their lengths and decay coefficients are derived from the action array from the start of the trial
+    ## Evidence is only computed at the frames that can change the posterior, the other frames repeat the previous posterior
+    ## Equivalent to T calls to update, returns the log probability of the judgements at each update
+    def replay(self, observations, observations_alt, actions):
+        T = observations.shape[0] - 1
+        start = self._n
+        frames = np.arange(start + T)
+
+        # Length of the run of consecutive frames acting on the same variable, as Action_state._get_action_len
+        run_idx = np.cumsum(np.concatenate(([True], actions[1:] != actions[:-1]))) - 1
+        run_len = np.bincount(run_idx)[run_idx]
+
+        acting = ~np.isnan(actions[:start+T])
+        acting_prev = np.concatenate(([False], acting[:-1]))
+
+        # No update is made before the first intervention, then every frame is updated
+        updated = np.maximum.accumulate(acting & (frames > 0))
+        if not updated[start:].any():
+            self._last_obs = observations[-1, :]
+            self._last_instant_action = (int(actions[frames[-1]]), observations[T-1, int(actions[frames[-1]])]) if acting[-1] else None
+            return self._replay_updates(np.tile(self._posterior_params, (T, 1, 1)))
+
+        # Intervention segments start when acting after an idle frame, or at the first intervention
+        starts = updated & acting & (~acting_prev | ~np.concatenate(([False], updated[:-1])))
+        seg_start = frames[starts][np.maximum(np.cumsum(starts) - 1, 0)]
+        focus = actions[seg_start]
+        action_len = run_len[seg_start]
+        action_idx = frames - seg_start
+
+        # Frames since the end of the segment intervention, None in the step wise update while still acting
+        stops = updated & acting_prev & ~acting
+        last_stop = np.maximum.accumulate(np.where(stops, frames, -1))
+        decaying = last_stop > seg_start
+        action_end = np.maximum(frames - last_stop, 1)
+
+        # Decay coefficients of the updated frames
+        active = np.where(updated[start:])[0]
+        n_active = active + start
+        if self._decay_type == 'exponential':
+            power_coefs = np.where(decaying[n_active], self._decay_rate_powers(action_end[n_active]), 1)
+        elif self._decay_type == 'sigmoid':
+            power_coefs = 1 / (1 + self._decay_rate_powers(- action_idx[n_active] + action_len[n_active]))
+        self._power_update_coef_history[n_active] = power_coefs
+
+        log_likelihoods, summary_stats = self._link_log_likelihoods(observations_alt[active+1, :], observations[active, :], power_coefs, focus[n_active])
+        steps, links = np.where(~np.isnan(summary_stats))
+        self._summary_stats_history[links, n_active[steps]] = summary_stats[steps, links]
+
+        # Posterior after each active update, accumulated in the same order as step wise updates
+        log_posteriors = np.cumsum(np.concatenate((self._posterior_params.reshape((1,) + self._posterior_params.shape), log_likelihoods)), axis=0)
+        # Idle frames refer to the posterior of the last active update
+        log_posteriors = log_posteriors[np.cumsum(updated[start:])]
+
+        # Attention state after the last update
+        last = frames[-1]
+        if seg_start[last] >= start:
+            self._last_action = (int(focus[last]), observations[seg_start[last]-start, int(focus[last])])
+        self._last_action_len = int(action_len[last])
+        self._last_action_idx = int(action_idx[last]) + 1
+        self._last_action_end = int(action_end[last]) + int(not acting_prev[last] and not acting[last]) if decaying[last] else None
+        self._last_instant_action = (int(actions[last]), observations[T-1, int(actions[last])]) if acting[last] else None
+        self._last_obs = observations[-1, :]
+
+        return self._replay_updates(log_posteriors)
+
+
+    # Normalised log likelihood of each link value for a batch of updates
+    ## obs_alt: (T, K) change observations, last_obs: (T, K) previous observations
+    ## power_coefs: (T,) attention coefficients, focus: (T,) acted upon variable, only its outgoing links are updated
+    ## Returns the (T, num_link_vars, num_links) log likelihoods and the (T, num_link_vars) summary statistics, nan where no evidence is taken
+    def _link_log_likelihoods(self, obs_alt, last_obs, power_coefs, focus):
+        log_likelihood_per_link = np.zeros((focus.size,) + self._posterior_params.shape)
+        summary_stats = self._link_summary_stats(obs_alt, last_obs, focus)
+        steps, links = np.where(~np.isnan(summary_stats))
+
+        # Likelihood of observed the new values given the previous values for each model
+        log_likelihood = power_coefs[steps, np.newaxis] * stats.norm.logpdf(summary_stats[steps, links, np.newaxis], loc=self._L, scale=self._sigma)
+        # Normalisation step
+        likelihood_log = log_likelihood - np.amax(log_likelihood, axis=1, keepdims=True)
+        likelihood_norm = np.exp(likelihood_log) / np.exp(likelihood_log).sum(axis=1, keepdims=True)
+        log_likelihood_per_link[steps, links, :] = np.log(likelihood_norm)
+
+        return log_likelihood_per_link, summary_stats
+
+    ## Summary statistic of the links going out of the variable in focus, nan for the other links and when it diverges
+    def _link_summary_stats(self, obs_alt, last_obs, focus):
+        summary_stats = np.full((focus.size, self._link_causes.size), np.nan)
+        steps, links = np.where(self._link_causes == focus.reshape((-1, 1)))
+        causes = self._link_causes[links]
+        effects = self._link_effects[links]
+
+        summary_stat = self._calc_obs_stat(obs_alt[steps, effects], last_obs[steps, causes], last_obs[steps, effects])
+        # Control divergence and weird interventions
+        summary_stat[np.abs(summary_stat) == np.inf] = np.nan
+        summary_stats[steps, links] = summary_stat
+
+        return summary_stats
 
     
     # Background methods
@@ -190,35 +282,35 @@ class LC_linear_change_DIS(Discrete_IS):
     def _local_prior_init(self):
         self._summary_stats_history = np.zeros((self._prior_params.shape[0], self._N))
 
-    # Summary statistics               
+    # Summary statistics, element wise over arrays of observations
     ## Proportional to cause value
     def _prop_cause_value(self, change_effect, cause, effect):
-        if np.abs(cause) == 0 or np.abs(change_effect) > 20:
-            return np.inf
+        with np.errstate(divide='ignore', invalid='ignore'):
+            summary_stat = self._c * change_effect / cause
 
-        return self._c * change_effect / cause
+        return np.where((np.abs(cause) == 0) | (np.abs(change_effect) > 20), np.inf, summary_stat)
 
     ## Additive cause and effect values
     def _cause_effect_values(self, change_effect, cause, effect):
-        if np.abs(cause) == 0 or np.abs(change_effect) > 20:
-            return np.inf
+        with np.errstate(divide='ignore', invalid='ignore'):
+            summary_stat = self._c * change_effect / cause + effect / cause
 
-        return self._c * change_effect / cause + effect / cause
+        return np.where((np.abs(cause) == 0) | (np.abs(change_effect) > 20), np.inf, summary_stat)
 
     ## Full knowledge
     def _full_knowledge(self, change_effect, cause, effect):
-        if np.abs(cause) == 0 or np.abs(change_effect) > 20:
-            return np.inf
+        with np.errstate(divide='ignore', invalid='ignore'):
+            summary_stat = self._c * change_effect / cause + (effect * (np.abs(effect) / 100) )/ cause
 
-        return self._c * change_effect / cause + (effect * (np.abs(effect) / 100) )/ cause
+        return np.where((np.abs(cause) == 0) | (np.abs(change_effect) > 20), np.inf, summary_stat)
     
     ## Proportional to distance
     ### NOT FUNCTIONAL: Requires additional logic as it fails for negative links
     def _prop_distance(self, change_effect, cause, effect):
-        if np.abs(cause - effect) == 0 or np.abs(change_effect) > 20:
-            return np.inf
+        with np.errstate(divide='ignore', invalid='ignore'):
+            summary_stat = self._c * (change_effect / (cause - effect))
 
-        return self._c * (change_effect / (cause - effect))
+        return np.where((np.abs(cause - effect) == 0) | (np.abs(change_effect) > 20), np.inf, summary_stat)
         
 
     # Power update coefficients
@@ -233,5 +325,10 @@ class LC_linear_change_DIS(Discrete_IS):
     def _sigmoid_decay(self, delay):
         return 1 / (1 + self._decay_rate**(- self._last_action_idx + delay))
 
+    ## Powers of the decay rate for integer exponents, computed once per distinct exponent with the same scalar power as the step wise update
+    def _decay_rate_powers(self, exponents):
+        values, inverse = np.unique(exponents, return_inverse=True)
+        return np.array([self._decay_rate**int(e) for e in values], dtype=float)[inverse]
+
 
 
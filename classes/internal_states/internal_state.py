@@ -1,16 +1,48 @@
 from math import log
 import re
+import hashlib
 import numpy as np
 from numpy.random.mtrand import sample
 import pandas as pd
 from scipy import stats
 from copy import deepcopy
+from functools import wraps
+from types import MappingProxyType
 
+from methods.marginalisation_methods import build_marginalisation_index, models_to_links, links_to_models, links_to_log_models
+from methods.retention_methods import build_retention_mask, retention_slots
+from methods.packed_factors_methods import unpack_factors, segment_softmax, segment_entropy
+
+
+
+# Property derived from the current posterior, computed once per step, see Internal_state._memoised
+def memoised_property(func):
+    @wraps(func)
+    def getter(self):
+        return self._memoised(func.__name__, lambda: func(self))
+    return property(getter)
+
+
+# Parameter combination tables of Variational_IS, shared by every instance in the process
+## Keyed by number of variables, link values, non link parameter grids and factorisation, tables are read only
+_parameter_subsets_cache = {}
 
 
 # Main Internal state class
 class Internal_state():
-    def __init__(self, N, K, update_func, update_func_args=[], prior_param=None):
+    # Arrays updated in place and per frame histories read back by updates, see snapshot
+    _snapshot_copies = ('_judgement_current',)
+    _snapshot_rows = ()
+    # Attributes read back by the next update besides the posterior, see fingerprint
+    _fingerprint_attributes = ()
+    # Batched rollouts of tree search action states, see Treesearch_AS._batched_seqs_values
+    ## Models supporting them implement rollout_state, batch_rollout and batch_entropy
+    supports_batched_rollouts = False
+    # Whole trial replay when fitting realised trials, see Experiment.fit
+    ## Models supporting it implement replay_trial, e.g. Local_computations_omniscient_DIS.replay_trial
+    replays_trials = False
+
+    def __init__(self, N, K, update_func, update_func_args=[], prior_param=None, history_dtype=np.float64, retention='full'):
         self._N = N
         self._n = 0
         self._K = K
@@ -21,6 +53,22 @@ class Internal_state():
 
         self._prior_params = None
 
+        # Index structure for marginalisation over links, built on first use
+        self._marginalisation_index = None
+
+        # Posterior history is preallocated as a (N+1, *param_shape) array of this dtype when parameters are arrays
+        ## float32 halves the memory, at the cost of precision in the history and in rolled back posteriors
+        self._history_dtype = history_dtype
+
+        # Frames kept in the posterior history, see methods.retention_methods
+        ## Rolling back is only possible to retained frames
+        self._retention_mask = build_retention_mask(self._N, retention)
+        self._history_slots = retention_slots(self._retention_mask)
+
+        # Derived posterior quantities (posterior, marginals, entropies, MAP) for the current step
+        self._memo = {}
+        self._memo_n = None
+
         # p(i_t|s_t, i_t-1): must be a function of sensory states and the last action
         self._p_i_g_s_i = update_func
         self._p_i_g_s_i_args = update_func_args
@@ -34,51 +82,98 @@ class Internal_state():
     ## Parameters can change but there must always be current set of posterior parameters & a history of the parameters at each time step
     def update(self, sensory_state, action_state):
 
-        self._posterior_params_history[self._n] = deepcopy(self._posterior_params)
-
         self._posterior_params = self._p_i_g_s_i(sensory_state, action_state, *self._p_i_g_s_i_args)
         
         self._n += 1
+        self._clear_memo()
+
+        # History entry n holds the posterior after n updates, entry 0 is the prior
+        slot = self._history_slots[self._n]
+        if slot < 0:
+            pass
+        elif isinstance(self._posterior_params_history, np.ndarray):
+            self._posterior_params_history[slot] = self._posterior_params
+        else:
+            self._posterior_params_history[slot] = deepcopy(self._posterior_params)
         
         
         if self._realised:
             if self._fitting_judgement:
-                # Update history
-                self._log_likelihood_history[self._n] = self._log_likelihood
-
+                judgement_log_prob = self._fit_judgement()
+            else:
                 judgement_log_prob = 0
-                j_data = self._judgement_data[self._n-1, :]
+                self._log_likelihood += judgement_log_prob
+        
+            return judgement_log_prob
 
-                if np.sum(np.isnan(j_data) != True) > 0:
-                    link_idx = np.argmax(np.isnan(j_data) != True)
-                    link_value = j_data[link_idx]
 
-                    judgement_log_prob = self.posterior_PF_link(link_idx, link_value, log=True)
+    # Replay a whole realised trial from the posterior parameters after each update
+    ## posterior_params_steps: (T, *param_shape) array, entry t is the posterior after the (t+1)-th update from the current frame
+    ## Equivalent to T calls to update: retained frames are written to the history and judgements are fitted where they are made
+    ## Returns the log probability of the judgements at each update
+    def _replay_updates(self, posterior_params_steps):
+        T = posterior_params_steps.shape[0]
+        frames = np.arange(self._n+1, self._n+T+1)
+
+        slots = self._history_slots[frames]
+        kept = slots >= 0
+        self._posterior_params_history[slots[kept]] = posterior_params_steps[kept]
+
+        judgement_log_probs = np.zeros(T)
+        if self._realised and self._fitting_judgement:
+            judged = (~np.isnan(self._judgement_data[frames-1, :])).any(axis=1) | (frames == self._N)
+            for t, n in enumerate(frames):
+                if judged[t]:
+                    # Judgements are made on the posterior at that frame
+                    self._n = n
+                    self._posterior_params = posterior_params_steps[t]
+                    self._clear_memo()
+                    judgement_log_probs[t] = self._fit_judgement()
+                else:
+                    self._log_likelihood_history[n] = self._log_likelihood
 
-                    self._judgement_current[link_idx] = link_value
+        self._n = frames[-1]
+        self._posterior_params = posterior_params_steps[-1]
+        self._clear_memo()
 
-                elif self._n == self._N:
-                    # Fit final judgement
-                    judge_diff = self._judgement_current != self._judgement_final
+        return judgement_log_probs
 
 
-                    for i in range(judge_diff.size):
-                        if judge_diff[i]:
-                            link_idx = i
-                            link_value = self._judgement_final[link_idx]
+    # Log probability of the judgement made at the current frame, the final judgement is fitted at the last frame
+    def _fit_judgement(self):
+        # Update history
+        self._log_likelihood_history[self._n] = self._log_likelihood
 
-                            judgement_log_prob += self.posterior_PF_link(link_idx, link_value, log=True)
+        judgement_log_prob = 0
+        j_data = self._judgement_data[self._n-1, :]
 
-                            self._judgement_current[link_idx] = link_value
+        if np.sum(np.isnan(j_data) != True) > 0:
+            link_idx = np.argmax(np.isnan(j_data) != True)
+            link_value = j_data[link_idx]
 
-                    print('Fiiting final judgement:', judgement_log_prob)
+            judgement_log_prob = self.posterior_PF_link(link_idx, link_value, log=True)
 
-                self._log_likelihood += judgement_log_prob
-            else:
-                judgement_log_prob = 0
-                self._log_likelihood += judgement_log_prob
-        
-            return judgement_log_prob
+            self._judgement_current[link_idx] = link_value
+
+        elif self._n == self._N:
+            # Fit final judgement
+            judge_diff = self._judgement_current != self._judgement_final
+
+
+            for i in range(judge_diff.size):
+                if judge_diff[i]:
+                    link_idx = i
+                    link_value = self._judgement_final[link_idx]
+
+                    judgement_log_prob += self.posterior_PF_link(link_idx, link_value, log=True)
+
+                    self._judgement_current[link_idx] = link_value
+
+            print('Fiiting final judgement:', judgement_log_prob)
+
+        self._log_likelihood += judgement_log_prob
+
+        return judgement_log_prob
         
 
     def load_judgement_data(self, judgement_data, final_judgement, fit_judgement=True):
@@ -98,26 +193,70 @@ class Internal_state():
     # Roll back internal state by a given number of step
     ## Used mostly for action selection
     def rollback(self, back=np.Inf):
+        self._clear_memo()
         if back > self._N or back > self._n:
             self._n = 0
             self._reset_priors()
         else:
             self._n -= int(back)
 
-            self._local_prior_init()
-            self._posterior_params = self._posterior_params_history[self._n]
-            # Reset Action values, seq and planned action from n to N
-            for n in range(self._n+1, self._N):
-                self._posterior_params_history[n] = None
+            self._local_rollback(int(back))
+            if isinstance(self._posterior_params_history, np.ndarray):
+                self._posterior_params = self._posterior_history_at(self._n).astype(self._prior_params.dtype)
+            else:
+                self._posterior_params = self._posterior_history_at(self._n)
+                # Reset Action values, seq and planned action from n to N
+                for slot in range(self._history_slots[self._n]+1, len(self._posterior_params_history)):
+                    self._posterior_params_history[slot] = None
                 
 
+    # Snapshot of the current step, to explore branches from it and come back with restore (e.g. tree search)
+    ## Attributes are shared with the snapshot rather than copied: updates rebind them and only write per frame histories ahead of the current frame
+    ## Arrays updated in place are listed in _snapshot_copies and copied
+    ## Per frame histories read back by updates are listed in _snapshot_rows, their current row is kept and the rows written ahead are cleared on restore
+    def snapshot(self):
+        attributes = self.__dict__.copy()
+        for name in self._snapshot_copies:
+            if isinstance(attributes.get(name), np.ndarray):
+                attributes[name] = attributes[name].copy()
+        rows = {name: getattr(self, name)[self._n].copy() for name in self._snapshot_rows if self._n < len(getattr(self, name))}
+        return attributes, rows
+
+    # Restore a snapshot, the same snapshot can be restored several times
+    def restore(self, snapshot):
+        attributes, rows = snapshot
+        n_from = self._n
+        self.__dict__.update(attributes)
+        for name in self._snapshot_copies:
+            if isinstance(attributes.get(name), np.ndarray):
+                setattr(self, name, attributes[name].copy())
+        for name, row in rows.items():
+            history = getattr(self, name)
+            history[self._n] = row
+            history[self._n+1:n_from+1] = 0
+
+
+    # Fingerprint of the current state, states with the same fingerprint update identically (e.g. transpositions in tree search)
+    ## Covers the posterior parameters, the attributes listed in _fingerprint_attributes and the current row of the _snapshot_rows histories
+    def fingerprint(self):
+        digest = hashlib.blake2b(digest_size=16)
+        values = [self._posterior_params] + [getattr(self, name, None) for name in self._fingerprint_attributes]
+        values += [getattr(self, name)[self._n] for name in self._snapshot_rows if self._n < len(getattr(self, name))]
+        for value in values:
+            if isinstance(value, np.ndarray) and value.dtype != object:
+                digest.update(np.ascontiguousarray(value).tobytes())
+            else:
+                digest.update(repr(value).encode())
+        return digest.digest()
+
+
     # Utility functions
     def initialise_prior_distribution(self, prior_judgement=None):
         self._prior_params = self._generate_prior_from_judgement(prior_judgement, self._prior_param) # Depends on continuous or discrete IS
         self._local_prior_init() # Model specific transformations of the prior
         self._posterior_params = self._prior_params
-        self._posterior_params_history = [None for i in range(self._N)]
-        self._posterior_params_history[0] = self._prior_params
+        self._init_posterior_history()
+        self._clear_memo()
 
         # Compute prior entropy
         self._prior_entropy = self.posterior_entropy
@@ -128,8 +267,54 @@ class Internal_state():
         self._local_prior_init()
         # Simply reset priors to intial states
         self._posterior_params = self._prior_params
-        self._posterior_params_history = [None for i in range(self._N)]
-        self._posterior_params_history[0] = self._prior_params
+        self._init_posterior_history()
+        self._clear_memo()
+
+    ## Model specific state to restore when rolling back, by default the prior initialisation is run again
+    def _local_rollback(self, back):
+        self._local_prior_init()
+
+
+    # Memoise a derived quantity for the current step
+    ## Keyed on _n and cleared whenever the posterior parameters change (update, rollback, prior initialisation)
+    ## Cached arrays are read only as they are shared between callers
+    def _memoised(self, key, compute):
+        if self._memo_n != self._n:
+            self._memo = {}
+            self._memo_n = self._n
+
+        if key not in self._memo:
+            value = compute()
+            if isinstance(value, np.ndarray):
+                value.flags.writeable = False
+            self._memo[key] = value
+
+        return self._memo[key]
+
+    def _clear_memo(self):
+        self._memo = {}
+        self._memo_n = None
+
+
+    # Contiguous history when the parameters are a single array, list otherwise (e.g. variational factors)
+    def _init_posterior_history(self):
+        num_retained = np.count_nonzero(self._retention_mask)
+        if isinstance(self._prior_params, np.ndarray) and self._prior_params.dtype != object:
+            self._posterior_params_history = np.zeros((num_retained,) + self._prior_params.shape, dtype=self._history_dtype)
+            self._posterior_params_history[0] = self._prior_params
+        else:
+            self._posterior_params_history = [None for i in range(num_retained)]
+            self._posterior_params_history[0] = deepcopy(self._prior_params)
+
+    # Posterior parameters at frame idx, the frame must be retained
+    def _posterior_history_at(self, idx):
+        if self._history_slots[idx] < 0:
+            raise ValueError(f'Frame {idx} is not kept by the history retention policy')
+        return self._posterior_params_history[self._history_slots[idx]]
+
+    # Retained posterior parameters for frames before n
+    def _posterior_history_until(self, n):
+        return self._posterior_params_history[:np.count_nonzero(self._retention_mask[:n])]
 
 
     def _causality_matrix(self, link_vec, fill_diag=1):
@@ -145,9 +330,9 @@ class Internal_state():
 
 # Internal state using a discrete probability distribution to represent the external states
 class Discrete_IS(Internal_state):
-    def __init__(self, N, K, links, dt, update_func, update_func_args=[], generate_sample_space=True, sample_params=True, prior_param=None, smoothing=0):
+    def __init__(self, N, K, links, dt, update_func, update_func_args=[], generate_sample_space=True, sample_params=True, prior_param=None, smoothing=0, history_dtype=np.float64, retention='full'):
 
-        super().__init__(N, K, update_func, update_func_args=update_func_args, prior_param=prior_param)
+        super().__init__(N, K, update_func, update_func_args=update_func_args, prior_param=prior_param, history_dtype=history_dtype, retention=retention)
 
         self._num_links = len(links)
         self._dt = dt
@@ -181,65 +366,65 @@ class Discrete_IS(Internal_state):
         
 
     # Properties
-    @property
+    @memoised_property
     def posterior(self):
         posterior = self._likelihood(self._posterior_params)
         smoothed_posterior = self._smooth_softmax(posterior)
         return smoothed_posterior
 
-    @property
+    @memoised_property
     def posterior_unsmoothed(self):
         return self._likelihood(self._posterior_params)
 
-    @property
+    @memoised_property
     def posterior_over_links(self):
         if len(self.posterior.shape) == 1:
             return self._models_to_links(self.posterior)
         else:
             return self.posterior
 
-    @property
+    @memoised_property
     def posterior_over_models(self):
         if len(self.posterior.shape) == 1:
             return self.posterior
         else:
             return self._links_to_models(self.posterior) 
         
-    @property
+    @memoised_property
     def posterior_over_links_unsmoothed(self):
         if len(self.posterior.shape) == 1:
             return self._models_to_links(self.posterior_unsmoothed)
         else:
             return self.posterior_unsmoothed
 
-    @property
+    @memoised_property
     def posterior_over_models_unsmoothed(self):
         if len(self.posterior.shape) == 1:
             return self.posterior_unsmoothed
         else:
             return self._links_to_models(self.posterior_unsmoothed) 
 
-    @property
+    @memoised_property
     def MAP(self):
         graph_idx = np.argmax(self.posterior_over_models)
         return self._sample_space[graph_idx]
     
-    @property
+    @memoised_property
     def MAP_unsmoothed(self):
         graph_idx = np.argmax(self.posterior_over_models_unsmoothed)
         return self._sample_space[graph_idx]
     
-    @property
+    @memoised_property
     def MAP_weighted(self):
         links = np.tile(self._L, (self._K**2 - self._K, 1))
         weighted_links = links * self.posterior_over_links_unsmoothed
         return np.round(weighted_links.sum(axis=1), 2)
 
-    @property
+    @memoised_property
     def posterior_entropy(self):
         return self._entropy(self.posterior_over_models)
 
-    @property
+    @memoised_property
     def posterior_entropy_unsmoothed(self):
         if len(self.posterior_unsmoothed.shape) == 1:
             return self._entropy(self.posterior_unsmoothed)
@@ -254,31 +439,31 @@ class Discrete_IS(Internal_state):
     def prior_entropy_over_links(self):
         return self._prior_entropy_links
 
-    @property
+    @memoised_property
     def posterior_entropy_over_links(self):
         return self._entropy(self.posterior_over_links)
     
-    @property
+    @memoised_property
     def posterior_entropy_over_links_unsmoothed(self):
         return self._entropy(self.posterior_over_links_unsmoothed)
     
     @property
     def entropy_history(self):
-        posterior_history = self._likelihood(self._posterior_params_history[:self._n])
+        posterior_history = self._likelihood(self._posterior_history_until(self._n))
         return self._entropy(posterior_history)
 
     @property
     def entropy_history_links(self):
-        if (self._posterior_params.shape) == 2:
-            posterior_history = self._likelihood(self._posterior_params_history[:self._n])
+        if len(self._posterior_params.shape) == 2:
+            posterior_history = self._likelihood(self._posterior_history_until(self._n))
         else:
-            posterior_history = np.array([self._models_to_links(self._likelihood(posterior)) for posterior in self._posterior_params_history[:self._n]])
+            posterior_history = self._models_to_links(self._likelihood(self._posterior_history_until(self._n)).reshape((-1, self._indexed_space.shape[0])))
         entropy = self._entropy(posterior_history, keepdim=True)
         return entropy
 
     # Return a posterior over model for the given index between 0 and N
     def posterior_over_models_byidx(self, idx):
-        posterior = self._likelihood(self._posterior_params_history[idx])
+        posterior = self._likelihood(self._posterior_history_at(idx))
         if len(self.posterior.shape) == 1:
             return self._smooth(posterior)
         else:
@@ -350,13 +535,14 @@ class Discrete_IS(Internal_state):
     def _likelihood(self, log_likelihood):
         if isinstance(log_likelihood, list):
             LL = np.array(log_likelihood[0:self._n+1])
-            # Case where likelihood is 2 dimensional (LC) and we want the whole history
-            if len(LL.shape) == 3: 
-                LL_n = LL - np.amax(LL, axis=2).reshape((LL.shape[0], LL.shape[1], 1))
-                return np.squeeze(np.exp(LL_n) / np.sum(np.exp(LL_n), axis=2).reshape((LL.shape[0], LL.shape[1], 1)))
         else:
             LL = log_likelihood
 
+        # Case where likelihood is 2 dimensional (LC) and we want the whole history
+        if len(LL.shape) == 3: 
+            LL_n = LL - np.amax(LL, axis=2).reshape((LL.shape[0], LL.shape[1], 1))
+            return np.squeeze(np.exp(LL_n) / np.sum(np.exp(LL_n), axis=2).reshape((LL.shape[0], LL.shape[1], 1)))
+
         if len(LL.shape) == 1:
             LL = LL.reshape(1, LL.shape[0])
         LL_n = LL - np.amax(LL, axis=1).reshape(LL.shape[0], 1)
@@ -411,12 +597,12 @@ class Discrete_IS(Internal_state):
             return - np.sum(distribution * log_dist, axis=1)
 
 
+    # Works for a single posterior or a whole (T, num_models) history
     def _models_to_links(self, models_probs, intervention=None):
-        s = self._K**2 - self._K
-        links_probs = np.zeros((s, self._num_links))
-        for j in range(s):
-            for k in range(self._num_links):
-                links_probs[j, k] = np.sum(models_probs[self._indexed_space[:,j] == k])
+        if self._marginalisation_index is None:
+            self._marginalisation_index = build_marginalisation_index(self._indexed_space, self._num_links)
+
+        links_probs = models_to_links(models_probs, self._marginalisation_index)
 
         if intervention:
             links_probs[self.causes_idx[intervention], :] = 0 # Not sure yet about value
@@ -424,14 +610,19 @@ class Discrete_IS(Internal_state):
         return links_probs
 
 
-    def _links_to_models(self, links_probs):
-        return links_probs[np.arange(links_probs.shape[0]), self._indexed_space].prod(axis=1)
+    def _links_to_models(self, links_probs, log=False):
+        if log:
+            return links_to_log_models(links_probs, self._indexed_space)
+        else:
+            return links_to_models(links_probs, self._indexed_space)
 
     
     # Sample space related methods
     def add_sample_space_env(self, triple_of_spaces):
         # Add sample space manually
         self._sample_space, self._indexed_space, self._sample_space_as_mat = triple_of_spaces
+        self._marginalisation_index = None
+        self._clear_memo()
 
 
     def _build_space(self, links, as_matrix=False):
@@ -468,11 +659,194 @@ class Discrete_IS(Internal_state):
 
 
 
+# Internal state using a discrete distribution factorised over effect variables
+## The posterior is stored as K independent factors, one per effect variable, over the num_links**(K-1) configurations of its incoming links
+## Exact when the prior and likelihood factorise over effect variables, as is the case for the OU likelihood
+## Memory and time grow with K * num_links**(K-1) instead of num_links**(K**2-K), so no sample space is built
+## Smoothing, when used, is applied within each factor
+class Factorised_DIS(Discrete_IS):
+    def __init__(self, N, K, links, dt, update_func, update_func_args=[], sample_params=True, prior_param=None, smoothing=0, history_dtype=np.float64, retention='full'):
+
+        super().__init__(N, K, links, dt, update_func, update_func_args=update_func_args, generate_sample_space=False, sample_params=sample_params, prior_param=prior_param, smoothing=smoothing, history_dtype=history_dtype, retention=retention)
+
+        self._links = np.array(links)
+
+        # Index of each link in the link vector, links are ordered row wise off the diagonal
+        self._link_matrix_idx = -1 * np.ones((self._K, self._K), dtype=int)
+        self._link_matrix_idx[~np.eye(self._K, dtype=bool)] = np.arange(self._K**2 - self._K)
+
+        # Causes of each effect variable and the corresponding incoming links
+        self._factor_causes = np.array([np.delete(np.arange(self._K), j) for j in range(self._K)])
+        self._factor_links_idx = np.array([self._link_matrix_idx[self._factor_causes[j], j] for j in range(self._K)])
+
+        # Factor space: each configuration of the K-1 incoming links, as indices and values
+        self._factor_shape = (self._num_links,) * (self._K-1)
+        self._factor_indexed_space = np.array(np.unravel_index(np.arange(self._num_links**(self._K-1)), self._factor_shape)).T
+        self._factor_space = self._links[self._factor_indexed_space]
+
+        self._prior_over_links = False
+
+
+    # Properties
+    @memoised_property
+    def posterior(self):
+        return self._smooth_softmax(self._likelihood(self._posterior_params))
+
+    @memoised_property
+    def posterior_unsmoothed(self):
+        return self._likelihood(self._posterior_params)
+
+    @memoised_property
+    def posterior_over_links(self):
+        return self._factors_to_links(self.posterior)
+
+    @memoised_property
+    def posterior_over_links_unsmoothed(self):
+        return self._factors_to_links(self.posterior_unsmoothed)
+
+    # Full joint, only tractable when a sample space has been added
+    @memoised_property
+    def posterior_over_models(self):
+        return self._factors_to_models(self.posterior)
+
+    @memoised_property
+    def posterior_over_models_unsmoothed(self):
+        return self._factors_to_models(self.posterior_unsmoothed)
+
+    @memoised_property
+    def MAP(self):
+        return self._factors_to_graph(np.argmax(self.posterior, axis=1))
+    
+    @memoised_property
+    def MAP_unsmoothed(self):
+        return self._factors_to_graph(np.argmax(self.posterior_unsmoothed, axis=1))
+
+    # Factors are independent, the joint entropy is the sum of the factors' entropies
+    @memoised_property
+    def posterior_entropy(self):
+        return self._entropy(self.posterior).sum()
+
+    @memoised_property
+    def posterior_entropy_unsmoothed(self):
+        return self._entropy(self.posterior_unsmoothed).sum()
+
+    @property
+    def entropy_history(self):
+        posterior_history = self._likelihood(self._posterior_history_until(self._n))
+        return self._entropy(posterior_history.reshape((-1, self._K, self._factor_space.shape[0])), keepdim=True).reshape((-1, self._K)).sum(axis=1)
+
+    @property
+    def entropy_history_links(self):
+        posterior_history = np.array([self._factors_to_links(self._likelihood(posterior)) for posterior in self._posterior_history_until(self._n)])
+        entropy = self._entropy(posterior_history, keepdim=True)
+        return entropy
+
+    # Return a posterior over factors for the given index between 0 and N
+    def posterior_over_models_byidx(self, idx):
+        return self._smooth_softmax(self._likelihood(self._posterior_history_at(idx)))
+
+    # Samples the posterior by sampling each factor independently, the number of samples is given by the size parameter
+    def posterior_sample(self, size=1, uniform=False, as_matrix=False, smoothed=False, probs_return=False):
+        num_configs = self._factor_space.shape[0]
+        if uniform:
+            p = np.ones((self._K, num_configs)) / num_configs
+        elif smoothed:
+            p = self.posterior
+        else:
+            p = self.posterior_unsmoothed
+
+        configs_idx = np.zeros((size, self._K), dtype=int)
+        for j in range(self._K):
+            configs_idx[:, j] = np.random.choice(np.arange(num_configs), size=size, p=p[j, :])
+        probs_idx = p[np.arange(self._K), configs_idx].prod(axis=1)
+
+        graphs = self._factors_to_graph(configs_idx)
+        if as_matrix:
+            graphs = self._graphs_to_matrices(graphs)
+
+        if probs_return:
+            return graphs.squeeze(), probs_idx
+        else:
+            return graphs.squeeze()
+
+    # PMF of the posterior for a given graph, product of the factors' probabilities
+    def posterior_PF(self, graph, log=False):
+        configs_idx = self._graph_to_factors(graph)
+        log_prob = np.log(self.posterior[np.arange(self._K), configs_idx]).sum()
+        if not log:
+            return np.exp(log_prob)
+        else:
+            return log_prob
+
+
+    # Prior initialisation
+    ## Same distance based prior as Discrete_IS, computed link wise so that it factorises
+    def _generate_prior_from_judgement(self, prior_judgement, temperature):
+
+        if type(prior_judgement) == np.ndarray:
+            prior_j = prior_judgement  
+            temp = temperature  
+        else:
+            prior_j = np.zeros(self._K**2 - self._K)
+            temp = 0
+
+        distances = np.abs(self._links.reshape((1, self._num_links)) - prior_j.reshape((prior_j.size, 1)))
+        norm_distances = 1 - distances / distances.max()
+
+        self._prior_over_links = True
+        return self._softmax(norm_distances, temp)
+
+    ## Product of the link marginals into factors, in log space
+    def _local_prior_init(self):
+        if self._prior_over_links:
+            self._prior_params = self._links_to_factors(np.log(self._prior_params))
+            self._prior_over_links = False
+
+
+    # Background methods mapping between factors, links and graphs
+    def _factors_to_links(self, factors_probs):
+        links_probs = np.zeros((self._K**2 - self._K, self._num_links))
+        for j in range(self._K):
+            factor = factors_probs[j, :].reshape(self._factor_shape)
+            for p in range(self._K-1):
+                links_probs[self._factor_links_idx[j, p], :] = factor.sum(axis=tuple(np.delete(np.arange(self._K-1), p)))
+        return links_probs
+
+    def _links_to_factors(self, links_log_probs):
+        return links_log_probs[self._factor_links_idx.reshape((self._K, 1, self._K-1)), self._factor_indexed_space].sum(axis=2)
+
+    def _factors_to_models(self, factors_probs):
+        models_probs = np.ones(self._indexed_space.shape[0])
+        for j in range(self._K):
+            factor_idx = np.ravel_multi_index(self._indexed_space[:, self._factor_links_idx[j]].T, self._factor_shape)
+            models_probs *= factors_probs[j, factor_idx]
+        return models_probs
+
+    ## configs_idx: (..., K) array of configuration indices, one per factor
+    def _factors_to_graph(self, configs_idx):
+        configs_idx = np.array(configs_idx)
+        graphs = np.zeros(configs_idx.shape[:-1] + (self._K**2 - self._K,))
+        for j in range(self._K):
+            graphs[..., self._factor_links_idx[j]] = self._factor_space[configs_idx[..., j]]
+        return graphs
+
+    def _graph_to_factors(self, graph):
+        graph_idx = np.argmax(self._links.reshape((self._num_links, 1)) == np.array(graph).reshape((1, -1)), axis=0)
+        return np.ravel_multi_index(graph_idx[self._factor_links_idx].T, self._factor_shape)
+
+    def _graphs_to_matrices(self, graphs):
+        matrices = np.ones(graphs.shape[:-1] + (self._K, self._K))
+        matrices[..., ~np.eye(self._K, dtype=bool)] = graphs
+        return matrices
+
+
+
+
 # Internal state using a continuous probability distribution to represent the external states
 ## Need to be able to express discrete probability values
 class Continuous_IS(Internal_state):
-    def __init__(self, N, K, links, dt, update_func, update_func_args=[], generate_sample_space=True, sample_params=True, prior_param=None , smoothing=0):
-        super().__init__(N, K, update_func, update_func_args=update_func_args, prior_param=prior_param)
+    def __init__(self, N, K, links, dt, update_func, update_func_args=[], generate_sample_space=True, sample_params=True, prior_param=None , smoothing=0, history_dtype=np.float64, retention='full'):
+        super().__init__(N, K, update_func, update_func_args=update_func_args, prior_param=prior_param, history_dtype=history_dtype, retention=retention)
 
 
         # Smoothing temperature
@@ -517,15 +891,15 @@ class Continuous_IS(Internal_state):
     def posterior_params(self):
         return self._posterior_params
 
-    @property
+    @memoised_property
     def posterior(self):
         return self._smooth(self._posterior_pmf(self._posterior_params))
     
-    @property
+    @memoised_property
     def posterior_over_links(self):
         return self.posterior
 
-    @property
+    @memoised_property
     def posterior_over_models(self):
         return self._links_to_models(self.posterior) 
 
@@ -533,19 +907,19 @@ class Continuous_IS(Internal_state):
     def MAP_continuous(self):
         return self._argmax()
 
-    @property
+    @memoised_property
     def MAP(self):
         graph_idx = np.argmax(self.posterior_over_models)
         return self._sample_space[graph_idx]
 
-    @property
+    @memoised_property
     def posterior_over_links(self):
         if len(self.posterior.shape) == 1:
             return self._models_to_links(self.posterior)
         else:
             return self.posterior
 
-    @property
+    @memoised_property
     def posterior_over_models(self):
         if len(self.posterior.shape) == 1:
             return self.posterior
@@ -560,19 +934,24 @@ class Continuous_IS(Internal_state):
     def prior_entropy_over_links(self):
         return self._prior_entropy_links
     
-    @property
+    @memoised_property
     def posterior_entropy(self):
         return self._entropy(self.posterior_over_links, custom=True)
 
-    @property
+    @memoised_property
     def posterior_entropy_over_links(self):
         return self._entropy(self.posterior_over_links)
     
     @property
     def entropy_history(self):
-        entropy_history = np.zeros(len(self._posterior_params_history))
+        posterior_params_history = self._posterior_history_until(self._n)
+        # Contiguous history, all frames at once
+        if isinstance(posterior_params_history, np.ndarray):
+            return np.atleast_1d(self._entropy(self._posterior_pmf(posterior_params_history)))
+
+        entropy_history = np.zeros(len(posterior_params_history))
         for i in range(entropy_history.size):
-            entropy_history[i] = np.sum(self._entropy(self._posterior_pmf(self._posterior_params_history[i])))  
+            entropy_history[i] = np.sum(self._entropy(self._posterior_pmf(posterior_params_history[i])))  
         return entropy_history
     
     @property
@@ -585,18 +964,19 @@ class Continuous_IS(Internal_state):
 
     @property
     def differential_entropy_history(self):
-        entropy_history = np.zeros(len(self._posterior_params_history))
+        posterior_params_history = self._posterior_history_until(self._n)
+        entropy_history = np.zeros(len(posterior_params_history))
         for i in range(entropy_history.size):
-            entropy_history[i] = np.sum(self._diff_entropy(self._posterior_params_history[i]))
+            entropy_history[i] = np.sum(self._diff_entropy(posterior_params_history[i]))
         return entropy_history
 
 
     # Return a posterior over model for the given index between 0 and N
     def posterior_over_models_byidx(self, idx):
         if len(self.posterior.shape) == 1:
-            return self._smooth(self._posterior_pmf(self._posterior_params_history[idx]))
+            return self._smooth(self._posterior_pmf(self._posterior_history_at(idx)))
         else:
-            return self._links_to_models(self._smooth(self._posterior_pmf(self._posterior_params_history[idx])))
+            return self._links_to_models(self._smooth(self._posterior_pmf(self._posterior_history_at(idx))))
 
 
     # Samples the posterior, the number of samples is given by the size parameter
@@ -686,12 +1066,12 @@ class Continuous_IS(Internal_state):
         return smoothed_values / smoothed_values.sum(axis=1).reshape((dist.shape[0], 1))
 
 
+    # Works for a single posterior or a whole (T, num_models) history
     def _models_to_links(self, models_probs, intervention=None):
-        s = self._K**2 - self._K
-        links_probs = np.zeros((s, self._num_links))
-        for j in range(s):
-            for k in range(self._num_links):
-                links_probs[j, k] = np.sum(models_probs[self._indexed_space[:,j] == k])
+        if self._marginalisation_index is None:
+            self._marginalisation_index = build_marginalisation_index(self._indexed_space, self._num_links)
+
+        links_probs = models_to_links(models_probs, self._marginalisation_index)
 
         if intervention:
             links_probs[self.causes_idx[intervention], :] = 0 # Not sure yet about value
@@ -699,14 +1079,19 @@ class Continuous_IS(Internal_state):
         return links_probs
 
 
-    def _links_to_models(self, links_probs):
-        return links_probs[np.arange(links_probs.shape[0]), self._indexed_space].prod(axis=1)
+    def _links_to_models(self, links_probs, log=False):
+        if log:
+            return links_to_log_models(links_probs, self._indexed_space)
+        else:
+            return links_to_models(links_probs, self._indexed_space)
 
     
     # Sample space related methods
     def add_sample_space_env(self, triple_of_spaces):
         # Add sample space manually
         self._sample_space, self._indexed_space, self._sample_space_as_mat = triple_of_spaces
+        self._marginalisation_index = None
+        self._clear_memo()
 
     def _build_space(self, links, as_matrix=False):
         a = links 
@@ -739,9 +1124,9 @@ class Continuous_IS(Internal_state):
 
 # Internal state using a discrete probability distribution to represent the external states
 class Variational_IS(Internal_state):
-    def __init__(self, N, K, links, dt, parameter_set, update_func, update_func_args=[], factorisation='normative', generate_sample_space=True, prior_param=None, smoothing=0):
+    def __init__(self, N, K, links, dt, parameter_set, update_func, update_func_args=[], factorisation='normative', generate_sample_space=True, prior_param=None, smoothing=0, retention='full'):
 
-        super().__init__(N, K, update_func, update_func_args=update_func_args, prior_param=prior_param)
+        super().__init__(N, K, update_func, update_func_args=update_func_args, prior_param=prior_param, retention=retention)
 
         self.variational = True
         self._num_links = len(links)
@@ -763,9 +1148,17 @@ class Variational_IS(Internal_state):
             if self._parameter_set[name]['type'] == 'no_link':
                 self._link_params_bool[i] = 0
 
+        # Factors are stored packed in a single buffer, factor i is _posterior_params[offsets[i]:offsets[i+1]], see methods.packed_factors_methods
+        ## Link factors all come after the non link factors
+        factor_sizes = [np.size(self._parameter_set[name]['values']) for name in self._param_names_list]
+        self._factor_offsets = np.concatenate(([0], np.cumsum(factor_sizes))).astype(int)
+        self._links_offset = self._factor_offsets[np.argmax(self._link_params_bool)]
+
         self._link_names_matrix = self._construct_link_matrix(K)
 
-        self._param_subsets_dict = self._construct_parameter_subset_dict()
+        # Parameter combination tables, built on first use and shared between instances, see _parameter_subsets_cache
+        ## Only the key is held by the instance, which can then be copied and sent to worker processes
+        self._param_subsets_cache_key = None
 
         # Build representational spaces
         ## if generate sample space == True, build sample space, else, wait for call of the add_sample_space method call
@@ -780,29 +1173,34 @@ class Variational_IS(Internal_state):
         
     # Properties
     # Specific properties
+    @property
+    def _param_subsets_dict(self):
+        if self._param_subsets_cache_key is None:
+            self._param_subsets_cache_key = self._parameter_subsets_key()
+
+        key = self._param_subsets_cache_key
+        if key not in _parameter_subsets_cache:
+            subsets = self._construct_parameter_subset_dict()
+            for table in subsets.values():
+                table.flags.writeable = False
+            _parameter_subsets_cache[key] = MappingProxyType(subsets)
+        return _parameter_subsets_cache[key]
+
     @property
     def variational_posterior(self):
-        ## Qs are the unnormalised log posterior, need to loop over them and take exp and normalise
-        posterior_factors = np.array([self._likelihood(factor) for factor in self._posterior_params], dtype=object)
-        return posterior_factors
+        return self._variational_factors(self._posterior_params)
 
     # Entropy over all parameters
     @property
     def variational_posterior_entropy(self):
-        #posterior_factors_partition = [np.exp(factor).sum() for factor in self._posterior_params]
-        posterior_factors = [self._likelihood(factor) for factor in self._posterior_params]
-        posterior_entropies = np.array([self._entropy(factor) for factor in posterior_factors])
-        return posterior_entropies
+        return segment_entropy(segment_softmax(self._posterior_params, self._factor_offsets), self._factor_offsets)
     
     # Entropy over all parameters
     @property
     def variational_posterior_entropy_history(self):
-        posterior_entropies = np.zeros((self._n, self._num_factors))
-        for i in np.arange(self._n):
-            posterior_factors = [self._likelihood(factor) for factor in self._posterior_params_history[i]]
-            posterior_entropies[i, :] = np.array([self._entropy(factor) for factor in posterior_factors])
-        
-        return posterior_entropies
+        ## History is a (T, total_size) array of packed buffers, normalised in one pass
+        posterior_params_history = self._posterior_history_until(self._n)
+        return segment_entropy(segment_softmax(posterior_params_history, self._factor_offsets), self._factor_offsets)
     
     @property
     def variational_MAP(self):
@@ -825,40 +1223,40 @@ class Variational_IS(Internal_state):
 
     # Standard properties
     # Will only provide a posterior over causal link parameters
-    @property
+    @memoised_property
     def posterior(self):
-        posterior_links = np.vstack(self._posterior_params[self._link_params_bool])
+        posterior_links = self._link_params(self._posterior_params)
         posterior = self._likelihood(posterior_links)
         smoothed_posterior = self._smooth_softmax(posterior)
         return smoothed_posterior
 
-    @property
+    @memoised_property
     def posterior_unsmoothed(self):
-        posterior_links = np.vstack(self._posterior_params[self._link_params_bool])
+        posterior_links = self._link_params(self._posterior_params)
         return self._likelihood(posterior_links)
 
-    @property
+    @memoised_property
     def posterior_over_links(self):
         if len(self.posterior.shape) == 1:
             return self._models_to_links(self.posterior)
         else:
             return self.posterior
     
-    @property
+    @memoised_property
     def posterior_over_links_unsmoothed(self):
         if len(self.posterior.shape) == 1:
             return self._models_to_links(self.posterior_unsmoothed)
         else:
             return self.posterior_unsmoothed
 
-    @property
+    @memoised_property
     def posterior_over_models(self):
         if len(self.posterior.shape) == 1:
             return self.posterior
         else:
             return self._links_to_models(self.posterior) 
     
-    @property
+    @memoised_property
     def posterior_over_models_unsmoothed(self):
         if len(self.posterior_unsmoothed.shape) == 1:
             return self.posterior_unsmoothed
@@ -866,28 +1264,28 @@ class Variational_IS(Internal_state):
             return self._links_to_models(self.posterior_unsmoothed) 
 
 
-    @property
+    @memoised_property
     def MAP(self):
         graph_idx = np.argmax(self.posterior_over_models)
         return self._sample_space[graph_idx]
     
-    @property
+    @memoised_property
     def MAP_unsmoothed(self):
         graph_idx = np.argmax(self.posterior_over_models_unsmoothed)
         return self._sample_space[graph_idx]
     
-    @property
+    @memoised_property
     def MAP_weighted(self):
         links = np.tile(self._L, (self._K**2 - self._K, 1))
         weighted_links = links * self.posterior_over_links_unsmoothed
         map_weighted = weighted_links.sum(axis=1)
         return np.round(map_weighted, 2)
         
-    @property
+    @memoised_property
     def posterior_entropy(self):
         return self._entropy(self.posterior_over_models)
 
-    @property
+    @memoised_property
     def posterior_entropy_unsmoothed(self):
         if len(self.posterior_unsmoothed.shape) == 1:
             return self._entropy(self.posterior_unsmoothed)
@@ -902,30 +1300,30 @@ class Variational_IS(Internal_state):
     def prior_entropy_over_links(self):
         return self._prior_entropy_links
 
-    @property
+    @memoised_property
     def posterior_entropy_over_links(self):
         return self._entropy(self.posterior_over_links)
     
-    @property
+    @memoised_property
     def posterior_entropy_over_links_unsmoothed(self):
         return self._entropy(self.posterior_over_links_unsmoothed)
     
     @property
     def entropy_history(self):
-        link_params_history = [np.vstack(posterior_param[self._link_params_bool]) for posterior_param in self._posterior_params_history[:self._n]]
+        link_params_history = self._link_params(self._posterior_history_until(self._n))
         posterior_history = self._likelihood(link_params_history)
         return self._entropy(posterior_history)
 
     @property
     def entropy_history_links(self):
-        link_params_history = [np.vstack(posterior_param[self._link_params_bool]) for posterior_param in self._posterior_params_history[:self._n]]
+        link_params_history = self._link_params(self._posterior_history_until(self._n))
         posterior_history = self._likelihood(link_params_history)
         entropy = self._entropy(posterior_history, keepdim=True)
         return entropy
 
     # Return a posterior over model for the given index between 0 and N
     def posterior_over_models_byidx(self, idx):
-        log_posterior = np.vstack(self._posterior_params_history[idx][self._link_params_bools])
+        log_posterior = self._link_params(self._posterior_history_at(idx))
         posterior = self._likelihood(log_posterior)
         if len(self.posterior.shape) == 1:
             return self._smooth(posterior)
@@ -994,17 +1392,31 @@ class Variational_IS(Internal_state):
 
         return self._models_to_links(softmax_prior)
 
+    # Background methods for packed factors
+    ## Normalised factors of a packed buffer of log factors, as an object array of views
+    def _variational_factors(self, packed_params):
+        posterior_factors = np.empty(self._num_factors, dtype=object)
+        for i, factor in enumerate(unpack_factors(segment_softmax(packed_params, self._factor_offsets), self._factor_offsets)):
+            posterior_factors[i] = factor
+        return posterior_factors
+
+    ## Log link factors of a packed (..., total_size) buffer as a (..., num_link_vars, num_links) array
+    def _link_params(self, packed_params):
+        return packed_params[..., self._links_offset:].reshape(packed_params.shape[:-1] + (self._K**2 - self._K, self._L.size))
+
+
     # Background methods for likelihood and sampling for discrete distributions
     def _likelihood(self, log_likelihood):
         if isinstance(log_likelihood, list):
             LL = np.array(log_likelihood[0:self._n+1])
-            # Case where likelihood is 2 dimensional (LC) and we want the whole history
-            if len(LL.shape) == 3: 
-                LL_n = LL - np.amax(LL, axis=2).reshape((LL.shape[0], LL.shape[1], 1))
-                return np.squeeze(np.exp(LL_n) / np.sum(np.exp(LL_n), axis=2).reshape((LL.shape[0], LL.shape[1], 1)))
         else:
             LL = log_likelihood
 
+        # Case where likelihood is 2 dimensional (LC) and we want the whole history
+        if len(LL.shape) == 3: 
+            LL_n = LL - np.amax(LL, axis=2).reshape((LL.shape[0], LL.shape[1], 1))
+            return np.squeeze(np.exp(LL_n) / np.sum(np.exp(LL_n), axis=2).reshape((LL.shape[0], LL.shape[1], 1)))
+
         if len(LL.shape) == 1:
             LL = LL.reshape(1, LL.shape[0])
         LL_n = LL - np.amax(LL, axis=1).reshape(LL.shape[0], 1)
@@ -1059,12 +1471,12 @@ class Variational_IS(Internal_state):
             return - np.sum(distribution * log_dist, axis=1)
 
 
+    # Works for a single posterior or a whole (T, num_models) history
     def _models_to_links(self, models_probs, intervention=None):
-        s = self._K**2 - self._K
-        links_probs = np.zeros((s, self._num_links))
-        for j in range(s):
-            for k in range(self._num_links):
-                links_probs[j, k] = np.sum(models_probs[self._indexed_space[:,j] == k])
+        if self._marginalisation_index is None:
+            self._marginalisation_index = build_marginalisation_index(self._indexed_space, self._num_links)
+
+        links_probs = models_to_links(models_probs, self._marginalisation_index)
 
         if intervention:
             links_probs[self.causes_idx[intervention], :] = 0 # Not sure yet about value
@@ -1072,14 +1484,19 @@ class Variational_IS(Internal_state):
         return links_probs
 
 
-    def _links_to_models(self, links_probs):
-        return links_probs[np.arange(links_probs.shape[0]), self._indexed_space].prod(axis=1)
+    def _links_to_models(self, links_probs, log=False):
+        if log:
+            return links_to_log_models(links_probs, self._indexed_space)
+        else:
+            return links_to_models(links_probs, self._indexed_space)
 
 
     # Sample space related methods
     def add_sample_space_env(self, triple_of_spaces):
         # Add sample space manually
         self._sample_space, self._indexed_space, self._sample_space_as_mat = triple_of_spaces
+        self._marginalisation_index = None
+        self._clear_memo()
 
     def _build_space(self, links, as_matrix=False):
         a = links 
@@ -1192,6 +1609,12 @@ class Variational_IS(Internal_state):
         return S
 
 
+    ## Key of the parameter combination tables in _parameter_subsets_cache
+    def _parameter_subsets_key(self):
+        grids = tuple((name, tuple(np.asarray(self._parameter_set[name]['values']).tolist())) for name in self._param_names_list[~self._link_params_bool])
+        return (self._K, tuple(np.asarray(self._L).tolist()), grids, self._factorisation)
+
+
     """
     Constructs a dictionary
     keys: the relevant parameter subsets needed for update as stringified lists
@@ -4,8 +4,12 @@ import numpy as np
 
 # Local computation discrete agent
 class Local_computations_interfocus_DIS(Discrete_IS):
-    def __init__(self, N, K, links, dt, theta, sigma, decay_type, decay_rate=0.65, evidence_weight=1, generate_sample_space=True, sample_params=False, prior_param=None, smoothing=False):
-        super().__init__(N, K, links, dt, self._update_rule, generate_sample_space=generate_sample_space, sample_params=sample_params, prior_param=prior_param, smoothing=smoothing)
+    replays_trials = True
+    # Attention and schedule state read back by the next update, see Internal_state.fingerprint
+    _fingerprint_attributes = ('_last_obs', '_last_action', '_last_action_len', '_last_instant_action', '_last_action_idx', '_last_action_end')
+
+    def __init__(self, N, K, links, dt, theta, sigma, decay_type, decay_rate=0.65, evidence_weight=1, generate_sample_space=True, sample_params=False, prior_param=None, smoothing=False, history_dtype=np.float64, retention='full'):
+        super().__init__(N, K, links, dt, self._update_rule, generate_sample_space=generate_sample_space, sample_params=sample_params, prior_param=prior_param, smoothing=smoothing, history_dtype=history_dtype, retention=retention)
 
                 # Sample parameter estimates
         if sample_params:
@@ -25,6 +29,9 @@ class Local_computations_interfocus_DIS(Discrete_IS):
         # Special parameters for faster computations
         self._links_lc_updates = np.tile(links.reshape((links.size, 1)), 3).T
 
+        # Cause and effect variable of each link, links are ordered row wise off the diagonal
+        self._link_causes, self._link_effects = np.where(~np.eye(self._K, dtype=bool))
+
         # Define own attractor mu, should be mu for each given the other two
         self._mus = self._attractor_mu(np.zeros(self._K))
         self._mus_history = [None for i in range(self._N)]
@@ -62,137 +69,189 @@ class Local_computations_interfocus_DIS(Discrete_IS):
         
         obs = sensory_state.s
         
-        
-        
+        # If fitting, attention follows the real action, else the sampled one
         if action_state.realised:
+            action = action_state.a_real
+            action_len = action_state.a_len_real if action else None
+        else:
+            action = intervention
+            action_len = action_state.a_len
+
+        if not self._focus_step(action, action_len, action_state.realised):
+            self._last_obs = obs
+            self._last_instant_action = action
+            return self._posterior_params
+    
+        # Logic for updating
+        # Compute power update coefficient
+
+        delay = self._last_action_len
+        power_coef = self._power_update_coef(delay)
+        self._power_update_coef_history[self._n] = power_coef
+
+        focus = self._last_action[0] if self._varfocus else np.nan
+        inter_var = intervention[0] if isinstance(intervention, tuple) else np.nan
+        log_likelihood_per_link = self._link_log_likelihoods(obs.reshape((1, self._K)), 
+                                                             self._mus.reshape((1,) + self._mus.shape), 
+                                                             np.array([power_coef]), 
+                                                             np.array([focus]), 
+                                                             np.array([inter_var]))[0]
+        
+        # Posterior params is the log likelihood of each model given the data
+        log_posterior = self._posterior_params + log_likelihood_per_link
+
+        # update mus
+        self._update_mus(obs)
+
+        self._last_obs = obs
+        self._end_step(action)
+
+        return log_posterior
+
+
+    # Whole trial replay from the sensory and action histories, see Local_computations_omniscient_DIS.replay_trial
+    ## Realised actions drive the attention, change summaries are not read
+    def replay_trial(self, observations, observations_alt, interventions, actions):
+        return self.replay(observations, interventions, actions)
+
+    # Replay a whole realised trial in one pass, step wise update is kept for closed loop runs
+    ## observations: (T+1, K) array, first row is the observation preceding the first update (zeros at trial start, as in Sensory_state)
+    ## interventions: (T,) array of the variable intervened upon at each update, nan when idle
+    ## actions: realised actions as loaded in the action state, the real action at update t is actions[t]
+    ## The attention state is a scalar state machine stepped over the trial, likelihoods are then computed in one pass
+    ## Equivalent to T calls to update, returns the log probability of the judgements at each update
+    def replay(self, observations, interventions, actions):
+        T = observations.shape[0] - 1
+        start = self._n
+
+        # Length of the run of consecutive frames acting on the same variable, as Action_state._get_action_len
+        acting = ~np.isnan(actions)
+        run_idx = np.cumsum(np.concatenate(([True], actions[1:] != actions[:-1]))) - 1
+        run_len = np.bincount(run_idx)[run_idx]
+
+        updated = np.zeros(T, dtype=bool)
+        power_coefs = np.zeros(T)
+        focus = np.full(T, np.nan)
+        mus_source = np.zeros(T, dtype=int) # Row of observations the attractors at each update derive from
+        last_source = 0
+        for t in range(T):
+            self._n = start + t
+            if acting[self._n]:
+                action = (int(actions[self._n]), observations[t, int(actions[self._n])])
+                action_len = int(run_len[self._n])
+            else:
+                action = None
+                action_len = None
+
+            if not self._focus_step(action, action_len, True):
+                self._last_instant_action = action
+                continue
+
+            updated[t] = True
+            power_coefs[t] = self._power_update_coef(self._last_action_len)
+            self._power_update_coef_history[self._n] = power_coefs[t]
+            if self._varfocus:
+                focus[t] = self._last_action[0]
+
+            mus_source[t] = last_source
+            last_source = t + 1
+
+            self._end_step(action)
+
+        self._n = start
+        self._last_obs = observations[-1, :]
+
+        # Attractors and likelihoods for every update at once, no evidence where no update is made
+        mus = self._attractor_mu(observations[mus_source, :])
+        log_likelihoods = self._link_log_likelihoods(observations[1:, :], mus, power_coefs, focus, interventions)
+        log_likelihoods[~updated] = 0
+
+        # Posterior after each update, accumulated in the same order as step wise updates
+        log_posteriors = np.cumsum(np.concatenate((self._posterior_params.reshape((1,) + self._posterior_params.shape), log_likelihoods)), axis=0)[1:]
+
+        for t in np.where(updated)[0]:
+            self._mus_history[start+t] = mus[t]
+        if updated.any():
+            self._mus = self._attractor_mu(observations[last_source, :])
+
+        return self._replay_updates(log_posteriors)
+
+
+    # Attention state machine, returns False when no update is made at this step
+    ## action: real action if fitting, sampled action otherwise
+    def _focus_step(self, action, action_len, realised):
+        if realised:
             # If fitting, check between fit and real action
             if self._decay_type in ['partial', 'total']:
-                if action_state.a_real:
-                    self._last_action = action_state.a_real
-            elif (not self._last_action and not action_state.a_real) or self._n == 0:
-                self._last_obs = obs
-                self._last_instant_action = action_state.a_real
-                return self._posterior_params
-
-            elif not self._last_action and action_state.a_real:
+                if action:
+                    self._last_action = action
+            elif (not self._last_action and not action) or self._n == 0:
+                return False
+
+            elif not self._last_action and action:
                 # First action
-                self._last_action_len = action_state.a_len_real      
+                self._last_action_len = action_len      
                 # Reset last action index
                 self._last_action_idx = 0
                 self._last_action_end = None
 
-                self._last_action = action_state.a_real
+                self._last_action = action
         
-            elif self._last_action and action_state.a_real:
+            elif self._last_action and action:
                 if not self._last_instant_action:
                     # CHANGE OF ACTION
                     # Action length is
-                    self._last_action_len = action_state.a_len_real      
+                    self._last_action_len = action_len      
                     # Reset last action index
                     self._last_action_idx = 0
                     self._last_action_end = None 
 
-                    self._last_action = action_state.a_real
+                    self._last_action = action
 
-            elif self._last_instant_action and not action_state.a_real:
+            elif self._last_instant_action and not action:
                 # Stopped acting
                 self._last_action_end = 1               
     
         else:
             # If generating data
             if self._decay_type in ['partial', 'total']:
-                if intervention:
-                    self._last_action = intervention
-            elif (not self._last_action and not intervention) or self._n == 0:
-                self._last_obs = obs
-                self._last_instant_action = intervention
-                return self._posterior_params
-            elif not self._last_action and intervention:
+                if action:
+                    self._last_action = action
+            elif (not self._last_action and not action) or self._n == 0:
+                return False
+            elif not self._last_action and action:
                 # Action length is
-                self._last_action_len = action_state.a_len     
+                self._last_action_len = action_len     
                 # Reset last action index
                 self._last_action_idx = 0
                 self._last_action_end = None
 
-                self._last_action = intervention
+                self._last_action = action
 
-            elif self._last_action and intervention:
-                if self._last_action != intervention:
+            elif self._last_action and action:
+                if self._last_action != action:
                     # Action length is
-                    self._last_action_len = action_state.a_len     
+                    self._last_action_len = action_len     
                     # Reset last action index
                     self._last_action_idx = 0
                     self._last_action_end = None
 
-                self._last_action = intervention
+                self._last_action = action
                 
   
-            elif self._last_instant_action and not intervention:
+            elif self._last_instant_action and not action:
                 # Stopped acting
                 self._last_action_end = 1  
 
-    
-        # Logic for updating
-        # Compute power update coefficient
-
-        delay = self._last_action_len
-        power_coef = self._power_update_coef(delay)
-        self._power_update_coef_history[self._n] = power_coef
-
-        log_likelihood_per_link = np.zeros(self._posterior_params.shape)
-        idx = 0
-        for i in range(self._K):
-            for j in range(self._K):
-                if i != j:
-                    if self._varfocus:
-                        if j == self._last_action[0] or i != self._last_action[0]:
-                            log_likelihood_per_link[idx, :] = np.zeros(self._L.size)
-                       
-                        else:
-                            # Likelihood of observed the new values given the previous values for each model
-                            log_likelihood = self._evidence_weight * power_coef * stats.norm.logpdf(obs[j], loc=self._mus[idx, :], scale=self._sigma*np.sqrt(self._dt))
-                            # Normalisation step
-                            likelihood_log = log_likelihood - np.amax(log_likelihood)
-                            #likelihood_norm = np.exp(likelihood_log) / np.exp(likelihood_log).sum()
-
-                            #log_likelihood_per_link[idx, :] = np.log(likelihood_norm)
-                            log_likelihood_per_link[idx, :] = likelihood_log
-                            a = 1
-                    else:
-                        # Likelihood of observed the new values given the previous values for each model
-                        log_likelihood = self._evidence_weight * power_coef * stats.norm.logpdf(obs[j], loc=self._mus[idx, :], scale=self._sigma*np.sqrt(self._dt))
-                        # Normalisation step
-                        likelihood_log = log_likelihood - np.amax(log_likelihood)
-                        likelihood_norm = np.exp(likelihood_log) / np.exp(likelihood_log).sum()
-
-                        ## If intervention, the probability of observing the new values is set to 1
-                        if isinstance(intervention, tuple):
-                            if j == intervention[0]:
-                                likelihood_norm[:] = 1
-
-                        log_likelihood_per_link[idx, :] = np.log(likelihood_norm)
-
-                    idx += 1
-        
-        # Posterior params is the log likelihood of each model given the data
-        log_posterior = self._posterior_params + log_likelihood_per_link
-
-        # update mus
-        self._update_mus(obs)
+        return True
 
-        self._last_obs = obs
+    # Attention bookkeeping once an update is made
+    def _end_step(self, action):
         self._last_action_idx += 1
 
-        if action_state.realised:
-            if not self._last_instant_action and not action_state.a_real and self._decay_type not in ['total', 'partial']:
-                self._last_action_end += 1
-            self._last_instant_action = action_state.a_real
-        else:
-            if not self._last_instant_action and not intervention and self._decay_type not in ['total', 'partial']:
-                self._last_action_end += 1
-            self._last_instant_action = intervention
-
-        return log_posterior
+        if not self._last_instant_action and not action and self._decay_type not in ['total', 'partial']:
+            self._last_action_end += 1
+        self._last_instant_action = action
 
 
     # Background methods
@@ -234,16 +293,35 @@ class Local_computations_interfocus_DIS(Discrete_IS):
         self._mus = self._attractor_mu(obs)
 
     
+    ## obs: (K,) for a single frame or (T, K) for a whole trial, returns (..., num_link_vars, num_links)
     def _attractor_mu(self, obs):
         mu_self = obs * (1 - np.abs(obs) / 100)
-        mu_att = obs.reshape((self._K, 1)) * self._links_lc_updates
+        obs_effects = obs[..., self._link_effects, np.newaxis]
+        mu_att = obs[..., self._link_causes, np.newaxis] * self._links_lc_updates[self._link_causes]
+
+        mus = obs_effects + (mu_att + mu_self[..., self._link_effects, np.newaxis] - obs_effects) * self._dt * self._theta
+
+        return mus
+
+
+    # Normalised log likelihood of each link value for a batch of updates
+    ## obs: (T, K), mus: (T, num_link_vars, num_links), power_coefs: (T,) attention coefficients
+    ## focus: (T,) variable in focus, only its outgoing links are updated (nan when attention is not variable specific)
+    ## interventions: (T,) intervened variable, nan when idle
+    def _link_log_likelihoods(self, obs, mus, power_coefs, focus, interventions):
+        # Likelihood of observed the new values given the previous values for each link value
+        log_likelihood = self._evidence_weight * power_coefs.reshape((-1, 1, 1)) * stats.norm.logpdf(obs[:, self._link_effects, np.newaxis], loc=mus, scale=self._sigma*np.sqrt(self._dt))
+        # Normalisation step
+        likelihood_log = log_likelihood - np.amax(log_likelihood, axis=2, keepdims=True)
+
+        if self._varfocus:
+            # Links not going out of the variable in focus are not updated
+            likelihood_log[self._link_causes != focus.reshape((-1, 1))] = 0
+            return likelihood_log
+        else:
+            likelihood_norm = np.exp(likelihood_log) / np.exp(likelihood_log).sum(axis=2, keepdims=True)
 
-        mus = np.zeros((self._K**2 - self._K, self._L.size))
-        idx = 0
-        for i in range(self._K):
-            for j in range(self._K):
-                if i != j:
-                    mus[idx, :] = obs[j] + (mu_att[i, :] + mu_self[j] - obs[j]) * self._dt * self._theta
-                    idx += 1
+            ## If intervention, the probability of observing the new values is set to 1
+            likelihood_norm[self._link_effects == interventions.reshape((-1, 1))] = 1
 
-        return mus
\ No newline at end of file
+            return np.log(likelihood_norm)
@@ -6,8 +6,9 @@ import numpy as np
 
 # Local computations continuous agent
 class Local_computations_omniscient_CIS(Continuous_IS):
-    def __init__(self, N, K, links, dt, theta, sigma, generate_sample_space=True, sample_params=False, prior_param=None, smoothing=0):
-        super().__init__(N, K, links, dt, self._update_rule, generate_sample_space=generate_sample_space, sample_params=sample_params, prior_param=prior_param, smoothing=smoothing)
+    replays_trials = True
+    def __init__(self, N, K, links, dt, theta, sigma, generate_sample_space=True, sample_params=False, prior_param=None, smoothing=0, history_dtype=np.float64, retention='full'):
+        super().__init__(N, K, links, dt, self._update_rule, generate_sample_space=generate_sample_space, sample_params=sample_params, prior_param=prior_param, smoothing=smoothing, history_dtype=history_dtype, retention=retention)
 
         # Sample parameter estimates
         if sample_params:
@@ -23,40 +24,75 @@ class Local_computations_omniscient_CIS(Continuous_IS):
 
         self._last_obs = np.zeros(self._K)
 
+        # Cause and effect variable of each link, links are ordered row wise off the diagonal
+        self._link_causes, self._link_effects = np.where(~np.eye(self._K, dtype=bool))
+
 
     def _update_rule(self, sensory_state, action_state):
         intervention = action_state.a
         obs = sensory_state.s
 
-        new_params = np.zeros(self._posterior_params.shape)
-
         mu_self = self._last_obs * (1 - np.abs(self._last_obs) / 100)
 
-        idx = 0
-        for i in range(self._K):
-            for j in range(self._K):
-                if i != j:
-                    mean_prev = self._posterior_params[idx, 0]
-                    sd_prev = self._posterior_params[idx, 1]
-
-                    if isinstance(intervention, tuple):
-                        if j == intervention[0]:
-                            sd = sd_prev
-                            mean = mean_prev
-                            new_params[idx, :] = [mean, sd]
-                            idx += 1
-                            continue
-                    
-                    sd = (self._last_obs[i]**2 / self._dt + 1 / sd_prev**2)**(-1/2)
-                    mean = sd**2 * (self._last_obs[i]*(obs[j] - mu_self[j]) / self._dt + mean_prev / sd_prev**2)
-
-                    new_params[idx, :] = [mean, sd]
-                    idx += 1    
+        mean_prev = self._posterior_params[:, 0]
+        sd_prev = self._posterior_params[:, 1]
+
+        # Gaussian conjugate update of every link at once
+        last_obs_causes = self._last_obs[self._link_causes]
+        sd = (last_obs_causes**2 / self._dt + 1 / sd_prev**2)**(-1/2)
+        mean = sd**2 * (last_obs_causes*(obs[self._link_effects] - mu_self[self._link_effects]) / self._dt + mean_prev / sd_prev**2)
+
+        new_params = np.array([mean, sd]).T
+
+        # If intervention, links into the intervened variable are not updated
+        if isinstance(intervention, tuple):
+            intervened = self._link_effects == intervention[0]
+            new_params[intervened, :] = self._posterior_params[intervened, :]
 
         self._last_obs = obs    
 
         return new_params
 
+
+    # Closed form posterior over a whole realised trial
+    ## The update is conjugate, precisions and precision weighted means are sums over non intervened frames:
+    ##     1/sd_t^2 = 1/sd_0^2 + sum_s last_obs[i]^2 / dt
+    ##     mean_t/sd_t^2 = mean_0/sd_0^2 + sum_s last_obs[i] * (obs[j] - mu_self[j]) / dt
+    ### observations: (T+1, K) array, first row is the observation preceding the first update (zeros at trial start, as in Sensory_state)
+    ### interventions: (T,) array of the variable intervened upon at each update, nan when idle
+    ## Returns the (T, num_link_vars, 2) means and standard deviations after each update
+    def batch_posterior_params(self, observations, interventions):
+        last_obs = observations[:-1, :]
+        obs = observations[1:, :]
+        mu_self = last_obs * (1 - np.abs(last_obs) / 100)
+
+        # Links into the intervened variable are not updated
+        mask = self._link_effects != interventions.reshape((-1, 1))
+
+        last_obs_causes = last_obs[:, self._link_causes]
+        precision_steps = mask * last_obs_causes**2 / self._dt
+        weighted_mean_steps = mask * last_obs_causes * (obs[:, self._link_effects] - mu_self[:, self._link_effects]) / self._dt
+
+        precision_prev = 1 / self._posterior_params[:, 1]**2
+        precision = precision_prev + np.cumsum(precision_steps, axis=0)
+        mean = (self._posterior_params[:, 0] * precision_prev + np.cumsum(weighted_mean_steps, axis=0)) / precision
+
+        return np.stack((mean, precision**(-1/2)), axis=2)
+
+
+    # Whole trial replay from the sensory and action histories, see Local_computations_omniscient_DIS.replay_trial
+    ## Change summaries and realised actions are not read
+    def replay_trial(self, observations, observations_alt, interventions, actions):
+        return self.replay(observations, interventions)
+
+    # Replay a whole realised trial with the closed form posterior, step wise update is kept for closed loop runs
+    ## Same arguments as batch_posterior_params, returns the log probability of the judgements at each update
+    def replay(self, observations, interventions):
+        posterior_params_steps = self.batch_posterior_params(observations, interventions)
+        self._last_obs = observations[-1, :]
+
+        return self._replay_updates(posterior_params_steps)
+
     ## Prior initialisation specific to model:
     def _local_prior_init(self):
         pass
@@ -82,12 +118,13 @@ class Local_computations_omniscient_CIS(Continuous_IS):
         return stats.norm.entropy(scale=parameters[:, 1])
 
 
+    ## params: (num_link_vars, 2) or (T, num_link_vars, 2) for a whole history
     def _posterior_pmf(self, params):
-        means = params[:, 0].reshape((params.shape[0], 1))
-        sds = params[:, 1].reshape((params.shape[0], 1))
+        means = params[..., 0, np.newaxis]
+        sds = params[..., 1, np.newaxis]
 
         discrete_pmf = stats.norm.cdf(self._L + self._interval, loc=means, scale=sds) - stats.norm.cdf(self._L - self._interval, loc=means, scale=sds)
-        discrete_pmf_norm = discrete_pmf / discrete_pmf.sum(axis=1).reshape((means.shape))
+        discrete_pmf_norm = discrete_pmf / discrete_pmf.sum(axis=-1, keepdims=True)
 
         return discrete_pmf_norm
 
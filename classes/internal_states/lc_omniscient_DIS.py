@@ -4,8 +4,11 @@ import numpy as np
 
 # Local computation discrete agent
 class Local_computations_omniscient_DIS(Discrete_IS):
-    def __init__(self, N, K, links, dt, theta, sigma, evidence_weight=1, generate_sample_space=True, sample_params=False, prior_param=None, smoothing=False):
-        super().__init__(N, K, links, dt, self._update_rule, generate_sample_space=generate_sample_space, sample_params=sample_params, prior_param=prior_param, smoothing=smoothing)
+    replays_trials = True
+    supports_batched_rollouts = True
+
+    def __init__(self, N, K, links, dt, theta, sigma, evidence_weight=1, generate_sample_space=True, sample_params=False, prior_param=None, smoothing=False, history_dtype=np.float64, retention='full'):
+        super().__init__(N, K, links, dt, self._update_rule, generate_sample_space=generate_sample_space, sample_params=sample_params, prior_param=prior_param, smoothing=smoothing, history_dtype=history_dtype, retention=retention)
 
         # Sample parameter estimates
         if sample_params:
@@ -25,6 +28,9 @@ class Local_computations_omniscient_DIS(Discrete_IS):
         # Special parameters for faster computations
         self._links_lc_updates = np.tile(links.reshape((links.size, 1)), 3).T
 
+        # Cause and effect variable of each link, links are ordered row wise off the diagonal
+        self._link_causes, self._link_effects = np.where(~np.eye(self._K, dtype=bool))
+
         # Define own attractor mu, should be mu for each given the other two
         self._mus = self._attractor_mu(np.zeros(self._K))
         self._mus_history = [None for i in range(self._N)]
@@ -37,31 +43,8 @@ class Local_computations_omniscient_DIS(Discrete_IS):
         obs = sensory_state.s
 
         # Logic for updating
-        log_likelihood_per_link = np.zeros(self._posterior_params.shape)
-        idx = 0
-        for i in range(self._K):
-            for j in range(self._K):
-                if i != j:
-                    # Likelihood of observed the new values given the previous values for each model
-                    log_likelihood = self._evidence_weight * stats.norm.logpdf(obs[j], loc=self._mus[idx, :], scale=self._sigma*np.sqrt(self._dt))
-                    # Normalisation step
-                    likelihood_log = log_likelihood - np.amax(log_likelihood)
-                    #likelihood_norm = np.exp(likelihood_log) / np.exp(likelihood_log).sum()
-
-                    ### If intervention, the probability of observing the new values is set to 1
-                    #if isinstance(intervention, tuple):
-                    #    if j == intervention[0]:
-                    #        likelihood_norm[:] = 1
-
-                    #log_likelihood_per_link[idx, :] = np.log(likelihood_norm)
-
-                    # If intervention, the probability of observing the new values is set to 1
-                    if isinstance(intervention, tuple):
-                        if j == intervention[0]:
-                            likelihood_log[:] = 0
-
-                    log_likelihood_per_link[idx, :] = likelihood_log
-                    idx += 1
+        inter_var = np.array([intervention[0] if isinstance(intervention, tuple) else np.nan])
+        log_likelihood_per_link = self._link_log_likelihoods(obs.reshape((1, self._K)), self._mus.reshape((1,) + self._mus.shape), inter_var)[0]
         
         # Posterior params is the log likelihood of each model given the data
         log_posterior = self._posterior_params + log_likelihood_per_link
@@ -71,6 +54,60 @@ class Local_computations_omniscient_DIS(Discrete_IS):
 
         return log_posterior
 
+
+    # Whole trial replay from the sensory and action histories, see Experiment.fit
+    ## observations, observations_alt: (T+1, K) arrays as recorded by the sensory state, first row is the observation preceding the first update
+    ## interventions: (T,) array of the variable intervened upon at each update, nan when idle
+    ## actions: realised actions as loaded in the action state
+    ## Equivalent to T calls to update, returns the log probability of the judgements at each update
+    ### Change summaries and realised actions are not read
+    def replay_trial(self, observations, observations_alt, interventions, actions):
+        return self.replay(observations, interventions)
+
+    # Replay a whole realised trial in one pass, step wise update is kept for closed loop runs
+    ## observations: (T+1, K) array, first row is the observation preceding the first update (zeros at trial start, as in Sensory_state)
+    ## interventions: (T,) array of the variable intervened upon at each update, nan when idle
+    ## Equivalent to T calls to update, returns the log probability of the judgements at each update
+    def replay(self, observations, interventions):
+        T = observations.shape[0] - 1
+
+        # Attractors for every update at once
+        mus = self._attractor_mu(observations[:-1, :])
+        log_likelihoods = self._link_log_likelihoods(observations[1:, :], mus, interventions)
+
+        # Posterior after each update, accumulated in the same order as step wise updates
+        log_posteriors = np.cumsum(np.concatenate((self._posterior_params.reshape((1,) + self._posterior_params.shape), log_likelihoods)), axis=0)[1:]
+
+        for t in range(T):
+            self._mus_history[self._n+t] = mus[t]
+        self._mus = self._attractor_mu(observations[-1, :])
+
+        return self._replay_updates(log_posteriors)
+
+
+    # Batched rollouts, see Treesearch_AS._batched_seqs_values
+    ## A rollout state holds the log posterior (B, num_link_vars, num_links) and the attractors (B, num_link_vars, num_links) of B branches
+    def rollout_state(self):
+        return {'params': self._posterior_params[np.newaxis], 'mus': self._mus[np.newaxis]}
+
+    ## observations: (B, T, K) observations of each branch, interventions: (B,) variable intervened upon in each branch, nan when idle
+    ## Same steps as T calls to update in every branch, histories are left untouched
+    def batch_rollout(self, rollout_state, observations, interventions):
+        log_posterior, mus = rollout_state['params'], rollout_state['mus']
+
+        for t in range(observations.shape[1]):
+            obs = observations[:, t, :]
+            log_posterior = log_posterior + self._link_log_likelihoods(obs, mus, interventions)
+            mus = self._attractor_mu(obs)
+
+        return {'params': log_posterior, 'mus': mus}
+
+    ## Unsmoothed posterior entropy of each branch, (B,)
+    ## The posterior over models is the product of the link posteriors, its entropy is the sum of the link entropies
+    def batch_entropy(self, rollout_state):
+        posterior = self._likelihood(rollout_state['params']).reshape(rollout_state['params'].shape)
+        return np.atleast_1d(self._entropy(posterior))
+
     
     # Background methods
     ## Prior initialisation specific to model:
@@ -84,17 +121,28 @@ class Local_computations_omniscient_DIS(Discrete_IS):
         self._mus = self._attractor_mu(obs)
 
     
+    ## obs: (K,) for a single frame or (T, K) for a whole trial, returns (..., num_link_vars, num_links)
     def _attractor_mu(self, obs):
         mu_self = obs * (1 - np.abs(obs) / 100)
-        mu_att = obs.reshape((self._K, 1)) * self._links_lc_updates
+        obs_effects = obs[..., self._link_effects, np.newaxis]
+        mu_att = obs[..., self._link_causes, np.newaxis] * self._links_lc_updates[self._link_causes]
 
-        mus = np.zeros((self._K**2 - self._K, self._L.size))
-        idx = 0
-        for i in range(self._K):
-            for j in range(self._K):
-                if i != j:
-                    mus[idx, :] = obs[j] + (mu_att[i, :] + mu_self[j] - obs[j]) * self._dt * self._theta
-                    idx += 1
+        mus = obs_effects + (mu_att + mu_self[..., self._link_effects, np.newaxis] - obs_effects) * self._dt * self._theta
 
         return mus
 
+
+    # Normalised log likelihood of each link value for a batch of updates
+    ## obs: (T, K), mus: (T, num_link_vars, num_links), interventions: (T,) intervened variable, nan when idle
+    def _link_log_likelihoods(self, obs, mus, interventions):
+        # Likelihood of observed the new values given the previous values for each link value
+        log_likelihood = self._evidence_weight * stats.norm.logpdf(obs[:, self._link_effects, np.newaxis], loc=mus, scale=self._sigma*np.sqrt(self._dt))
+        # Normalisation step
+        likelihood_log = log_likelihood - np.amax(log_likelihood, axis=2, keepdims=True)
+
+        # If intervention, the probability of observing the new values is set to 1
+        intervened = self._link_effects == interventions.reshape((-1, 1))
+        likelihood_log[intervened] = 0
+
+        return likelihood_log
+
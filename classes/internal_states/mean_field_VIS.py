@@ -1,4 +1,5 @@
 from classes.internal_states.internal_state import Variational_IS
+from methods.packed_factors_methods import unpack_factors, segment_softmax
 from scipy import stats
 import numpy as np
 
@@ -34,8 +35,11 @@ from active states is set to True
 
 
 class MeanField_VIS(Variational_IS):
-    def __init__(self, N, K, links, dt, parameter_set, factorisation='normative', update_schedule='full', evidence_weight=1, certainty_threshold=1e-1, block_learning=[], generate_sample_space=True, prior_param=None, smoothing=False):
-        super().__init__(N, K, links, dt, parameter_set, self._update_rule, factorisation=factorisation, generate_sample_space=generate_sample_space, prior_param=prior_param, smoothing=smoothing)
+    # Attention and schedule state read back by the next update, see Internal_state.fingerprint
+    _fingerprint_attributes = ('_update_schedule',)
+
+    def __init__(self, N, K, links, dt, parameter_set, factorisation='normative', update_schedule='full', expectation='moments', evidence_weight=1, certainty_threshold=1e-1, block_learning=[], generate_sample_space=True, prior_param=None, smoothing=False, retention='full'):
+        super().__init__(N, K, links, dt, parameter_set, self._update_rule, factorisation=factorisation, generate_sample_space=generate_sample_space, prior_param=prior_param, smoothing=smoothing, retention=retention)
 
         self._epsilon = certainty_threshold
 
@@ -43,8 +47,25 @@ class MeanField_VIS(Variational_IS):
 
         if self._factorisation == 'normative':
             self._causal_link_expectation = self._normative_causal_link_expectation
+            self._causal_link_moment_expectation = self._normative_causal_link_moment_expectation
+            self._causal_links_moment_expectation = self._normative_causal_links_moment_expectation
         elif self._factorisation == 'local_computations':
             self._causal_link_expectation = self._lc_causal_link_expectation
+            self._causal_link_moment_expectation = self._lc_causal_link_moment_expectation
+            self._causal_links_moment_expectation = self._lc_causal_links_moment_expectation
+
+        # Expectations over the dependencies
+        ## 'moments': closed form from the first and second moments of each factor, linear in the number of factors
+        ## 'enumeration': sum over every joint combination of the dependencies values
+        self._expectation = expectation
+
+        # Special parameters for faster updates
+        ## Cause and effect variable of each link, links are ordered row wise off the diagonal
+        self._num_no_links = np.sum(~self._link_params_bool)
+        self._link_causes, self._link_effects = np.where(~np.eye(self._K, dtype=bool))
+        self._other_links = ((self._link_effects.reshape((-1, 1)) == self._link_effects) & ~np.eye(self._link_effects.size, dtype=bool)).astype(float)
+        ## Dependencies of each factor update for each intervened variable
+        self._update_dependencies = self._construct_update_dependencies()
 
         self._update_law = update_schedule
         if update_schedule == 'full':
@@ -94,6 +115,7 @@ class MeanField_VIS(Variational_IS):
         X = sensory_state.s
         X_prev = sensory_state.s_prev
 
+        # Packed buffer of log factors, factors already updated in this step are used for the next ones
         posterior_params = self._posterior_params.copy()
 
         
@@ -106,72 +128,127 @@ class MeanField_VIS(Variational_IS):
         # Reset update schedule.
         self._update_schedule_history[self._n, :] = self._update_schedule
 
-        params_to_update = self._param_names_list[self._update_schedule]
-        params_to_update_indices = self._param_index_list[self._update_schedule]
+        # Dependencies given the intervened variable, links into the intervened variable are not updated
+        dependencies = self._update_dependencies[action]
+        to_update = np.where(self._update_schedule & ~dependencies['skipped'])[0]
+
+        for wave in self._update_waves(to_update, dependencies['mask']):
+            # Variational posterior shared by all factors of the wave
+            variational_posterior = segment_softmax(posterior_params, self._factor_offsets)
+            factors = unpack_factors(variational_posterior, self._factor_offsets)
+
+            links_in_wave = wave[self._link_params_bool[wave]]
+            if self._expectation == 'moments' and links_in_wave.size:
+                # All links of the wave in one batch
+                moments = self._factor_moments(self._param_names_list[~self._link_params_bool], [factors[j] for j in np.where(~self._link_params_bool)[0]])
+                link_moments = self._link_moments(variational_posterior)
+                expectation = self._causal_links_moment_expectation(links_in_wave - self._num_no_links, X, X_prev, moments, link_moments)
+
+                self._link_params(posterior_params)[links_in_wave - self._num_no_links] += self._evidence_weight * expectation
+                wave = wave[~self._link_params_bool[wave]]
+
+            for i in wave:
+                param = self._param_names_list[i]
+                dependencies_str = dependencies['names'][i]
+                dependency_factors = [factors[j] for j in dependencies['indices'][i]]
+                var_to_consider = dependencies['var_to_consider'][i]
+
+                if self._expectation == 'moments':
+                    moments = self._factor_moments(dependencies_str, dependency_factors)
+
+                    # Perform the update
+                    # Compute the expectation
+                    if self._link_params_bool[i]:
+                        expectation = self._causal_link_moment_expectation(param, self._parameter_set[param]['values'], X, X_prev, moments, var_to_consider)
+                    else:
+                        expectation = self._parameter_moment_expectation(param, self._parameter_set[param]['values'], X, X_prev, moments, var_to_consider)
+
+                    # Unnormalised probability of observing this transition
+                    data_log_probability_unnormalised = self._evidence_weight * expectation
+                else:
+                    # Generate a list of all parameter values and the associated joints
+                    dep_str = ','.join(dependencies_str)
+                    parameter_values = self._param_subsets_dict[dep_str]
+                    expectation_probabilities = self._construct_parameter_combinations(dependencies_str, dependency_factors)
+
+                    # Perform the update
+                    # Compute the expectation
+                    if self._link_params_bool[i]:
+                        expectation_quantities = self._causal_link_expectation(param, self._parameter_set[param]['values'], X, X_prev, dependencies_str.tolist(), parameter_values, var_to_consider)
+                    else:
+                        expectation_quantities = self._parameter_expectation(param, self._parameter_set[param]['values'], X, X_prev, dependencies_str.tolist(), parameter_values, var_to_consider)
+
+                    # Unnormalised probability of observing this transition
+                    data_log_probability_unnormalised = self._evidence_weight * np.sum(expectation_probabilities.prod(axis=1) * expectation_quantities, axis=1)
+                
+                # Update considered belief
+                posterior_params[self._factor_offsets[i]:self._factor_offsets[i+1]] += data_log_probability_unnormalised
 
-        dependencies_str = [None for _ in params_to_update]
-        dependencies_array = np.zeros((len(dependencies_str), self._update_schedule.size), dtype=bool)
+        return posterior_params
 
-        var_to_consider = np.zeros((params_to_update.size, self._K), dtype=bool)
 
-        for i, param in enumerate(params_to_update):
-            
-            # If agent is intervening on the cause the factor, do not update it
-            if param in self._param_names_list[self._link_params_bool]:
-                if action == int(param[-1]):
+    """
+    Dependencies of the factor updates, computed once for each possible intervened variable
+    """
+    ## For each factor: names and indices of the factors its expectation depends on, variables whose change is considered
+    ## Links into the intervened variable are skipped. Idle frames are stored under the None key
+    def _construct_update_dependencies(self):
+        update_dependencies = {}
+        for action in [None] + list(range(self._K)):
+            skipped = np.zeros(self._num_factors, dtype=bool)
+            dependencies_str = [None for _ in range(self._num_factors)]
+            dependencies_array = np.zeros((self._num_factors, self._num_factors), dtype=bool)
+            var_to_consider = np.zeros((self._num_factors, self._K), dtype=bool)
+
+            for i, param in enumerate(self._param_names_list):
+                if self._link_params_bool[i] and action == int(param[-1]):
+                    skipped[i] = True
                     continue
 
-            dependencies_str[i] = self._parameter_set[param]['dependencies_as_str']
-            dependencies_array[i, :] = self._parameter_set[param]['dependencies_as_bool']
-
-            if self._parameter_set[param]['type'] == 'no_link':
-                dep_bool = np.zeros(self._link_names_matrix.shape, dtype=bool)
-                for j in range(self._K):
-                    for k in range(self._K):
-                        if j != k and k != action:
-                            dep_bool[j, k] = 1
-                additional_dependencies = self._link_names_matrix[dep_bool]
-                add_dep_bool = np.in1d(self._param_names_list, additional_dependencies)
-                dependencies_str[i] = np.concatenate((dependencies_str[i], additional_dependencies), dtype=object)
-                dependencies_array[i, :][add_dep_bool] = 1
-
-                var_to_consider[i, :] = np.ones(self._K, dtype=bool)
-                var_to_consider[i, action] = 0
-            else:
-                var_to_consider[i, int(params_to_update[i][-1])] = 1
-
-            # Now that dependencies needed to update have been found
-            ## Generate a list of all parameter values and the associated joints
-            dep_str = ','.join(dependencies_str[i])
-            parameter_values = self._param_subsets_dict[dep_str]
-            expectation_probabilities = self._construct_parameter_combinations(dependencies_str[i], self.variational_posterior[dependencies_array[i, :]])
-
-            # Perform the update
-            # Compute the expectation
-            if param in self._param_names_list[self._link_params_bool]:
-                expectation_quantities = self._causal_link_expectation(param, self._parameter_set[param]['values'], X, X_prev, dependencies_str[i].tolist(), parameter_values, var_to_consider[i, :])
-            else:
-                expectation_quantities = self._parameter_expectation(param, self._parameter_set[param]['values'], X, X_prev, dependencies_str[i].tolist(), parameter_values, var_to_consider[i, :])
-
-            # Unnormalised probability of observing this transition
-            data_log_probability_unnormalised = self._evidence_weight * np.sum(expectation_probabilities.prod(axis=1) * expectation_quantities, axis=1)
-            
-            # Update considered belief
-            if not action_state.simulate:
-                a = 1
-                pass
-            posterior_params[params_to_update_indices[i]] += data_log_probability_unnormalised
-            #self._posterior_params[params_to_update_indices[i]] - np.amax(self._posterior_params[params_to_update_indices[i]])
+                dependencies_str[i] = self._parameter_set[param]['dependencies_as_str']
+                dependencies_array[i, :] = self._parameter_set[param]['dependencies_as_bool']
+
+                if self._parameter_set[param]['type'] == 'no_link':
+                    dep_bool = np.zeros(self._link_names_matrix.shape, dtype=bool)
+                    for j in range(self._K):
+                        for k in range(self._K):
+                            if j != k and k != action:
+                                dep_bool[j, k] = 1
+                    additional_dependencies = self._link_names_matrix[dep_bool]
+                    add_dep_bool = np.in1d(self._param_names_list, additional_dependencies)
+                    dependencies_str[i] = np.concatenate((dependencies_str[i], additional_dependencies), dtype=object)
+                    dependencies_array[i, :][add_dep_bool] = 1
+
+                    var_to_consider[i, :] = np.ones(self._K, dtype=bool)
+                    var_to_consider[i, action] = 0
+                else:
+                    var_to_consider[i, int(param[-1])] = 1
+
+            update_dependencies[action] = {
+                'skipped': skipped,
+                'names': dependencies_str,
+                'indices': [np.where(dependencies_array[i, :])[0] for i in range(self._num_factors)],
+                'mask': dependencies_array,
+                'var_to_consider': var_to_consider
+            }
+
+        return update_dependencies
+
+    ## Factors are updated in order, each one using the factors already updated in this step
+    ## Consecutive factors which do not depend on each other form a wave and are updated from the same posterior
+    def _update_waves(self, to_update, dependencies_mask):
+        waves = []
+        current = []
+        for i in to_update:
+            if dependencies_mask[i, current].any():
+                waves.append(np.array(current, dtype=int))
+                current = []
+            current.append(i)
+        if current:
+            waves.append(np.array(current, dtype=int))
+
+        return waves
 
-        
-        if not action_state.simulate:
-            #print()
-            #print(action, X[action])
-            #print(action_state._flatten_action([action, X[action]]))
-            #print(self._param_names_list[self._update_schedule])
-            a = 1          
-            pass
-        return posterior_params
 
     """
     Prior initialisation specific to model
@@ -179,10 +256,15 @@ class MeanField_VIS(Variational_IS):
     def _local_prior_init(self):
         non_causal = [np.log(self._parameter_set[nc_factor]['prior']) for nc_factor in self._param_names_list[~self._link_params_bool]]
         causal_links = [np.log(factor) for factor in self._prior_params]
-        self._prior_params = np.array(non_causal + causal_links, dtype=object)
+        # Single packed buffer of log factors, see Variational_IS
+        self._prior_params = np.concatenate(non_causal + causal_links)
 
         # Initialise update schedule
         self._update_schedule = self._init_update_schedule()
+
+    ## Rolling back keeps the log prior, only the update schedule is reset
+    def _local_rollback(self, back):
+        self._update_schedule = self._init_update_schedule()
             
 
     """
@@ -287,6 +369,131 @@ class MeanField_VIS(Variational_IS):
         return out
     
 
+    """
+    Moment based expectations
+    Under the mean field factorisation, the change of variable k is Gaussian with mean theta * c_k * dt and variance sigma^2 * dt,
+    where the drift c_k is linear in the links going into k. The expected log likelihood only depends on:
+    - E[theta] and E[theta^2]
+    - E[log sigma] and E[1/sigma^2]
+    - E[c_k] and E[c_k^2], which follow from the mean and variance of each independent link factor
+    """
+    def _factor_moments(self, factor_names, factors):
+        moments = {}
+        for name, q in zip(factor_names, factors):
+            values = self._parameter_set[name]['values']
+            if name == 'sigma':
+                moments[name] = (np.sum(q * np.log(values)), np.sum(q / values**2))
+            else:
+                moments[name] = (np.sum(q * values), np.sum(q * values**2))
+
+        return moments
+
+    ## Expected Gaussian log density of an observed change given the moments of theta, sigma and the drift
+    def _expected_log_likelihood(self, change, theta_moments, sigma_moments, drift_moments):
+        E_theta, E_theta_sq = theta_moments
+        E_log_sigma, E_inv_sigma_sq = sigma_moments
+        E_drift, E_drift_sq = drift_moments
+
+        expected_sq_error = change**2 - 2 * change * E_theta * E_drift * self._dt + E_theta_sq * E_drift_sq * self._dt**2
+
+        return - E_log_sigma - np.log(2 * np.pi * self._dt) / 2 - E_inv_sigma_sq * expected_sq_error / (2 * self._dt)
+
+    ## Mean and second moment of the drift of variable k from the links going into k, except the ones in fixed_causes
+    def _drift_moments(self, k, X_prev, moments, drift_fixed, fixed_causes=[]):
+        E_drift = drift_fixed
+        var_drift = 0
+        for j in range(self._K):
+            if j == k or j in fixed_causes:
+                continue
+            E_link, E_link_sq = moments[self._link_names_matrix[j, k]]
+            E_drift = E_drift + X_prev[j] * E_link
+            var_drift = var_drift + X_prev[j]**2 * (E_link_sq - E_link**2)
+
+        return E_drift, E_drift**2 + var_drift
+
+    """
+    Normative link moment expectation function
+    """
+    def _normative_causal_link_moment_expectation(self, belief_name, belief_values, X, X_prev, moments, var_to_consider):
+        cause = int(belief_name[0])
+
+        out = np.zeros(belief_values.size)
+        for k in np.where(var_to_consider)[0]:
+            regularisor = -1 * X_prev[k] * (np.abs(X_prev[k]) / 100)
+            drift_moments = self._drift_moments(k, X_prev, moments, X_prev[cause] * belief_values + regularisor, fixed_causes=[cause])
+
+            out += self._expected_log_likelihood(X[k] - X_prev[k], moments['theta'], moments['sigma'], drift_moments)
+
+        return out
+
+    """
+    Local computations link moment expectation function
+    """
+    def _lc_causal_link_moment_expectation(self, belief_name, belief_values, X, X_prev, moments, var_to_consider):
+        cause = int(belief_name[0])
+
+        out = np.zeros(belief_values.size)
+        for k in np.where(var_to_consider)[0]:
+            regularisor = X_prev[k]*(1 - np.abs(X_prev[k]) / 100)
+            drift = X_prev[cause] * belief_values + regularisor - X_prev[k]
+
+            out += self._expected_log_likelihood(X[k] - X_prev[k], moments['theta'], moments['sigma'], (drift, drift**2))
+
+        return out
+
+    """
+    Batched link moment expectation functions
+    All the links updated together share the moments of the other factors, link p goes from _link_causes[p] into _link_effects[p]
+    Return the expected log likelihood of each value of each link, (links.size, num_links)
+    """
+    ## Mean and second moment of each link factor from the packed variational posterior
+    def _link_moments(self, variational_posterior):
+        link_probs = self._link_params(variational_posterior)
+        return np.sum(link_probs * self._L, axis=1), np.sum(link_probs * self._L**2, axis=1)
+
+    def _normative_causal_links_moment_expectation(self, links, X, X_prev, moments, link_moments):
+        causes = self._link_causes[links]
+        effects = self._link_effects[links]
+        E_link, E_link_sq = link_moments
+
+        # Drift moments from the other links going into the same effect
+        drift_fixed = self._other_links[links] @ (X_prev[self._link_causes] * E_link)
+        var_drift = self._other_links[links] @ (X_prev[self._link_causes]**2 * (E_link_sq - E_link**2))
+
+        regularisor = -1 * X_prev[effects] * (np.abs(X_prev[effects]) / 100)
+        E_drift = X_prev[causes].reshape((-1, 1)) * self._L + regularisor.reshape((-1, 1)) + drift_fixed.reshape((-1, 1))
+        drift_moments = (E_drift, E_drift**2 + var_drift.reshape((-1, 1)))
+
+        return self._expected_log_likelihood((X[effects] - X_prev[effects]).reshape((-1, 1)), moments['theta'], moments['sigma'], drift_moments)
+
+    def _lc_causal_links_moment_expectation(self, links, X, X_prev, moments, link_moments):
+        causes = self._link_causes[links]
+        effects = self._link_effects[links]
+
+        regularisor = X_prev[effects]*(1 - np.abs(X_prev[effects]) / 100)
+        drift = X_prev[causes].reshape((-1, 1)) * self._L + regularisor.reshape((-1, 1)) - X_prev[effects].reshape((-1, 1))
+
+        return self._expected_log_likelihood((X[effects] - X_prev[effects]).reshape((-1, 1)), moments['theta'], moments['sigma'], (drift, drift**2))
+
+    """
+    Hyperparameter moment expectation function
+    """
+    def _parameter_moment_expectation(self, belief_name, belief_values, X, X_prev, moments, var_to_consider):
+        out = np.zeros(belief_values.size)
+        for k in np.where(var_to_consider)[0]:
+            regularisor = -1 * X_prev[k] * (np.abs(X_prev[k]) / 100)
+            drift_moments = self._drift_moments(k, X_prev, moments, regularisor)
+
+            if belief_name == 'theta':
+                out += self._expected_log_likelihood(X[k] - X_prev[k], (belief_values, belief_values**2), moments['sigma'], drift_moments)
+            else:
+                out += self._expected_log_likelihood(X[k] - X_prev[k], moments['theta'], (np.log(belief_values), 1 / belief_values**2), drift_moments)
+                # Add a penalty for high variance, the negative of the variance
+                out += - self._dt*belief_values**2
+
+        return out
+
+
     """
     Update schedules
     """
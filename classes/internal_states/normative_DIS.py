@@ -4,8 +4,10 @@ import numpy as np
 
 # Normative discrete agent
 class Normative_DIS(Discrete_IS):
-    def __init__(self, N, K, links, dt, theta, sigma, evidence_weight=1, generate_sample_space=True, sample_params=False, prior_param=None, smoothing=False):
-        super().__init__(N, K, links, dt, self._update_rule, generate_sample_space=generate_sample_space, sample_params=sample_params, prior_param=prior_param, smoothing=smoothing)
+    supports_batched_rollouts = True
+
+    def __init__(self, N, K, links, dt, theta, sigma, evidence_weight=1, generate_sample_space=True, sample_params=False, prior_param=None, smoothing=False, history_dtype=np.float64, retention='full'):
+        super().__init__(N, K, links, dt, self._update_rule, generate_sample_space=generate_sample_space, sample_params=sample_params, prior_param=prior_param, smoothing=smoothing, history_dtype=history_dtype, retention=retention)
 
         
         # Sample parameter estimates
@@ -21,6 +23,9 @@ class Normative_DIS(Discrete_IS):
         # Evidence weight
         self._evidence_weight = evidence_weight
 
+        # Per effect variable likelihood tables, built once the sample space is available
+        self._effect_gather = None
+
         # Collect observations to recompute mus
         self._obs_history = [None for _ in range(self._N+1)]
         self._obs_history[0] = np.zeros(self._K)
@@ -32,35 +37,22 @@ class Normative_DIS(Discrete_IS):
         intervention = action_state.a
         obs = sensory_state.s
 
-        # Likelihood of observed the new values given the previous values for each model
-        likelihood_per_var = self._evidence_weight * stats.norm.logpdf(obs, loc=self._mus, scale=self._sigma*np.sqrt(self._dt)) # Compute probabilities
+        # Likelihood of observed the new values given the previous values for each combination of incoming links
+        ## Each effect variable only depends on its K-1 incoming links, hence a (K, num_links**(K-1)) table
+        likelihood_per_var = self._evidence_weight * stats.norm.logpdf(obs.reshape((self._K, 1)), loc=self._mus, scale=self._sigma*np.sqrt(self._dt)) # Compute probabilities
 
         # Normalisation step
-        likelihood_log = likelihood_per_var - np.amax(likelihood_per_var, axis=0)
-        #likelihood_per_var_norm = np.exp(likelihood_log) / np.exp(likelihood_log).sum(axis=0)
+        ## Every combination of incoming links appears in some model, so the max over the table is the max over models
+        likelihood_log = likelihood_per_var - np.amax(likelihood_per_var, axis=1, keepdims=True)
         
         ## If intervention, the probability of observing the new values is set to 1
         if isinstance(intervention, tuple):
-            #likelihood_per_var_norm[:, intervention[0]] = 1
-            likelihood_log[:, intervention[0]] = 0
+            likelihood_log[intervention[0], :] = 0
  
-        # Compute and normalise probabilities of each model given the previous and new values
-        #likelihood_to_prop = likelihood_per_var_norm.prod(axis=1)
-        #likelihood_over_models = likelihood_to_prop / likelihood_to_prop.sum()
-        
         # Posterior params is the log likelihood of each model given the data
-        ## The where argument is a problem, it makes it so models that are so unlikely that their probability is essentially 0 don't have their log likelihood penalised
-        ## Cannot achieve numerical stability without it
-        LL = likelihood_log.sum(axis=1)
-        #LL = np.log(likelihood_over_models, where=likelihood_over_models!=0)
+        ## Gather each effect variable's table entry for every model and sum over variables
+        LL = likelihood_log[self._effect_rows, self._effect_gather].sum(axis=0)
         log_posterior = self._posterior_params + LL
-        #log_posterior = self._posterior_params + np.log(likelihood_over_models)
-
-        #LL_l = self._likelihood(LL)
-        #LL_c = self._likelihood(log_likelihood)
-
-        #LL_lp = self._likelihood(LL + self._posterior_params)
-        #LL_cp = self._likelihood(log_posterior)
 
         # Update mus
         self._update_mus(obs)
@@ -69,12 +61,53 @@ class Normative_DIS(Discrete_IS):
         return log_posterior
 
 
+    # Batched rollouts, see Treesearch_AS._batched_seqs_values
+    ## A rollout state holds the log posterior over models (B, num_models) and the attractors (B, K, num_combinations) of B branches
+    def rollout_state(self):
+        return {'params': self._posterior_params[np.newaxis], 'mus': self._mus[np.newaxis]}
+
+    ## observations: (B, T, K) observations of each branch, interventions: (B,) variable intervened upon in each branch, nan when idle
+    ## Same steps as T calls to update in every branch, histories are left untouched
+    def batch_rollout(self, rollout_state, observations, interventions):
+        log_posterior, mus = rollout_state['params'], rollout_state['mus']
+        B = observations.shape[0]
+        acting = np.where(~np.isnan(interventions))[0]
+        inter_var = interventions[acting].astype(int)
+
+        # Per effect variable tables summed over frames, gathering is linear so models are gathered once
+        likelihood_log_sum = np.zeros(mus.shape)
+        for t in range(observations.shape[1]):
+            obs = observations[:, t, :]
+
+            likelihood_per_var = self._evidence_weight * stats.norm.logpdf(obs.reshape((B, self._K, 1)), loc=mus, scale=self._sigma*np.sqrt(self._dt))
+            likelihood_log = likelihood_per_var - np.amax(likelihood_per_var, axis=2, keepdims=True)
+            likelihood_log[acting, inter_var, :] = 0
+            likelihood_log_sum += likelihood_log
+
+            mus = self._attractor_mu(obs)
+
+        # Gather one effect variable at a time, a (B, K, num_models) table would not fit in memory for deep trees
+        LL = likelihood_log_sum[:, 0, self._effect_gather[0]]
+        for j in range(1, self._K):
+            LL += likelihood_log_sum[:, j, self._effect_gather[j]]
+
+        return {'params': log_posterior + LL, 'mus': mus}
+
+    ## Unsmoothed posterior entropy of each branch, (B,)
+    def batch_entropy(self, rollout_state):
+        posterior = self._likelihood(rollout_state['params']).reshape(rollout_state['params'].shape)
+        return self._entropy(posterior)
+
+
     # Background methods
     ## Prior initialisation specific to model:
     def _local_prior_init(self):
         if len(self._prior_params.shape) == 2:
-            prior = self._links_to_models(self._prior_params)
-            self._prior_params = np.log(prior)
+            self._prior_params = self._links_to_models(self._prior_params, log=True)
+
+        # Index structures for per effect variable likelihood tables
+        if self._effect_gather is None:
+            self._build_effect_tables()
 
         # Compute initial attractor
         self._mus = self._attractor_mu(self._obs_history[self._n])
@@ -85,14 +118,101 @@ class Normative_DIS(Discrete_IS):
         self._obs_history[self._n+1] = obs
 
 
+    # Attractors for each effect variable and each combination of its incoming links
+    ## obs: (K,) for a single frame or (B, K) for a batch of branches, returns (..., K, num_combinations)
     def _attractor_mu(self, obs): 
-        att_mu =  obs @ self._sample_space_as_mat 
+        att_mu = (self._effect_link_values * obs[..., self._effect_causes][..., np.newaxis, :]).sum(axis=-1)
         self_mu =  -1 * obs * (np.abs(obs) / 100)
-        mu_squeezed = np.squeeze(att_mu + self_mu)
-        mus = obs + (mu_squeezed - obs) * self._theta * self._dt
+        mus = obs[..., np.newaxis] + (att_mu + self_mu[..., np.newaxis]) * self._theta * self._dt
         return mus
 
 
+    # Precompute, for each effect variable j:
+    ## the causes of j and the values of its incoming links for each of the num_links**(K-1) combinations
+    ## the index of the combination taken by each model, used to gather tables into a log likelihood over models
+    def _build_effect_tables(self):
+        # Column of the sample space holding each link, links are ordered row wise off the diagonal
+        link_matrix_idx = -1 * np.ones((self._K, self._K), dtype=int)
+        link_matrix_idx[~np.eye(self._K, dtype=bool)] = np.arange(self._K**2 - self._K)
+
+        # Link values in index order, as used by the sample space
+        link_values = np.zeros(self._num_links)
+        link_values[self._indexed_space[:, 0]] = self._sample_space[:, 0]
+
+        combinations = np.array(np.unravel_index(np.arange(self._num_links**(self._K-1)), (self._num_links,)*(self._K-1))).T
+
+        self._effect_causes = np.zeros((self._K, self._K-1), dtype=int)
+        self._effect_link_values = np.zeros((self._K, combinations.shape[0], self._K-1))
+        self._effect_gather = np.zeros((self._K, self._indexed_space.shape[0]), dtype=int)
+        for j in range(self._K):
+            causes = np.arange(self._K)[np.arange(self._K) != j]
+            self._effect_causes[j, :] = causes
+            self._effect_link_values[j, :, :] = link_values[combinations]
+            self._effect_gather[j, :] = np.ravel_multi_index(self._indexed_space[:, link_matrix_idx[causes, j]].T, (self._num_links,)*(self._K-1))
+
+        self._effect_rows = np.arange(self._K).reshape((self._K, 1))
+
+
+    # Sufficient statistics
+    ## Each model's mean is linear in theta: mu = obs_prev + theta * drift, with drift = dt * (attractor - obs_prev)
+    ## The Gaussian log likelihood of a trial is therefore, up to a constant shared by all models:
+    ##     - evidence_weight / (2 * sigma^2 * dt) * (sum(b^2) - 2 * theta * sum(b * drift) + theta^2 * sum(drift^2))
+    ## where b = obs - obs_prev is the baseline residual and intervened variables are masked out.
+    ## The drift is linear in the links so every per model sum derives from small per effect variable moments
+    ### observations: (T+1, K) array, first row is the observation preceding the first update (zeros at trial start, as in Sensory_state)
+    ### interventions: (T,) array of the variable intervened upon at each update, nan when idle
+    def compute_sufficient_statistics(self, observations, interventions):
+        obs_prev = observations[:-1, :]
+        obs = observations[1:, :]
+
+        # Mask out intervened variables
+        mask = np.ones(obs.shape)
+        acting = ~np.isnan(interventions)
+        mask[np.where(acting)[0], interventions[acting].astype(int)] = 0
+
+        # Model independent parts: baseline residual and self attractor drift
+        b = mask * (obs - obs_prev)
+        c = -1 * self._dt * obs_prev * (np.abs(obs_prev) / 100)
+        # Causes scaled by dt, the link dependent drift of effect j is links[:, j] @ o
+        o = self._dt * obs_prev
+
+        b_o = np.einsum('tj,ti->ij', b, o)
+        c_o = np.einsum('tj,ti->ij', mask * c, o)
+        o_o = np.einsum('tj,ti,tk->jik', mask, o, o)
+
+        # Off diagonal causal matrices, the diagonal is absorbed by the drift definition
+        links = self._sample_space_as_mat * ~np.eye(self._K, dtype=bool)
+
+        self._sufficient_stats = {
+            'bb': np.sum(b**2),
+            'bd': np.sum(b * c) + np.einsum('mij,ij->m', links, b_o),
+            'dd': np.sum(mask * c**2) + 2 * np.einsum('mij,ij->m', links, c_o) + np.einsum('mij,mkj,jik->m', links, links, o_o)
+        }
+
+        return self._sufficient_stats
+
+
+    # Log posterior over all models from the sufficient statistics for any theta, sigma and evidence weight
+    def log_posterior_from_statistics(self, theta=None, sigma=None, evidence_weight=None):
+        theta = self._theta if theta is None else theta
+        sigma = self._sigma if sigma is None else sigma
+        evidence_weight = self._evidence_weight if evidence_weight is None else evidence_weight
+
+        suff_stats = self._sufficient_stats
+        sum_squares = suff_stats['bb'] - 2 * theta * suff_stats['bd'] + theta**2 * suff_stats['dd']
+
+        return self._prior_params - evidence_weight / (2 * sigma**2 * self._dt) * sum_squares
+
+
+    # Posterior at the end of a trial of T updates from its sufficient statistics, e.g. when the same trials are fitted again with other parameters
+    ## Only the current posterior is set, the history is left untouched
+    def update_from_statistics(self, sufficient_stats, T):
+        self._sufficient_stats = sufficient_stats
+        self._posterior_params = self.log_posterior_from_statistics()
+        self._n += T
+        self._clear_memo()
+
+
     def mus_model(self, graph, idx=None):
         if idx:
             graph_idx = idx
@@ -0,0 +1,74 @@
+from classes.internal_states.internal_state import Factorised_DIS
+from scipy import stats
+import numpy as np
+
+# Normative discrete agent with a posterior factorised over effect variables
+## Same likelihood as Normative_DIS, each factor is updated with the likelihood of its effect variable only
+## Scales to K >= 4 as no sample space over full graphs is needed
+class Normative_factorised_DIS(Factorised_DIS):
+    def __init__(self, N, K, links, dt, theta, sigma, evidence_weight=1, sample_params=False, prior_param=None, smoothing=False, history_dtype=np.float64, retention='full'):
+        super().__init__(N, K, links, dt, self._update_rule, sample_params=sample_params, prior_param=prior_param, smoothing=smoothing, history_dtype=history_dtype, retention=retention)
+
+        # Sample parameter estimates
+        if sample_params:
+            # Sample key variables according to Davis, Rehder, Bramley (2018)
+            self._theta = stats.gamma.rvs(100*theta, scale=1/100, size=1)
+            self._sigma = stats.gamma.rvs(100*sigma, scale=1/100, size=1)
+        else:
+            # Assume perfect knowledge
+            self._theta = theta
+            self._sigma = sigma
+
+        # Evidence weight
+        self._evidence_weight = evidence_weight
+
+        # Collect observations to recompute mus
+        self._obs_history = [None for _ in range(self._N+1)]
+        self._obs_history[0] = np.zeros(self._K)
+
+
+    # Update rule
+    def _update_rule(self, sensory_state, action_state):
+        intervention = action_state.a
+        obs = sensory_state.s
+
+        # Likelihood of observed the new values given the previous values for each configuration of each factor
+        likelihood_per_var = self._evidence_weight * stats.norm.logpdf(obs.reshape((self._K, 1)), loc=self._mus, scale=self._sigma*np.sqrt(self._dt)) # Compute probabilities
+
+        # Normalisation step
+        likelihood_log = likelihood_per_var - np.amax(likelihood_per_var, axis=1, keepdims=True)
+
+        ## If intervention, the probability of observing the new values is set to 1
+        if isinstance(intervention, tuple):
+            likelihood_log[intervention[0], :] = 0
+
+        # Posterior params are the log likelihood of each factor's configurations given the data
+        log_posterior = self._posterior_params + likelihood_log
+
+        # Update mus
+        self._update_mus(obs)
+
+        # Return log_posterior over factors
+        return log_posterior
+
+
+    # Background methods
+    ## Prior initialisation specific to model:
+    def _local_prior_init(self):
+        super()._local_prior_init()
+
+        # Compute initial attractor
+        self._mus = self._attractor_mu(self._obs_history[self._n])
+
+    # Update attractors for all factors
+    def _update_mus(self, obs):
+        self._mus = self._attractor_mu(obs)
+        self._obs_history[self._n+1] = obs
+
+
+    # Attractors for each effect variable and each configuration of its incoming links
+    def _attractor_mu(self, obs):
+        att_mu = self._factor_space @ obs[self._factor_causes].T
+        self_mu =  -1 * obs * (np.abs(obs) / 100)
+        mus = obs.reshape((self._K, 1)) + (att_mu.T + self_mu.reshape((self._K, 1))) * self._theta * self._dt
+        return mus
@@ -40,6 +40,9 @@ class OU_Network():
         self._I[:] = np.nan
 
         self._realised = False
+
+        # Pre drawn standard normal noise indexed by frame, see set_common_noise
+        self._common_noise = None
             
     
     def run(self, iter=1, interventions=None, reset=False):
@@ -89,7 +92,10 @@ class OU_Network():
         self._mu_att[self._n, :] = causal_attractor
 
         # Update using a direct sample from a normal distribution
-        self._X[self._n+1, :] = np.random.normal(loc=self._X[self._n,:] + self._theta * self._dt * (att - self._X[self._n,:]), scale=self._sig*np.sqrt(self._dt)) 
+        if self._common_noise is None:
+            self._X[self._n+1, :] = np.random.normal(loc=self._X[self._n,:] + self._theta * self._dt * (att - self._X[self._n,:]), scale=self._sig*np.sqrt(self._dt)) 
+        else:
+            self._X[self._n+1, :] = self._X[self._n,:] + self._theta * self._dt * (att - self._X[self._n,:]) + self._sig*np.sqrt(self._dt) * self._common_noise[self._n+1]
 
         # If intervention, set value irrespective of causal matrix
         if isinstance(intervention, tuple) and np.sum(np.isnan(np.array(intervention))) == 0:
@@ -103,10 +109,61 @@ class OU_Network():
         self._X[self._n+1, :][self._X[self._n+1, :] > self._range[1]] = self._range[1]
 
         # Record Difference
-        # Increment index      
+        # Increment index
         self._n += 1
 
 
+    # Open loop generation when the whole action plan is known in advance
+    ## actions: array of intervened variables with nan for idleness, values: array of variable values (as given by action plans)
+    ## actions[i] and values[i] apply to the i-th generated datapoint, as in run
+    ## rng: seed or numpy.random.Generator, the full noise block is drawn at once
+    def run_open_loop(self, actions, values, rng=None):
+        if self._n >= self._N:
+            print('Iterations maxed out')
+            return
+
+        r_iter = min(actions.size, self._N - self._n)
+        start = self._n
+
+        # Intervention masks and values for the whole trajectory
+        acting = ~np.isnan(actions[0:r_iter])
+        inter_var = np.where(acting, actions[0:r_iter], 0).astype(int)
+        inter_val = values[np.arange(r_iter), inter_var]
+        self._I[start+1:start+r_iter+1][acting] = inter_var[acting]
+
+        # If the data already exists, simply record the actions
+        if self._realised:
+            self._n += r_iter
+            return self._X[0:self._n+1, :]
+
+        # Pre draw the full noise block
+        rng = np.random.default_rng(rng)
+        noise = self._sig * np.sqrt(self._dt) * rng.standard_normal((r_iter, self._K))
+
+        # Fold the linear part of the attractor into a single transition matrix
+        transition = np.eye(self._K) + self._theta * self._dt * (self._G - np.eye(self._K))
+        self_coef = self._theta * self._dt / np.max(self._range)
+        low, high = self._range
+
+        X = self._X
+        for i in range(r_iter):
+            x = X[start+i, :]
+            mus = x @ transition - self_coef * x * np.abs(x)
+            self._mus[start+i, :] = mus
+            self._self_att[start+i, :] = -1 * x * (np.abs(x) / np.max(self._range))
+            self._mu_att[start+i, :] = x @ self._G
+
+            x_new = mus + noise[i]
+            if acting[i]:
+                x_new[inter_var[i]] = inter_val[i]
+            X[start+i+1, :] = np.clip(x_new, low, high)
+
+        self._n += r_iter
+
+        # Return the full trajectory, including the initial state
+        return self._X[0:self._n+1, :]
+
+
     # Load data
     def set_ground_truth(self, ground_truth):
         if len(ground_truth.shape) > 1:
@@ -140,6 +197,31 @@ class OU_Network():
                 self._X[0, :] = init_state
 
 
+    # Common random numbers, e.g. to compare tree search branches on the same noise
+    ## noise: (N+1, K) standard normal draws, row n is used to generate frame n, None to draw fresh noise again
+    def set_common_noise(self, noise):
+        self._common_noise = noise
+
+
+    # Snapshot of the current step, to explore branches from it and come back with restore (e.g. tree search)
+    ## The index, the causal matrix and the current state are kept, rows generated ahead of the current step are cleared on restore as in reset
+    ## Keeping the current state allows restoring a snapshot taken further down a branch, e.g. transpositions in tree search
+    def snapshot(self):
+        return self._n, self._G, self._X[self._n].copy()
+
+    def restore(self, snapshot):
+        n_from = self._n
+        self._n, self._G, x = snapshot
+
+        self._I[self._n+1:n_from+1] = np.nan
+        if not self._realised:
+            self._X[self._n, :] = x
+            self._X[self._n+1:n_from+1, :] = 0
+            self._mus[self._n:n_from, :] = 0
+            self._self_att[self._n:n_from, :] = 0
+            self._mu_att[self._n:n_from, :] = 0
+
+
     def plot_network(self, ax=None, labels=None, history=None):
         palette = sns.color_palette() # Set palette
         sns.set_palette(palette)
@@ -8,6 +8,8 @@ import numpy as np
 ## alpha: change "smoothing" rate, represents the memory of recent change and serves to smooth out one step variance or noise from the data
 
 class Omniscient_ST(Sensory_state):
+    supports_batched_rollouts = True
+
     def __init__(self, N, K, noise_std=None, change_memory=0.5, change='relative', value_range=(-100, 100)):
         super().__init__(N, K, self.omniscient_observation)
         self._alpha = change_memory
@@ -41,7 +43,22 @@ class Omniscient_ST(Sensory_state):
 
 
     def _noisy_observation(self, external_state):
-        return external_state.x + self._noisy * np.random.normal(scale=self._noise_std)
+        if self._common_noise is None:
+            return external_state.x + self._noisy * np.random.normal(scale=self._noise_std)
+        else:
+            return external_state.x + self._noisy * self._noise_std * self._common_noise[external_state._n]
+
+    # Observations of a batch of simulated trajectories, X: (..., T, K) external values, one noise draw per frame as in _noisy_observation
+    ## frames: (T,) frames of the trajectories, used with common noise
+    ## noise_free: if True, returns the noise free observations, i.e. the values themselves
+    ## Change summaries are not needed by information based rollouts and are not computed
+    def batch_observations(self, X, frames=None, noise_free=False):
+        if noise_free:
+            return X.copy()
+        elif self._common_noise is None:
+            return X + self._noisy * np.random.normal(scale=self._noise_std, size=X.shape[:-1] + (1,))
+        else:
+            return X + self._noisy * self._noise_std * self._common_noise[frames].reshape((-1, 1))
 
 
     def _raw_change(self, external_state):
@@ -1,6 +1,10 @@
 import numpy as np
 
 class Sensory_state():
+    # Batched rollouts of tree search action states, see Treesearch_AS._batched_seqs_values
+    ## Sensors supporting them implement batch_observations
+    supports_batched_rollouts = False
+
     def __init__(self, N, K, observe_func, observe_func_args=[]):
         self._N = N
         self._n = 0
@@ -15,6 +19,9 @@ class Sensory_state():
         self._obs_alt_record = False
         self._observations_alt = np.zeros((N+1, K))
 
+        # Pre drawn standard normal noise indexed by frame, see set_common_noise
+        self._common_noise = None
+
     
     def observe(self, external_state, internal_state):
         obs, obs_alt = self._p_s_g_e(external_state, internal_state, *self._p_s_g_e_params)
@@ -24,6 +31,11 @@ class Sensory_state():
             self._observations_alt[self._n] = obs_alt
         return obs
 
+    # Common random numbers, e.g. to compare tree search branches on the same noise
+    ## noise: (N+1,) standard normal draws, entry n is used to observe frame n, None to draw fresh noise again
+    def set_common_noise(self, noise):
+        self._common_noise = noise
+
     # Used mostly for action selection
     def rollback(self, back=np.Inf):
         if back > self._N or back > self._n:
@@ -35,6 +47,20 @@ class Sensory_state():
         self._observations[self._n+1:, :] = 0  
         self._observations_alt[self._n+1:, :] = 0
     
+    # Snapshot of the current step, to explore branches from it and come back with restore (e.g. tree search)
+    ## Observation functions may change the current observations in place, they are copied, rows observed ahead are cleared on restore
+    def snapshot(self):
+        return self._n, self._observations[self._n].copy(), self._observations_alt[self._n].copy()
+
+    def restore(self, snapshot):
+        n_from = self._n
+        self._n, obs, obs_alt = snapshot
+
+        self._observations[self._n] = obs
+        self._observations_alt[self._n] = obs_alt
+        self._observations[self._n+1:n_from+1, :] = 0
+        self._observations_alt[self._n+1:n_from+1, :] = 0
+    
     @property
     def s(self):
         return self._observations[self._n]
@@ -0,0 +1,131 @@
+from concurrent.futures import ProcessPoolExecutor
+import copy
+import inspect
+import os
+import pickle
+
+import numpy as np
+
+
+# Executors evaluating the branches of tree search action states concurrently, see Treesearch_AS
+## A task explores the subtree of one root action for one sampled graph on its own copies of the states
+## 'process': a persistent pool of worker processes, the sample space is sent once when workers start and states are sent without it
+##            The states of a decision are serialised once and loaded once per worker, see tree_search_task
+## Pools are owned by the fitting and simulation drivers (see shared_executors) or by the action state that made them
+_sample_space_attributes = ('_sample_space', '_indexed_space', '_sample_space_as_mat')
+
+# Sample space of the worker process, set by _init_worker
+_worker_sample_space = None
+
+# States of the current decision in the worker process, (decision key, payload)
+_worker_payload = (None, None)
+
+
+def make_executor(executor, workers=None, sample_space=None):
+    workers = os.cpu_count() if workers is None else workers
+
+    if executor == 'process':
+        return ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(sample_space,))
+    else:
+        return None
+
+
+def _init_worker(sample_space):
+    global _worker_sample_space
+    _worker_sample_space = sample_space
+
+
+# Pools shared by all trials of a fitting or simulation run, one per action state set to use an executor
+## The action states are given the pool in place of the executor name, they use it and leave it open
+def shared_executors(action_states_list, models_dict, sample_space=None):
+    executors = {}
+    for model in action_states_list:
+        kwargs = models_dict['actions'][model]['params']['kwargs']
+        if kwargs.get('executor') == 'process':
+            executors[model] = make_executor(kwargs['executor'], kwargs.get('workers'), sample_space=sample_space)
+
+    return executors
+
+def shutdown_executors(executors):
+    for pool in executors.values():
+        pool.shutdown()
+
+
+# Light copies of the states sent to the workers
+## Rollouts do not read the posterior history and only write ahead of the current frame: rollout copies do not keep any
+## Callables that cannot be sent (e.g. policy closures) are dropped from the action state
+def rollout_payload(action_state, external_state, sensory_state, internal_state, strip_sample_space=False):
+    action_copy = _rebound_copy(action_state)
+    for name, value in vars(action_copy).items():
+        if (callable(value) and not inspect.ismethod(value)) or name in ('_action_values', '_action_seqs_values', '_action_seqs', '_executor_pool'):
+            setattr(action_copy, name, None)
+
+    internal_copy = _rebound_copy(internal_state)
+    internal_copy._history_slots = np.full(internal_state._history_slots.shape, -1)
+    internal_copy._posterior_params_history = None
+    internal_copy._memo = {}
+    if strip_sample_space:
+        for name in _sample_space_attributes:
+            setattr(internal_copy, name, None)
+
+    return action_copy, external_state, sensory_state, internal_copy
+
+
+# Shallow copy with the methods of the object stored as attributes (e.g. update rules) bound to the copy
+def _rebound_copy(obj):
+    obj_copy = copy.copy(obj)
+    for name, value in vars(obj).items():
+        if inspect.ismethod(value) and value.__self__ is obj:
+            setattr(obj_copy, name, value.__func__.__get__(obj_copy))
+
+    return obj_copy
+
+
+# Payload serialised once per decision, sent as bytes to every task of the decision
+def pack_payload(payload):
+    return pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL)
+
+# Payload of a decision in a worker process, loaded at the first task of the decision and kept for the next ones
+def _load_payload(packed, decision):
+    global _worker_payload
+    if _worker_payload[0] != decision:
+        _worker_payload = (decision, pickle.loads(packed))
+
+    return _worker_payload[1]
+
+
+# Explore the subtree of root_action for graph, returns a tree with a single root branch
+## payload: states as returned by rollout_payload, or packed by pack_payload with the key of the decision
+##          Packed states are kept by the worker for the next tasks of the decision and are restored after each task
+## seed: seed of the worker process random generator, None to keep the current generator
+def tree_search_task(payload, graph, root_action, seed=None, decision=None):
+    packed = isinstance(payload, bytes)
+    if packed:
+        payload = _load_payload(payload, decision)
+    action_state, external_state, sensory_state, internal_state = payload
+
+    if getattr(internal_state, '_sample_space', None) is None and _worker_sample_space is not None:
+        internal_state._sample_space, internal_state._indexed_space, internal_state._sample_space_as_mat = _worker_sample_space
+    if seed is not None:
+        np.random.seed(seed)
+
+    if packed:
+        snapshots = action_state._snapshot_states(external_state, sensory_state, internal_state)
+        causal_matrix = external_state.causal_matrix
+
+    external_state.causal_matrix = graph
+
+    try:
+        tree = action_state._tree_search_func(0,
+                                              external_state,
+                                              sensory_state,
+                                              internal_state,
+                                              action_state._run_local_experiment,
+                                              *action_state._tree_search_func_args,
+                                              root_actions=[root_action])
+    finally:
+        if packed:
+            external_state.causal_matrix = causal_matrix
+            action_state._restore_states(snapshots, external_state, sensory_state, internal_state)
+
+    return tree
@@ -0,0 +1,44 @@
+import numpy as np
+
+
+# Index structure to view probabilities over models as a (num_links,)*num_link_vars tensor of link values
+## indexed_space: (num_models, num_link_vars) array of link value indices, as built by build_space_env
+## order is None when models are already laid out in row major order over links, which is the case for build_space
+def build_marginalisation_index(indexed_space, num_links):
+    shape = (num_links,) * indexed_space.shape[1]
+    position = np.ravel_multi_index(indexed_space.T, shape)
+
+    if np.array_equal(position, np.arange(position.size)):
+        order = None
+    else:
+        order = np.argsort(position)
+
+    return {'shape': shape, 'order': order}
+
+
+# Marginals over links from probabilities over models
+## models_probs: (num_models,) for a single step or (T, num_models) for a whole history
+## Returns (num_link_vars, num_links) or (T, num_link_vars, num_links)
+def models_to_links(models_probs, marginalisation_index):
+    shape = marginalisation_index['shape']
+    order = marginalisation_index['order']
+
+    probs = models_probs if order is None else models_probs[..., order]
+    tensor = probs.reshape(probs.shape[:-1] + shape)
+
+    batch_dims = probs.ndim - 1
+    link_axes = np.arange(len(shape))
+    links_probs = [tensor.sum(axis=tuple(batch_dims + np.delete(link_axes, j))) for j in link_axes]
+
+    return np.stack(links_probs, axis=-2)
+
+
+# Log probabilities over models from independent link marginals, the product is done as a sum of logs
+def links_to_log_models(links_probs, indexed_space):
+    with np.errstate(divide='ignore'):
+        log_links_probs = np.log(links_probs)
+    return log_links_probs[np.arange(links_probs.shape[0]), indexed_space].sum(axis=1)
+
+
+def links_to_models(links_probs, indexed_space):
+    return np.exp(links_to_log_models(links_probs, indexed_space))
@@ -12,6 +12,52 @@ from classes.agent import Agent
 from methods.action_plans import generate_action_plan
 
 from methods.sample_space_methods import build_space_env
+from methods.retention_methods import judgement_frames
+from methods.executor_methods import shared_executors, shutdown_executors
+
+
+# History retention of internal states given what is read once a trial is fitted, see methods.retention_methods
+## save_full_data: as in generalised_model_fitting, False when only the final posterior is read
+def internal_states_retention(action_states_list, models_dict, save_full_data=False, judgement_data=None):
+    # Action states that roll back the internal state need its full history
+    if any(models_dict['actions'][model]['object'].rolls_back_internal_state for model in action_states_list):
+        return 'full'
+
+    if not save_full_data:
+        return 'none'
+    elif save_full_data is True or 'entropy_history' in save_full_data or 'link_entropy_history' in save_full_data:
+        return 'full'
+    elif 'posteriors_at_judgements' in save_full_data and type(judgement_data) == np.ndarray:
+        return judgement_frames(judgement_data)
+    else:
+        return 'none'
+
+
+# Final judgements of a noise free normative observer depend on theta, sigma and the evidence weight only through the sufficient statistics of each trial
+## Statistics are then computed once per trial and reused for every set of parameters, see Normative_DIS.compute_sufficient_statistics
+def fits_from_statistics(internal_states, sensory_states, internal_params_labels, sensory_params_labels, fit_judgement=False):
+    statistics_params = ['theta', 'sigma', 'evidence_weight', 'prior_param', 'smoothing']
+    return len(internal_states) == 1 \
+           and hasattr(internal_states[0], 'compute_sufficient_statistics') \
+           and not fit_judgement \
+           and not sensory_params_labels \
+           and not getattr(sensory_states, '_noisy', 0) \
+           and all(param_fit[0] in statistics_params for param_fit in internal_params_labels)
+
+# Sufficient statistics of a fitted trial
+## The internal state updated on frame t under the action fitted at frame t-1, no action precedes the first update
+## Observations are read from the realised data: sensory buffers can be changed in place once observed (e.g. relative change)
+## The t-th update observed the network at frame t, or at its last frame once the data is exhausted, the first row is the zero initial observation
+def trial_sufficient_statistics(agent, external_state):
+    internal_state, action_state = agent.internal_state, agent.action_state
+    T = internal_state._n
+    interventions = np.full(T, np.nan)
+    interventions[1:] = action_state._A[0:T-1]
+
+    observations = np.zeros((T+1, external_state.K))
+    observations[1:] = external_state._X[np.minimum(np.arange(1, T+1), external_state._N)]
+    return internal_state.compute_sufficient_statistics(observations, interventions)
+
 
 # Runs the specified model on the specified data, with given parameters without assuming anything about the structure of data
 def generalised_model_fitting(internal_states_list,                # List of internal states names as strings
@@ -56,6 +102,9 @@ def generalised_model_fitting(internal_states_list,                # List of int
             generated_data = {}
             
         
+    # Worker pools of the action states, shared by all trials, see methods.executor_methods
+    executors = shared_executors(action_states_list, models_dict, sample_space=space_triple)
+
     # Count participant index
     sample_size = len(data_dict.keys())
     done_idx = 0
@@ -103,6 +152,9 @@ def generalised_model_fitting(internal_states_list,                # List of int
             external_state.load_trial_data(data) # Load Data
 
         # Set up states
+        ## Only keep the posterior history that is read after fitting
+        retention = internal_states_retention(action_states_list, models_dict, save_full_data=save_full_data, judgement_data=judgement_data)
+
         ## Internal states and sensory states
         internal_states = []
         sensory_states = []  
@@ -134,7 +186,8 @@ def generalised_model_fitting(internal_states_list,                # List of int
             i_s = models_dict['internal'][model]['object'](N, K, 
                                                            *models_dict['internal'][model]['params']['args'],
                                                            **internal_states_kwargs,
-                                                           generate_sample_space = False)
+                                                           generate_sample_space = False,
+                                                           retention = retention)
 
             # Initialse space according to build_space
             i_s.add_sample_space_env(space_triple)
@@ -162,10 +215,13 @@ def generalised_model_fitting(internal_states_list,                # List of int
                 for param_key, param_val in fitted_params_dict[model].items():
                     if param_key in action_states_kwargs.keys():
                         action_states_kwargs[param_key] = param_val
+            if model in executors:
+                action_states_kwargs['executor'] = executors[model]
             
             a_s = models_dict['actions'][model]['object'](N, K, 
                                                          *models_dict['actions'][model]['params']['args'],
-                                                         **action_states_kwargs)
+                                                         **action_states_kwargs,
+                                                         retention = 'none')
             # Load action data if fitting
             if fit_or_run == 'fit':
                 a_s.load_action_data(inters, data)
@@ -192,7 +248,7 @@ def generalised_model_fitting(internal_states_list,                # List of int
 
         # Fit data
         if fit_or_run == 'fit':
-            experiment.fit(verbose=verbose)
+            experiment.fit(verbose=verbose, replay=True)
         else:
             experiment.run(verbose=verbose)
 
@@ -297,6 +353,8 @@ def generalised_model_fitting(internal_states_list,                # List of int
             df = pd.DataFrame(columns=cols)
 
     
+    shutdown_executors(executors)
+
     # Final save
     if save_data:
 
@@ -376,6 +434,9 @@ def fit_models(internal_states_list,                # List of internal states na
             generated_data = {}
             
         
+    # Worker pools of the action states, shared by all trials, see methods.executor_methods
+    executors = shared_executors(action_states_list, models_dict, sample_space=space_triple)
+
     # Count participant index
     sample_size = len(data_dict.keys())
     part_idx = 0
@@ -429,6 +490,11 @@ def fit_models(internal_states_list,                # List of internal states na
                 external_state.load_trial_data(data) # Load Data
 
             # Set up states
+            ## Only keep the posterior history that is read after fitting, posteriors at judgements are always read when saving full data
+            retention = internal_states_retention(action_states_list, models_dict, save_full_data=save_full_data, judgement_data=judgement_data)
+            if save_full_data and isinstance(retention, str) and retention == 'none':
+                retention = judgement_frames(judgement_data)
+
             ## Internal states and sensory states
             internal_states = []
             sensory_states = []  
@@ -460,7 +526,8 @@ def fit_models(internal_states_list,                # List of internal states na
                 i_s = models_dict['internal'][model]['object'](N, K, 
                                                                *models_dict['internal'][model]['params']['args'],
                                                                **internal_states_kwargs,
-                                                               generate_sample_space = False)
+                                                               generate_sample_space = False,
+                                                               retention = retention)
                 # Initialse space according to build_space
                 i_s.add_sample_space_env(space_triple)
                 # Initialise prior distributions for all IS
@@ -486,10 +553,13 @@ def fit_models(internal_states_list,                # List of internal states na
                     for param_key, param_val in fitted_params_dict[model].items():
                         if param_key in action_states_kwargs.keys():
                             action_states_kwargs[param_key] = param_val
+                if model in executors:
+                    action_states_kwargs['executor'] = executors[model]
                 
                 a_s = models_dict['actions'][model]['object'](N, K, 
                                                              *models_dict['actions'][model]['params']['args'],
-                                                             **action_states_kwargs)
+                                                             **action_states_kwargs,
+                                                             retention = 'none')
                 # Load action data if fitting
                 if fit_or_run == 'fit':
                     a_s.load_action_data(inters, data, inters_fit)
@@ -517,7 +587,7 @@ def fit_models(internal_states_list,                # List of internal states na
 
             # Fit data
             if fit_or_run == 'fit':
-                experiment.fit(verbose=verbose)
+                experiment.fit(verbose=verbose, replay=True)
             else:
                 experiment.run(verbose=verbose)
 
@@ -622,6 +692,8 @@ def fit_models(internal_states_list,                # List of internal states na
             print('Done.')
 
     
+    shutdown_executors(executors)
+
     # Final save
     if save_data:
 
@@ -803,7 +875,9 @@ def fit_params_models_partlevel(params_initial_guesses,              # Initial g
             internal_params_labels,              # List of labels and indices in params of to fit of internal states params
             action_params_labels,
             sensory_params_labels,
-            space_triple 
+            space_triple,
+            False,                               # fit_judgement
+            {}                                   # Sufficient statistics of the participant's trials, filled at the first evaluation
         )
 
         minimize_out = minimize(fit_participant, 
@@ -874,7 +948,8 @@ def fit_participant(params_to_fit,
                     action_params_labels,
                     sensory_params_labels,
                     space_triple,
-                    fit_judgement=False):                 
+                    fit_judgement=False,
+                    sufficient_stats=None):              # Dict of sufficient statistics by trial utid, see fits_from_statistics
 
     trials = part_data['trials']
     nLL = 0
@@ -905,6 +980,9 @@ def fit_participant(params_to_fit,
         external_state.load_trial_data(data) # Load Data
 
         # Set up states
+        ## Only the final posterior is read, no history is kept unless action states need it
+        retention = internal_states_retention(action_states_list, models_dict)
+
         ## Internal states
         internal_states = []   
         
@@ -917,7 +995,8 @@ def fit_participant(params_to_fit,
             i_s = models_dict['internal'][model]['object'](N, K, 
                                                            *models_dict['internal'][model]['params']['args'],
                                                            **internal_states_kwargs,
-                                                           generate_sample_space = False)
+                                                           generate_sample_space = False,
+                                                           retention = retention)
             # Initialse space according to build_space
             i_s.add_sample_space_env(space_triple)
             # Initialise prior distributions for all IS
@@ -938,7 +1017,8 @@ def fit_participant(params_to_fit,
 
             a_s = models_dict['actions'][model]['object'](N, K, 
                                                          *models_dict['actions'][model]['params']['args'],
-                                                         **action_states_kwargs)
+                                                         **action_states_kwargs,
+                                                         retention = 'none')
             # Load action data
             a_s.load_action_data(inters, data, inters_fit)
             action_states.append(a_s)
@@ -970,7 +1050,16 @@ def fit_participant(params_to_fit,
         experiment = Experiment(agent, external_state)
 
         # Fit data
-        experiment.fit(console=False)
+        ## Trials whose sufficient statistics are known only need the final posterior
+        from_statistics = sufficient_stats is not None \
+                          and not internal_states_kwargs.get('sample_params', False) \
+                          and fits_from_statistics(internal_states, sensory_states, internal_params_labels, sensory_params_labels, fit_judgement)
+        if from_statistics and utid in sufficient_stats:
+            internal_states[0].update_from_statistics(sufficient_stats[utid], agent._N)
+        else:
+            experiment.fit(replay=True)
+            if from_statistics:
+                sufficient_stats[utid] = trial_sufficient_statistics(agent, external_state)
 
         # Extract relevant data
         # Extract posterior
@@ -1153,6 +1242,9 @@ def fit_group(params_to_fit,
             external_state.load_trial_data(data) # Load Data
 
             # Set up states
+            ## Only the final posterior is read, no history is kept unless action states need it
+            retention = internal_states_retention(action_states_list, models_dict)
+
             ## Internal states
             internal_states = []   
 
@@ -1165,7 +1257,8 @@ def fit_group(params_to_fit,
                 i_s = models_dict['internal'][model]['object'](N, K, 
                                                                *models_dict['internal'][model]['params']['args'],
                                                                **internal_states_kwargs,
-                                                               generate_sample_space = False)
+                                                               generate_sample_space = False,
+                                                               retention = retention)
                 # Initialse space according to build_space
                 i_s.add_sample_space_env(space_triple)
                 # Initialise prior distributions for all IS
@@ -1186,7 +1279,8 @@ def fit_group(params_to_fit,
 
                 a_s = models_dict['actions'][model]['object'](N, K, 
                                                              *models_dict['actions'][model]['params']['args'],
-                                                             **action_states_kwargs)
+                                                             **action_states_kwargs,
+                                                             retention = 'none')
                 # Load action data
                 a_s.load_action_data(inters, data, inters_fit)
                 action_states.append(a_s)
@@ -1218,7 +1312,7 @@ def fit_group(params_to_fit,
             experiment = Experiment(agent, external_state)
 
             # Fit data
-            experiment.fit(console=False)
+            experiment.fit(replay=True)
 
             # Extract relevant data
             # Extract posterior
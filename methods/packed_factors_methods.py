@@ -0,0 +1,33 @@
+import numpy as np
+
+
+# Packed storage for a set of factors of different sizes, e.g. the variational factors of Variational_IS
+## Factors are laid out one after the other in a single contiguous buffer: factor i is buffer[..., offsets[i]:offsets[i+1]]
+## Buffers can have leading batch dimensions, e.g. a (T, total_size) history, kernels work segment wise on the last axis
+## Offsets are built from the factor sizes by Variational_IS
+
+# List of the factors of a packed buffer, as views
+def unpack_factors(buffer, offsets):
+    return [buffer[..., offsets[i]:offsets[i+1]] for i in range(offsets.size - 1)]
+
+
+# Per factor values repeated over the entries of each factor
+def _segment_broadcast(values, offsets):
+    return np.repeat(values, np.diff(offsets), axis=-1)
+
+
+# Normalised probabilities of each factor from unnormalised log probabilities
+def segment_softmax(log_buffer, offsets):
+    segment_max = np.maximum.reduceat(log_buffer, offsets[:-1], axis=-1)
+    exp_buffer = np.exp(log_buffer - _segment_broadcast(segment_max, offsets))
+    segment_sum = np.add.reduceat(exp_buffer, offsets[:-1], axis=-1)
+
+    return exp_buffer / _segment_broadcast(segment_sum, offsets)
+
+
+# Entropy of each factor in bits, zero probabilities do not contribute
+def segment_entropy(probs, offsets):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        plogp = np.where(probs > 0, probs * np.log2(probs), 0)
+
+    return - np.add.reduceat(plogp, offsets[:-1], axis=-1)
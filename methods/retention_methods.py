@@ -0,0 +1,43 @@
+import numpy as np
+
+
+# History retention policies shared by internal and action states
+## retention can be:
+### 'full' (or None): keep every frame
+### 'none': keep only the initial state, the current state is always available
+### int k: keep every k-th frame
+### array of frame indices: keep those frames only, e.g. judgement frames as given by judgement_frames
+## The initial state (frame 0) is always kept so that states can be reset
+def build_retention_mask(N, retention='full'):
+    keep = np.zeros(N+1, dtype=bool)
+
+    if retention is None or (isinstance(retention, str) and retention == 'full'):
+        keep[:] = True
+    elif isinstance(retention, str) and retention == 'none':
+        pass
+    elif isinstance(retention, (int, np.integer)):
+        if retention < 1:
+            raise ValueError(f'Retention every k-th frame needs k >= 1, got {retention}')
+        keep[::retention] = True
+    else:
+        frames = np.asarray(retention, dtype=int)
+        keep[frames[frames <= N]] = True
+
+    keep[0] = True
+
+    return keep
+
+
+# Slot of each frame in a compact history, -1 when the frame is not retained
+def retention_slots(keep):
+    slots = np.cumsum(keep) - 1
+    slots[~keep] = -1
+    return slots
+
+
+# Frames at which judgements are made, from the judgement (links_hist) data
+def judgement_frames(judgement_data):
+    if judgement_data.dtype == bool:
+        return np.where(judgement_data.any(axis=1))[0]
+    else:
+        return np.where((~np.isnan(judgement_data.astype(float))).any(axis=1))[0]
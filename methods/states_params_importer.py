@@ -7,6 +7,7 @@ from classes.ou_network import OU_Network
 from classes.internal_states.lc_omniscient_DIS import Local_computations_omniscient_DIS
 from classes.internal_states.lc_omniscient_CIS import Local_computations_omniscient_CIS
 from classes.internal_states.normative_DIS import Normative_DIS
+from classes.internal_states.normative_factorised_DIS import Normative_factorised_DIS
 from classes.internal_states.change_based_CIS import LC_linear_change_CIS
 from classes.internal_states.change_based_DIS import LC_linear_change_DIS
 from classes.internal_states.lc_interfocus_DIS import Local_computations_interfocus_DIS
@@ -15,6 +16,7 @@ from classes.internal_states.mean_field_VIS import MeanField_VIS
 
 from classes.action_states.discounted_gain_soft_horizon_TSAS import Discounted_gain_soft_horizon_TSAS
 from classes.action_states.undiscounted_gain_hard_horizon_TSAS import Undiscounted_gain_hard_horizon_TSAS
+from classes.action_states.anytime_MCTS_TSAS import Anytime_MCTS_TSAS
 from classes.action_states.experience_discrete_3D_AS import Experience_discrete_3D_AS
 from classes.action_states.experience_conti_3D_AS import Experience_conti_3D_AS
 
@@ -27,6 +29,7 @@ def import_states_asdict():
     states_dict = {
         'internal': {
             'normative': Normative_DIS,
+            'normative_factorised': Normative_factorised_DIS,
             'LC_discrete': Local_computations_omniscient_DIS,
             'LC_continuous': Local_computations_omniscient_CIS,
             'LC_discrete_attention': Local_computations_interfocus_DIS,
@@ -38,6 +41,7 @@ def import_states_asdict():
         'actions': {
             'tree_search_soft_horizon': Discounted_gain_soft_horizon_TSAS,
             'tree_search_hard_horizon': Undiscounted_gain_hard_horizon_TSAS,
+            'tree_search_mcts': Anytime_MCTS_TSAS,
             'experience_vao': Experience_conti_3D_AS
         },
         'sensory': {
@@ -97,6 +101,9 @@ def import_states_params_asdict():
     ## Different update schedules:
     ### omniscient, full, single_factor, single_link, single_variable
     update_schedule = 'full'
+    ## Expectations over the other factors:
+    ### moments (closed form), enumeration (all joint values)
+    expectation = 'moments'
     certainty_threshold = .4 # Should be represented as a percentage of the maximum entropy
     evidence_weight = 0.1
     block_learning = [
@@ -145,9 +152,22 @@ def import_states_params_asdict():
     resource_rational_parameter = 0.1
     ### Hard horizon
     depth = 1 # Target depth for hard horizon undiscounted gain  
+    rollouts = 'sequential' # Can be 'sequential' or 'batched' (all branches of a tree level simulated at once)
+    executor = 'serial' # Can be 'serial' or 'process' (concurrent exploration of the branches)
+    workers = None # Number of worker processes of the process executor, number of cores if None
+    transpositions = False # Cache the branches of identical nodes across graphs and decisions (serial executor)
+    tolerance = None # Observation tolerance to reuse the subtree of the chosen action at the next decision, None for identical nodes only
+    common_random_numbers = False # Share the simulation noise of a decision between all branches and sampled graphs
+    estimator = 'simulation' # Estimator of the gain of each branch, 'simulation' or 'noise_free' (single noise free batched rollout, fixed depth trees with batch capable states)
+    fit_schedule = 'every_frame' # Frames at which action values are computed when fitting, 'every_frame' or 'decision_points'
     ### Soft horizon
     horizon = 1e-2 # For soft horizon discounted gain
     discount = 0.01 # For soft horizon discounted gain
+    ### Anytime Monte Carlo tree search
+    mcts_depth = 2 # Maximum depth of the tree
+    budget = 100 # Per decision budget, in simulated branches or seconds
+    budget_type = 'nodes' # Can be 'nodes' or 'time'
+    exploration = np.sqrt(2) # UCB1 exploration constant
     ### Action selection policy
     action_temperature = 1
     softmax_policy_funcs = epsilon_greedy_init(0)#softmax_policy_init(action_temperature)
@@ -203,6 +223,22 @@ def import_states_params_asdict():
                 }
                 
             },
+            'normative_factorised': {
+                'object': Normative_factorised_DIS,
+                'params': {
+                    'args': [
+                        L,
+                        dt,
+                        theta,
+                        sigma
+                    ],
+                    'kwargs': {
+                        'evidence_weight': evidence_weight,
+                        'prior_param': prior_param,
+                        'smoothing': beta
+                    }
+                }
+            },
             'LC_discrete': {
                 'object': Local_computations_omniscient_DIS,
                 'params': {
@@ -523,6 +559,7 @@ def import_states_params_asdict():
                     'kwargs': {
                         'factorisation': factorisation,
                         'update_schedule': update_schedule,
+                        'expectation': expectation,
                         'evidence_weight': evidence_weight,
                         'certainty_threshold': certainty_threshold,
                         'block_learning': block_learning,
@@ -550,7 +587,14 @@ def import_states_params_asdict():
                         horizon
                     ],
                     'kwargs': {
-                        'resource_rational_parameter': resource_rational_parameter
+                        'resource_rational_parameter': resource_rational_parameter,
+                        'executor': executor,
+                        'workers': workers,
+                        'transpositions': transpositions,
+                        'tolerance': tolerance,
+                        'common_random_numbers': common_random_numbers,
+                        'estimator': estimator,
+                        'fit_schedule': fit_schedule
                     }
                 }
             },
@@ -569,11 +613,44 @@ def import_states_params_asdict():
                         depth
                     ],
                     'kwargs': {
-                        'resource_rational_parameter': resource_rational_parameter
+                        'resource_rational_parameter': resource_rational_parameter,
+                        'rollouts': rollouts,
+                        'executor': executor,
+                        'workers': workers,
+                        'transpositions': transpositions,
+                        'tolerance': tolerance,
+                        'common_random_numbers': common_random_numbers,
+                        'estimator': estimator,
+                        'fit_schedule': fit_schedule
                     }
                 }
                 
             },
+            'tree_search_mcts': {
+                'object': Anytime_MCTS_TSAS,
+                'params': {
+                    'args': [
+                        behaviour,
+                        epsilon,
+                        tree_search_poss_actions,
+                        action_len,
+                        softmax_policy_funcs,
+                        C,
+                        knowledge,
+                        gain_type,
+                        mcts_depth,
+                        budget
+                    ],
+                    'kwargs': {
+                        'budget_type': budget_type,
+                        'exploration': exploration,
+                        'resource_rational_parameter': resource_rational_parameter,
+                        'common_random_numbers': common_random_numbers,
+                        'estimator': estimator,
+                        'fit_schedule': fit_schedule
+                    }
+                }
+            },
             'experience_vao': {
                 'object': Experience_discrete_3D_AS,
                 'params': {